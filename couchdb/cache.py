@@ -0,0 +1,452 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2007-2009 Christopher Lenz
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+
+"""Local caches of database content, kept up to date from the changes feed
+of the database."""
+
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+import logging
+import threading
+from types import FunctionType
+
+from couchdb import http, util
+from couchdb.client import Document, View
+
+__all__ = ['LocalViewCache', 'CachedDatabase']
+__docformat__ = 'restructuredtext en'
+
+log = logging.getLogger('couchdb.cache')
+
+
+class _Max(object):
+    # Sorts after any document ID or emit index, to find the end of a range
+    def __lt__(self, other):
+        return False
+    def __gt__(self, other):
+        return True
+
+_MAX = _Max()
+_MISSING = object()
+
+
+def _collation_key(value):
+    """Return a key that sorts JSON values in the order CouchDB collates
+    them: ``null``, booleans, numbers, strings, arrays, then objects.
+
+    Note that strings are compared by code point, not with the ICU
+    collation CouchDB uses.
+    """
+    if value is None:
+        return (0,)
+    if value is False or value is True:
+        return (1, value)
+    if isinstance(value, (int, util.ltype, float)):
+        return (2, value)
+    if isinstance(value, util.strbase):
+        return (3, value)
+    if isinstance(value, (list, tuple)):
+        return (4, tuple([_collation_key(item) for item in value]))
+    if isinstance(value, dict):
+        return (5, tuple([(_collation_key(k), _collation_key(v))
+                          for k, v in value.items()]))
+    raise TypeError('%r is not a JSON value' % (value,))
+
+
+class LocalViewCache(View):
+    """A view computed locally by a Python map function and stored in memory,
+    kept up to date by applying the changes feed of the database.
+
+    The map function has the same signature as map functions run by the
+    `couchdb.view` server: it takes a document and yields ``(key, value)``
+    pairs. It may also be given as source code, as in a `ViewDefinition`
+    with the ``python`` language.
+
+    Queries support the options of permanent views that don't need a reduce
+    function or the documents, and return `ViewResults`, so slicing works as
+    it does for views on the server:
+
+    >>> from couchdb import Server
+    >>> server = Server()
+    >>> db = server.create('python-tests')
+    >>> db['johndoe'] = dict(type='Person', name='John Doe')
+    >>> db['maryjane'] = dict(type='Person', name='Mary Jane')
+    >>> db['gotham'] = dict(type='City', name='Gotham City')
+    >>> def map_fun(doc):
+    ...     yield [doc['type'], doc['name']], doc['name']
+    >>> cache = LocalViewCache(db, map_fun)
+    >>> cache.update()
+    3
+    >>> for row in cache()[['Person']:['Person', 'ZZZZ']]:
+    ...     print(row.value)
+    John Doe
+    Mary Jane
+
+    The cache only reflects the changes up to its last `update`, which has
+    to be called again to pick up later changes. The keys and values of the
+    rows are shared with the cache and must not be modified. As with views on
+    the server, design documents are only mapped with `include_design`.
+
+    >>> del server['python-tests']
+    """
+
+    def __init__(self, db, map_fun, wrapper=None, include_design=False):
+        """Initialize the cache.
+
+        :param db: the `Database` whose documents to map
+        :param map_fun: the map function, or its Python source code
+        :param wrapper: an optional callable that should be used to wrap the
+                        result rows
+        :param include_design: whether to map design documents too
+        """
+        self.db = db
+        if isinstance(map_fun, util.strbase):
+            map_fun = _compile(map_fun)
+        self.map_fun = map_fun
+        self.wrapper = wrapper
+        self.include_design = include_design
+        self.last_seq = 0
+        self._rows = [] # (collation key, doc ID, index, key, value) tuples
+        self._by_id = {} # doc ID -> list of (collation key, doc ID, index)
+
+    def __repr__(self):
+        return '<%s %r %r>' % (type(self).__name__, self.db,
+                               self.map_fun.__name__)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def update(self, batch=None):
+        """Apply the changes made to the database since the last update.
+
+        :param batch: the maximum number of changes to request at a time, or
+                      `None` to request them all at once
+        :return: the number of changes applied
+        :rtype: `int`
+        """
+        count = 0
+        # An empty cache is filled by sorting all rows once, rather than
+        # inserting them one at a time
+        loading = {} if not self._rows else None
+        while True:
+            options = {'since': self.last_seq, 'include_docs': True}
+            if batch:
+                options['limit'] = batch
+            data = self.db.changes(**options)
+            for change in data['results']:
+                if loading is not None:
+                    loading[change['id']] = self._map(change)
+                else:
+                    self._apply(change)
+            count += len(data['results'])
+            self.last_seq = data['last_seq']
+            if not batch or len(data['results']) < batch:
+                break
+        if loading:
+            self._rows = sorted(row for rows in loading.values()
+                                for row in rows)
+            for row in self._rows:
+                self._by_id.setdefault(row[1], []).append(row[:3])
+        return count
+
+    def _map(self, change):
+        # Return the rows emitted for the changed document
+        docid = change['id']
+        if change.get('deleted') or \
+                (docid.startswith('_design/') and not self.include_design):
+            return []
+        try:
+            emitted = list(self.map_fun(change['doc']) or ())
+        except Exception as e:
+            log.error('runtime error in map function for %r: %s', docid, e,
+                      exc_info=True)
+            return []
+        return [(_collation_key(key), docid, idx, key, value)
+                for idx, (key, value) in enumerate(emitted)]
+
+    def _apply(self, change):
+        docid = change['id']
+        rows = self._rows
+        for prefix in self._by_id.pop(docid, ()):
+            del rows[bisect_left(rows, prefix)]
+        prefixes = []
+        for row in self._map(change):
+            rows.insert(bisect_left(rows, row), row)
+            prefixes.append(row[:3])
+        if prefixes:
+            self._by_id[docid] = prefixes
+
+    def _bounds(self, key, docid, upper, inclusive):
+        # Index of the first row after (upper) or at (lower) the given bound
+        rows = self._rows
+        if key is _MAX:
+            return len(rows) if upper else 0
+        bound = (_collation_key(key),)
+        if docid is not None:
+            bound += (docid,)
+        if upper == inclusive:
+            return bisect_right(rows, bound + (_MAX,))
+        return bisect_left(rows, bound)
+
+    def _exec(self, options):
+        options = options.copy()
+        for name in ('startkey', 'endkey', 'startkey_docid', 'endkey_docid'):
+            alias = name.replace('key', '_key').replace('_docid', '_doc_id')
+            if alias in options:
+                options[name] = options.pop(alias)
+        descending = options.pop('descending', False)
+        inclusive_end = options.pop('inclusive_end', True)
+        limit = options.pop('limit', None)
+        skip = options.pop('skip', 0)
+        if 'key' in options:
+            options['keys'] = [options.pop('key')]
+        keys = options.pop('keys', None)
+        start = options.pop('startkey', _MAX)
+        start_docid = options.pop('startkey_docid', None)
+        end = options.pop('endkey', _MAX)
+        end_docid = options.pop('endkey_docid', None)
+        options.pop('update_seq', None)
+        if options.get('reduce') is False:
+            del options['reduce']
+        if options:
+            raise ValueError('Unsupported view options: %s'
+                             % ', '.join(sorted(options)))
+
+        if keys is not None:
+            offset = None
+            rows = []
+            for key in keys:
+                lo = self._bounds(key, None, False, True)
+                hi = self._bounds(key, None, True, True)
+                matches = self._rows[lo:hi]
+                rows.extend(matches[::-1] if descending else matches)
+        elif descending:
+            lo = self._bounds(end, end_docid, False, inclusive_end)
+            hi = self._bounds(start, start_docid, True, True)
+            rows = self._rows[lo:hi][::-1]
+            offset = len(self._rows) - hi
+        else:
+            lo = self._bounds(start, start_docid, False, True)
+            hi = self._bounds(end, end_docid, True, inclusive_end)
+            rows = self._rows[lo:hi]
+            offset = lo
+        if skip:
+            rows = rows[skip:]
+        if limit is not None:
+            rows = rows[:limit]
+        data = {'total_rows': len(self._rows),
+                'rows': [{'id': row[1], 'key': row[3], 'value': row[4]}
+                         for row in rows],
+                'update_seq': self.last_seq}
+        if offset is not None:
+            data['offset'] = offset + skip
+        return data
+
+
+def _compile(source):
+    # Like the view server, expect the source to define a single function
+    globals_ = {}
+    util.pyexec(source, {}, globals_)
+    functions = [value for value in globals_.values()
+                 if type(value) is FunctionType]
+    if len(functions) != 1:
+        raise ValueError('map function source must define a single function')
+    return functions[0]
+
+
+class CachedDatabase(object):
+    """Wrapper around a `Database` that serves documents from a local cache,
+    which a background thread keeps consistent by following the continuous
+    changes feed of the database.
+
+    Documents read by ID without options are cached, up to `max_size` of
+    them, and dropped as soon as the changes feed reports a change to them,
+    so reads may lag behind writes by others only for as long as the changes
+    take to arrive. Writes made through the wrapper invalidate the cached
+    document right away. Everything else is passed on to the database.
+
+    >>> from couchdb import Server
+    >>> server = Server()
+    >>> db = CachedDatabase(server.create('python-tests'))
+    >>> db['johndoe'] = dict(type='Person', name='John Doe')
+    >>> db['johndoe']['name']
+    u'John Doe'
+    >>> db['johndoe']['name']
+    u'John Doe'
+    >>> db.hits, db.misses
+    (1, 1)
+    >>> db.close()
+
+    The documents returned are shallow copies of the cached ones, so nested
+    values must not be modified.
+
+    If the changes feed fails, the cache is cleared and bypassed until the
+    feed is requested again, after `retry_delay` seconds.
+
+    >>> del server['python-tests']
+    """
+
+    def __init__(self, db, max_size=1000, poll_timeout=10000, retry_delay=1):
+        """Initialize the cache and start following the changes feed.
+
+        :param db: the `Database` to cache the documents of
+        :param max_size: the maximum number of documents to cache
+        :param poll_timeout: the number of milliseconds after which a quiet
+                             changes feed is requested again, which also
+                             bounds the time `close` takes to take effect
+        :param retry_delay: the number of seconds to wait before requesting
+                            the changes feed again after it failed
+        """
+        self.db = db
+        self.max_size = max_size
+        self.poll_timeout = poll_timeout
+        self.retry_delay = retry_delay
+        self.hits = self.misses = self.invalidations = 0
+        self.last_seq = db.info()['update_seq']
+        self._docs = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0 # incremented by every invalidation
+        self._listening = True
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._listen,
+                                         name='CachedDatabase changes')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __repr__(self):
+        return '<%s %r>' % (type(self).__name__, self.db)
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+    def __contains__(self, id):
+        return id in self.db
+
+    def __iter__(self):
+        return iter(self.db)
+
+    def __len__(self):
+        return len(self.db)
+
+    def __getitem__(self, id):
+        """Return the document with the specified ID.
+
+        :param id: the document ID
+        :rtype: `Document`
+        :raise ResourceNotFound: if no document with that ID exists
+        """
+        doc = self.get(id)
+        if doc is None:
+            raise http.ResourceNotFound(('not_found', 'missing'))
+        return doc
+
+    def __setitem__(self, id, content):
+        self.db[id] = content
+        self.invalidate(id)
+
+    def __delitem__(self, id):
+        del self.db[id]
+        self.invalidate(id)
+
+    @property
+    def hit_rate(self):
+        """The share of the reads served from the cache.
+
+        :rtype: `float`
+        """
+        total = self.hits + self.misses
+        return self.hits / float(total) if total else 0.0
+
+    def get(self, id, default=None, **options):
+        """Return the document with the specified ID, from the cache if
+        possible.
+
+        Reads with options, such as ``rev`` or ``conflicts``, always go to the
+        database.
+
+        :param id: the document ID
+        :param default: the default value to return when the document is not
+                        found
+        :return: a `Document` object, or the default value
+        """
+        if options or not self._listening:
+            return self.db.get(id, default, **options)
+        with self._lock:
+            doc = self._docs.pop(id, _MISSING)
+            if doc is not _MISSING:
+                self._docs[id] = doc
+                self.hits += 1
+            else:
+                self.misses += 1
+                generation = self._generation
+        if doc is _MISSING:
+            doc = self.db.get(id)
+            with self._lock:
+                # Don't cache what may have changed while it was retrieved
+                if generation == self._generation and self._listening:
+                    self._docs[id] = doc
+                    if len(self._docs) > self.max_size:
+                        self._docs.popitem(last=False)
+        if doc is None:
+            return default
+        return Document(doc)
+
+    def save(self, doc, **options):
+        result = self.db.save(doc, **options)
+        self.invalidate(result[0])
+        return result
+
+    def delete(self, doc):
+        self.db.delete(doc)
+        self.invalidate(doc['_id'])
+
+    def update(self, documents, **options):
+        results = self.db.update(documents, **options)
+        for _, docid, _ in results:
+            self.invalidate(docid)
+        return results
+
+    def invalidate(self, id=None):
+        """Drop the document with the specified ID from the cache, or all
+        documents if no ID is given.
+
+        :param id: the document ID
+        """
+        with self._lock:
+            self._generation += 1
+            if id is None:
+                self._docs.clear()
+            elif self._docs.pop(id, _MISSING) is not _MISSING:
+                self.invalidations += 1
+
+    def close(self):
+        """Stop following the changes feed and clear the cache."""
+        self._closed.set()
+        self._listening = False
+        self.invalidate()
+
+    def _listen(self):
+        while not self._closed.is_set():
+            self._listening = True
+            try:
+                for change in self.db.changes(feed='continuous',
+                                              since=self.last_seq,
+                                              timeout=self.poll_timeout):
+                    if 'last_seq' in change:
+                        self.last_seq = change['last_seq']
+                    else:
+                        self.invalidate(change['id'])
+                        self.last_seq = change['seq']
+                    if self._closed.is_set():
+                        break
+            except Exception as e:
+                log.warning('changes feed of %r failed: %s', self.db, e)
+                self._listening = False
+                self.invalidate()
+                self._closed.wait(self.retry_delay)
+        self._listening = False
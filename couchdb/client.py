@@ -23,9 +23,12 @@ False
 >>> del server['python-tests']
 """
 
+from base64 import b64decode
+import codecs
 import itertools
 import mimetypes
 import os
+import re
 from types import FunctionType
 from inspect import getsource
 from textwrap import dedent
@@ -34,8 +37,10 @@ import sys
 import socket
 
 from couchdb import http, json, util
+from couchdb.multipart import _parse_header, iter_multipart
 
-__all__ = ['Server', 'Database', 'Document', 'ViewResults', 'Row']
+__all__ = ['Server', 'Database', 'Document', 'LazyDocument', 'ViewResults',
+           'Row']
 __docformat__ = 'restructuredtext en'
 
 
@@ -102,13 +107,41 @@ class Server(object):
 
     def __iter__(self):
         """Iterate over the names of all databases."""
-        status, headers, data = self.resource.get_json('_all_dbs')
-        return iter(data)
+        return self.iterdbs()
 
     def __len__(self):
-        """Return the number of databases."""
-        status, headers, data = self.resource.get_json('_all_dbs')
-        return len(data)
+        """Return the number of databases.
+
+        Rather than downloading the names of all databases, the number is
+        found by probing for a database name at exponentially growing and
+        then bisected offsets into the ``_all_dbs`` list, so that every
+        request returns at most one name.
+        """
+        def names_at(offset):
+            _, _, data = self.resource.get_json('_all_dbs', skip=offset,
+                                                limit=1)
+            return data
+
+        first = names_at(0)
+        if len(first) != 1:
+            # Either there are no databases, or the server doesn't support
+            # paging through _all_dbs and returned all names
+            return len(first)
+        present, absent = 0, 1
+        while True:
+            names = names_at(absent)
+            if not names:
+                break
+            if names == first: # the single database, ignoring skip
+                return 1
+            present, absent = absent, absent * 2
+        while absent - present > 1:
+            middle = (present + absent) // 2
+            if names_at(middle):
+                present = middle
+            else:
+                absent = middle
+        return present + 1
 
     def __nonzero__(self):
         """Return whether the server is available."""
@@ -192,6 +225,117 @@ class Server(object):
         status, headers, data = resource.get_json()
         return data
 
+    def iterdbs(self, batch=1000, start=None):
+        """Iterate over the names of all databases, fetching them in batches.
+
+        Servers that don't support paging through ``_all_dbs`` (before
+        CouchDB 2.0) return all names in the first batch. If a server limits
+        the batches but ignores where they start, the remaining names are
+        taken from a single request for all of them instead.
+
+        :param batch: number of names to fetch per HTTP request
+        :param start: the name to start at, instead of the first database
+        :return: a generator of database names
+        :since: 1.3
+        """
+        if batch <= 0:
+            raise ValueError('batch must be 1 or more')
+        options = {'limit': batch}
+        if start is not None:
+            options['start_key'] = json.encode(start)
+        last = None
+        while True:
+            _, _, names = self.resource.get_json('_all_dbs', **options)
+            if last is not None and names and names[0] <= last:
+                # The server ignored the start key, so paging would never
+                # get past the first batch
+                _, _, names = self.resource.get_json('_all_dbs')
+                for name in names:
+                    if name > last:
+                        yield name
+                return
+            for name in names:
+                yield name
+            if len(names) != batch:
+                break
+            last = names[-1]
+            options.update(start_key=json.encode(names[-1]), skip=1)
+
+    def dbs_info(self, names, batch=100, concurrency=4):
+        """Return information about several databases.
+
+        The information is requested from ``_dbs_info`` in batches of names,
+        with up to `concurrency` requests at a time. Servers without
+        ``_dbs_info`` (before CouchDB 2.2) are asked for the information of
+        every database separately instead, again with up to `concurrency`
+        requests at a time. Other errors from ``_dbs_info`` are raised.
+
+        :param names: the names of the databases
+        :param batch: number of databases to ask about per request
+        :param concurrency: number of requests to make at a time
+        :return: a dictionary mapping the names of the databases that exist
+                 to their information, as returned by `Database.info`
+        :rtype: `dict`
+        :since: 1.3
+        """
+        names = list(names)
+        try:
+            return self._dbs_info(names, batch, concurrency)
+        except http.ResourceNotFound:
+            pass
+        except http.ServerError as e:
+            if e.args[0][0] not in (400, 405):
+                raise
+        infos = util.parallel_map(self._db_info, names, concurrency)
+        return dict((name, info) for name, info in zip(names, infos)
+                    if info is not None)
+
+    def contains_many(self, names, batch=100, concurrency=4):
+        """Return which of the given databases exist.
+
+        The databases are looked up with ``_dbs_info`` in batches of names,
+        with up to `concurrency` requests at a time. Servers without
+        ``_dbs_info`` (before CouchDB 2.2) are asked about every database
+        separately instead, again with up to `concurrency` requests at a time.
+        Other errors from ``_dbs_info`` are raised.
+
+        :param names: the names of the databases
+        :param batch: number of databases to ask about per request
+        :param concurrency: number of requests to make at a time
+        :return: the names of the databases that exist
+        :rtype: `set`
+        :since: 1.3
+        """
+        names = list(names)
+        try:
+            return set(self._dbs_info(names, batch, concurrency))
+        except http.ResourceNotFound:
+            pass
+        except http.ServerError as e:
+            if e.args[0][0] not in (400, 405):
+                raise
+        found = util.parallel_map(self.__contains__, names, concurrency)
+        return set(name for name, exists in zip(names, found) if exists)
+
+    def _dbs_info(self, names, batch, concurrency):
+        def request(keys):
+            _, _, data = self.resource.post_json('_dbs_info', {'keys': keys})
+            return data
+        batches = [names[i:i + batch] for i in range(0, len(names), batch)]
+        infos = {}
+        for result in util.parallel_map(request, batches, concurrency):
+            for item in result:
+                if item.get('info') is not None:
+                    infos[item['key']] = item['info']
+        return infos
+
+    def _db_info(self, name):
+        try:
+            _, _, data = self.resource(name).get_json()
+        except http.ResourceNotFound:
+            return None
+        return data
+
     def tasks(self):
         """A list of tasks currently active on the server."""
         status, headers, data = self.resource.get_json('_active_tasks')
@@ -645,16 +789,20 @@ class Database(object):
             raise ValueError('document ID cannot be None')
         _doc_resource(self.resource, doc['_id']).delete_json(rev=doc['_rev'])
 
-    def get(self, id, default=None, **options):
+    def get(self, id, default=None, lazy=False, **options):
         """Return the document with the specified ID.
 
         :param id: the document ID
         :param default: the default value to return when the document is not
                         found
+        :param lazy: whether to defer decoding the document until its content
+                     is first accessed, see `LazyDocument`
         :return: a `Row` object representing the requested document, or `None`
                  if no document with the ID was found
         :rtype: `Document`
         """
+        if lazy:
+            return self._get_lazy(id, default, options)
         try:
             _, _, data = _doc_resource(self.resource, id).get_json(**options)
         except http.ResourceNotFound:
@@ -664,6 +812,19 @@ class Database(object):
         else:
             return data
 
+    def _get_lazy(self, id, default, options):
+        try:
+            _, headers, data = _doc_resource(self.resource, id).get(**options)
+        except http.ResourceNotFound:
+            return default
+        data = data.read()
+        if data.lstrip()[:1] != b'{': # e.g. a list of revisions for open_revs
+            return json.decode(data.decode('utf-8'))
+        rev = headers.get('etag')
+        if rev is not None:
+            rev = rev.strip('"')
+        return LazyDocument(data, id, rev)
+
     def revisions(self, id, **options):
         """Return all available revisions of the given document.
 
@@ -745,6 +906,59 @@ class Database(object):
         except http.ResourceNotFound:
             return default
 
+    def iter_attachments(self, id_or_doc, **options):
+        """Return an iterator over all attachments of a document, fetched
+        together with the document in a single ``multipart/related`` request.
+
+        The iterator yields a ``(filename, stub, content)`` tuple for every
+        attachment, where ``stub`` is the entry of the attachment in the
+        ``_attachments`` of the document, and ``content`` is a file-like
+        object streaming the attachment data from the response, which is only
+        readable until the iterator advances. Attachments compressed by the
+        server are sent as stored, which is indicated by an ``encoding`` entry
+        in the stub. Attachments the server doesn't send the data of, such as
+        those unchanged since the revisions given in ``atts_since``, are
+        skipped.
+
+        :param id_or_doc: either a document ID or a dictionary or `Document`
+                          object representing the document
+        :param options: additional query string options, e.g. ``rev``
+        :return: an iterator over the attachments
+        :since: 1.3
+        """
+        if isinstance(id_or_doc, util.strbase):
+            id = id_or_doc
+        else:
+            id = id_or_doc['_id']
+        resource = _doc_resource(self.resource, id)
+        _, headers, data = resource.get(headers={
+            'Accept': 'multipart/related, application/json'
+        }, attachments=True, **options)
+        try:
+            mimetype, params = _parse_header(headers.get('content-type', ''))
+            if not mimetype.startswith('multipart/'):
+                # No attachments, or a server that only inlines them
+                doc = json.decode(data.read().decode('utf-8'))
+                for name, stub in doc.get('_attachments', {}).items():
+                    if 'data' not in stub:
+                        continue # not sent, as with atts_since
+                    content = util.StringIO(b64decode(stub.pop('data')))
+                    yield name, stub, content
+                return
+            parts = iter_multipart(data, boundary=params['boundary'])
+            _, _, payload = next(parts)
+            doc = json.decode(payload.read().decode('utf-8'))
+            stubs = doc.get('_attachments', {})
+            names = [name for name, stub in stubs.items() if stub.get('follows')]
+            for name, (part_headers, _, content) in zip(names, parts):
+                _, params = _parse_header(
+                    part_headers.get('content-disposition', '')
+                )
+                name = params.get('filename', name)
+                yield name, stubs[name], content
+        finally:
+            data.close()
+
     def put_attachment(self, doc, content, filename=None, content_type=None):
         """Create or replace an attachment.
 
@@ -780,7 +994,7 @@ class Database(object):
         }, rev=doc['_rev'])
         doc['_rev'] = data['rev']
 
-    def find(self, mango_query, wrapper=None):
+    def find(self, mango_query, wrapper=None, lazy=False):
         """Execute a mango find-query against the database.
 
         Note: only available for CouchDB version >= 2.0.0
@@ -806,11 +1020,95 @@ class Database(object):
                             documents
         :param wrapper: an optional callable that should be used to wrap the
                         resulting documents
+        :param lazy: whether to defer decoding every document until its
+                     content is first accessed, see `LazyDocument`
         :return: the query results as a list of `Document` (or whatever `wrapper` returns)
         """
+        if lazy:
+            status, headers, body = self.resource.post('_find',
+                                                       body=mango_query)
+            docs = _FindResults(mango_query, body, lazy=True).load().docs
+            return map(wrapper or (lambda doc: doc), docs)
         status, headers, data = self.resource.post_json('_find', mango_query)
         return map(wrapper or Document, data.get('docs', []))
 
+    def iterfind(self, mango_query, batch, wrapper=None, prefetch=False,
+                 lazy=False):
+        """Iterate the documents matching a mango find-query, fetching them
+        in pages of `batch` documents and yielding one document at a time.
+
+        Pages are requested using the bookmark returned with the previous
+        page, and the documents of a page are decoded one by one as the
+        response is read, so that only a single page is held in memory (two
+        with `prefetch`). As with `iterview`, documents added, changed or
+        deleted between requests may be missed or repeated.
+
+        Note: only available for CouchDB version >= 2.0.0
+
+        >>> server = Server()
+        >>> db = server.create('python-tests')
+        >>> for num in range(5):                                # doctest: +SKIP
+        ...     db['doc%d' % num] = dict(type='Person', num=num)
+        >>> mango = {'selector': {'type': 'Person'}}
+        >>> sorted(doc['num'] for doc in
+        ...        db.iterfind(mango, batch=2))                 # doctest: +SKIP
+        [0, 1, 2, 3, 4]
+        >>> del server['python-tests']
+
+        :param mango_query: a dictionary describing criteria used to select
+                            documents; a ``limit`` in it applies to the whole
+                            iteration
+        :param batch: number of documents to fetch per HTTP request
+        :param wrapper: an optional callable that should be used to wrap the
+                        resulting documents
+        :param prefetch: whether to request the next page while the documents
+                         of the current one are being consumed
+        :param lazy: whether to defer decoding every document until its
+                     content is first accessed, see `LazyDocument`
+        :return: document generator
+        :since: 1.3
+        """
+        if batch <= 0:
+            raise ValueError('batch must be 1 or more')
+        limit = mango_query.get('limit')
+        if limit is not None and limit <= 0:
+            raise ValueError('limit must be 1 or more')
+        if wrapper is None:
+            wrapper = (lambda doc: doc) if lazy else Document
+
+        results = self._find_page(mango_query, limit, batch, lazy)
+        while results is not None:
+            pending = None
+            if prefetch:
+                results.load()
+                pending = util.in_background(self._next_find_page, results,
+                                             batch, True)
+            for doc in results:
+                yield wrapper(doc)
+            if pending is not None:
+                results = pending()
+            else:
+                results = self._next_find_page(results, batch)
+
+    def _find_page(self, mango_query, remaining, batch, lazy=False):
+        query = dict(mango_query, limit=min(remaining or batch, batch))
+        status, headers, body = self.resource.post('_find', body=query)
+        return _FindResults(query, body, remaining, lazy)
+
+    def _next_find_page(self, results, batch, load=False):
+        bookmark = results.info.get('bookmark')
+        if results.count < results.query['limit'] or not bookmark:
+            return None
+        remaining = results.remaining
+        if remaining is not None:
+            remaining -= results.count
+            if remaining == 0:
+                return None
+        query = dict(results.query, bookmark=bookmark)
+        query.pop('skip', None) # the bookmark already accounts for it
+        results = self._find_page(query, remaining, batch, results.lazy)
+        return results.load() if load else results
+
     def explain(self, mango_query):
         """Explain a mango find-query.
 
@@ -981,6 +1279,81 @@ class Database(object):
         _, _, data = self.resource.post_json('_purge', body=content)
         return data
 
+    def contains_many(self, ids, batch=1000, concurrency=4):
+        """Return which of the documents with the given IDs exist.
+
+        Instead of a request per document as with ``id in db``, the IDs are
+        looked up in the ``_all_docs`` view in batches, with up to
+        `concurrency` requests at a time. As with ``id in db``, deleted
+        documents don't count as existing.
+
+        :param ids: the document IDs
+        :param batch: number of IDs to look up per request
+        :param concurrency: number of requests to make at a time
+        :return: the IDs of the documents that exist
+        :rtype: `set`
+        :since: 1.3
+        """
+        def request(keys):
+            _, _, data = self.resource.post_json('_all_docs', {'keys': keys})
+            return [row['id'] for row in data['rows']
+                    if 'error' not in row and
+                    not (row.get('value') or {}).get('deleted')]
+        ids = list(ids)
+        batches = [ids[i:i + batch] for i in range(0, len(ids), batch)]
+        found = set()
+        for result in util.parallel_map(request, batches, concurrency):
+            found.update(result)
+        return found
+
+    def revs_diff(self, revs):
+        """Return the revisions of documents that the database doesn't have.
+
+        :param revs: a dictionary mapping document IDs to lists of revisions
+        :return: a dictionary mapping the IDs of documents with missing
+                 revisions to dictionaries with the ``missing`` revisions and,
+                 if there are any, their ``possible_ancestors``
+        :rtype: `dict`
+        :since: 1.3
+        """
+        _, _, data = self.resource.post_json('_revs_diff', body=revs)
+        return data
+
+    def bulk_get(self, docs, **options):
+        """Retrieve specific revisions of many documents using a single HTTP
+        request.
+
+        The return value is a list containing a tuple for every revision that
+        was requested, of the form ``(success, docid, doc_or_exc)``, where
+        ``doc_or_exc`` is either the `Document`, or an exception instance (e.g.
+        `ResourceNotFound`) if the revision couldn't be retrieved.
+
+        :param docs: a sequence of dictionaries with the ``id`` of a document,
+                     and optionally the ``rev`` to retrieve and the revisions
+                     it can omit attachments for as ``atts_since``
+        :param options: optional query string parameters, e.g. ``revs=True``
+                        or ``attachments=True``
+        :return: a list of ``(success, docid, doc_or_exc)`` tuples
+        :rtype: ``list``
+        :since: 1.3
+        """
+        _, _, data = self.resource.post_json('_bulk_get',
+                                             body={'docs': list(docs)},
+                                             **options)
+        results = []
+        for result in data['results']:
+            for item in result['docs']:
+                if 'ok' in item:
+                    results.append((True, result['id'], Document(item['ok'])))
+                    continue
+                error = item['error']
+                if error['error'] == 'not_found':
+                    exc_type = http.ResourceNotFound
+                else:
+                    exc_type = http.ServerError
+                results.append((False, result['id'], exc_type(error['reason'])))
+        return results
+
     def view(self, name, wrapper=None, **options):
         """Execute a predefined view.
 
@@ -1166,6 +1539,128 @@ def _path_from_name(name, type):
     return ['_design', design, type, name]
 
 
+
+_FIND_START = re.compile(r'\s*\{\s*"docs"\s*:\s*\[')
+_FIND_SEPARATOR = re.compile(r'[\s,]*')
+_JSON_STRUCTURE = re.compile(r'[{}\[\]"]')
+_JSON_STRING_REST = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"')
+_JSON_ID_REV = re.compile(r'\{\s*"_id"\s*:\s*("[^"\\]*(?:\\.[^"\\]*)*")'
+                          r'(?:\s*,\s*"_rev"\s*:\s*"([^"\\]*)")?')
+
+
+class _FindResults(object):
+    """The documents of a ``_find`` response, which are decoded one at a time
+    as the response body is read.
+
+    The JSON text of every document is delimited by keeping track of nested
+    objects and arrays, and is then decoded on its own using `json.decode`.
+    The members of the response after the ``docs`` array, such as the
+    ``bookmark``, are available as `info` once all documents have been read.
+    With `lazy`, the JSON text of every document is kept in a `LazyDocument`
+    instead of being decoded.
+    """
+
+    def __init__(self, query, body, remaining=None, lazy=False):
+        self.query = query
+        self.body = body
+        self.remaining = remaining
+        self.lazy = lazy
+        self.count = 0
+        self.info = {}
+        self.docs = None
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buf = ''
+
+    def __iter__(self):
+        if self.docs is not None:
+            return iter(self.docs)
+        return self._decode()
+
+    def load(self):
+        """Read and decode the whole response."""
+        if self.docs is None:
+            self.docs = list(self._decode())
+        return self
+
+    def _fill(self):
+        data = self.body.read(http.CHUNK_SIZE)
+        self._buf += self._decoder.decode(data, final=not data)
+        return bool(data)
+
+    def _decode(self):
+        while '[' not in self._buf and self._fill():
+            pass
+        match = _FIND_START.match(self._buf)
+        if match is None:
+            # Not in the usual member order, so decode it in one go
+            while self._fill():
+                pass
+            data = json.decode(self._buf)
+            docs = data.pop('docs', [])
+            self.count, self.info, self._buf = len(docs), data, ''
+            for doc in docs:
+                yield Document(doc) if self.lazy else doc
+            return
+
+        pos = match.end()
+        while True:
+            pos = _FIND_SEPARATOR.match(self._buf, pos).end()
+            if pos == len(self._buf):
+                if not self._fill():
+                    raise ValueError('truncated _find response')
+                continue
+            if self._buf[pos] == ']':
+                break
+            end = self._scan(pos)
+            if self.lazy:
+                doc = _lazy_document(self._buf[pos:end])
+            else:
+                doc = json.decode(self._buf[pos:end])
+            self._buf = self._buf[end:]
+            pos = 0
+            self.count += 1
+            yield doc
+
+        while self._fill():
+            pass
+        rest = self._buf[pos + 1:].strip().lstrip(',')
+        self.info, self._buf = json.decode('{' + rest), ''
+
+    def _scan(self, start):
+        """Return the end of the JSON object or array starting at `start`,
+        reading more of the response as needed.
+        """
+        depth, pos = 0, start
+        while True:
+            match = _JSON_STRUCTURE.search(self._buf, pos)
+            if match is not None:
+                char = match.group()
+                if char != '"':
+                    pos = match.end()
+                    depth += 1 if char in '{[' else -1
+                    if depth == 0:
+                        return pos
+                    continue
+                string = _JSON_STRING_REST.match(self._buf, match.end())
+                if string is not None:
+                    pos = string.end()
+                    continue
+                pos = match.start()
+            else:
+                pos = len(self._buf)
+            if not self._fill():
+                raise ValueError('truncated _find response')
+
+
+def _lazy_document(raw):
+    # CouchDB puts the _id and _rev members first, so they are read from the
+    # start of the JSON text without decoding the rest
+    match = _JSON_ID_REV.match(raw)
+    if match is None:
+        return LazyDocument(raw)
+    return LazyDocument(raw, json.decode(match.group(1)), match.group(2))
+
+
 class Document(dict):
     """Representation of a document in the database.
 
@@ -1196,6 +1691,104 @@ class Document(dict):
         return self.get('_rev')
 
 
+def _decoding(method):
+    def wrapper(self, *args, **kwargs):
+        if self._raw is not None:
+            self._decode()
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+class LazyDocument(Document):
+    """Representation of a document that has not been decoded yet.
+
+    The raw JSON content is only decoded when the document content is first
+    accessed, which saves the decoding cost for large documents where only
+    a few fields (or none at all) are needed. The `id` and `rev` properties
+    are available without decoding, as they are known from the request URL
+    and the ``ETag`` response header, or from the start of the JSON text.
+
+    Instances are returned by `Database.get`, `Database.find` and
+    `Database.iterfind` when called with ``lazy=True``. The documents found
+    by a mango query are delimited in the response and each keeps its own
+    part of it.
+    """
+
+    def __init__(self, raw, id=None, rev=None):
+        Document.__init__(self)
+        if id is not None:
+            dict.__setitem__(self, '_id', id)
+        if rev is not None:
+            dict.__setitem__(self, '_rev', rev)
+        self._raw = raw
+
+    def _decode(self):
+        raw, self._raw = self._raw, None
+        if isinstance(raw, util.btype):
+            raw = raw.decode('utf-8')
+        dict.update(self, json.decode(raw))
+
+    @property
+    def decoded(self):
+        """Whether the document content has already been decoded.
+
+        :rtype: `bool`
+        """
+        return self._raw is None
+
+    @property
+    def id(self):
+        """The document ID.
+
+        :rtype: basestring
+        """
+        if self._raw is not None and not dict.__contains__(self, '_id'):
+            self._decode()
+        return dict.get(self, '_id')
+
+    @property
+    def rev(self):
+        """The document revision.
+
+        :rtype: basestring
+        """
+        if self._raw is not None and not dict.__contains__(self, '_rev'):
+            self._decode()
+        return dict.get(self, '_rev')
+
+    def __reduce__(self):
+        # Pickle as a plain document, as unpickling would set the items
+        # before the raw content is restored
+        return Document, (dict(self.items()),)
+
+    __contains__ = _decoding(dict.__contains__)
+    __delitem__ = _decoding(dict.__delitem__)
+    __eq__ = _decoding(dict.__eq__)
+    __getitem__ = _decoding(dict.__getitem__)
+    __iter__ = _decoding(dict.__iter__)
+    __len__ = _decoding(dict.__len__)
+    __ne__ = _decoding(dict.__ne__)
+    __setitem__ = _decoding(dict.__setitem__)
+    clear = _decoding(dict.clear)
+    copy = _decoding(dict.copy)
+    get = _decoding(dict.get)
+    items = _decoding(dict.items)
+    keys = _decoding(dict.keys)
+    pop = _decoding(dict.pop)
+    popitem = _decoding(dict.popitem)
+    setdefault = _decoding(dict.setdefault)
+    update = _decoding(dict.update)
+    values = _decoding(dict.values)
+
+    if sys.version_info[0] < 3:
+        has_key = _decoding(dict.has_key)
+        iteritems = _decoding(dict.iteritems)
+        iterkeys = _decoding(dict.iterkeys)
+        itervalues = _decoding(dict.itervalues)
+
+
 class View(object):
     """Abstract representation of a view or query."""
 
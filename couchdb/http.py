@@ -20,9 +20,9 @@ import sys
 import ssl
 
 try:
-    from threading import Lock
+    from threading import Lock, local
 except ImportError:
-    from dummy_threading import Lock
+    from dummy_threading import Lock, local
 
 try:
     from http.client import BadStatusLine, HTTPConnection, HTTPSConnection
@@ -140,23 +140,27 @@ class ResponseBody(object):
     def __del__(self):
         if not self.chunked:
             self.close()
-        else:
-            self.resp.close()
-            if self.conn:
+        elif self.conn:
+            if self.resp.isclosed():
+                # The terminating zero-length chunk has been read, so the
+                # connection is in a clean state and can be reused.
+                self._release_conn()
+            else:
                 # Since chunked responses can be infinite (i.e. for
                 # feed=continuous), and we want to avoid leaking sockets
                 # (even if just to prevent ResourceWarnings when running
                 # the test suite on Python 3), we'll close this connection
                 # eagerly. We can't get it into the clean state required to
                 # put it back into the ConnectionPool (since we don't know
-                # when it ends and we can only do blocking reads). Finding
-                # out whether it might in fact end would be relatively onerous
-                # and require a layering violation.
-                self.conn.close()
+                # when it ends and we can only do blocking reads).
+                self.resp.close()
+                self._discard_conn()
+        else:
+            self.resp.close()
 
     def read(self, size=None):
         bytes = self.resp.read(size)
-        if size is None or len(bytes) < size:
+        if size is None or len(bytes) < size or self.resp.isclosed():
             self.close()
         return bytes
 
@@ -164,6 +168,10 @@ class ResponseBody(object):
         self.conn_pool.release(self.url, self.conn)
         self.conn_pool, self.url, self.conn = None, None, None
 
+    def _discard_conn(self):
+        self.conn_pool.discard(self.url, self.conn)
+        self.conn_pool, self.url, self.conn = None, None, None
+
     def close(self):
         while not self.resp.isclosed():
             chunk = self.resp.read(CHUNK_SIZE)
@@ -184,7 +192,8 @@ class ResponseBody(object):
             if not chunksz:
                 self.resp.fp.read(2) #crlf
                 self.resp.close()
-                self._release_conn()
+                if self.conn:
+                    self._release_conn()
                 break
 
             chunk = self.resp.fp.read(chunksz)
@@ -213,14 +222,19 @@ RETRYABLE_ERRORS = frozenset([
 class Session(object):
 
     def __init__(self, cache=None, timeout=None, max_redirects=5,
-                 retry_delays=[0], retryable_errors=RETRYABLE_ERRORS):
+                 retry_delays=[0], retryable_errors=RETRYABLE_ERRORS,
+                 thread_affinity=False):
         """Initialize an HTTP client session.
 
+        A session can be shared by multiple threads.
+
         :param cache: an instance with a dict-like interface or None to allow
                       Session to create a dict for caching.
         :param timeout: socket timeout in number of seconds, or `None` for no
                         timeout (the default)
         :param retry_delays: list of request retry delays.
+        :param thread_affinity: whether idle connections should be kept per
+                                thread, see `ConnectionPool`
         """
         from couchdb import __version__ as VERSION
         self.user_agent = 'CouchDB-Python/%s' % VERSION
@@ -241,9 +255,11 @@ class Session(object):
 
         self._disable_ssl_verification = False
         self._timeout = timeout
+        self._thread_affinity = thread_affinity
         self.connection_pool = ConnectionPool(
             self._timeout,
-            disable_ssl_verification=self._disable_ssl_verification)
+            disable_ssl_verification=self._disable_ssl_verification,
+            thread_affinity=self._thread_affinity)
 
         self.retry_delays = list(retry_delays) # We don't want this changing on us.
         self.retryable_errors = set(retryable_errors)
@@ -254,12 +270,26 @@ class Session(object):
         of Python don't verify SSL certs."""
         self._disable_ssl_verification = True
         self.connection_pool = ConnectionPool(self._timeout,
-            disable_ssl_verification=self._disable_ssl_verification)
+            disable_ssl_verification=self._disable_ssl_verification,
+            thread_affinity=self._thread_affinity)
+
+    def prewarm(self, urls, count=1):
+        """Open connections ahead of time, so that the first requests to the
+        given servers don't have to wait for TCP and TLS handshakes.
+
+        :param urls: a sequence of URLs, one for every server to connect to
+        :param count: the number of idle connections to keep open per server
+        :return: the number of connections that were opened
+        """
+        opened = 0
+        for url in urls:
+            url = extract_credentials(url)[0]
+            opened += self.connection_pool.prewarm(url, count)
+        return opened
 
     def request(self, method, url, body=None, headers=None, credentials=None,
                 num_redirects=0):
-        if url in self.perm_redirects:
-            url = self.perm_redirects[url]
+        url = self.perm_redirects.get(url, url)
         method = method.upper()
 
         if headers is None:
@@ -291,7 +321,7 @@ class Session(object):
         if authorization:
             headers['Authorization'] = authorization
 
-        path_query = util.urlunsplit(('', '') + util.urlsplit(url)[2:4] + ('',))
+        path_query = split_url(url)[1]
         conn = self.connection_pool.get(url)
 
         def _try_request_with_retries(retries):
@@ -442,26 +472,40 @@ def cache_sort(i):
     return datetime.fromtimestamp(time.mktime(parsedate(i[1][1]['Date'])))
 
 class Cache(object):
-    """Content cache."""
+    """Content cache.
+
+    The cache can be used from multiple threads: updates are serialized by a
+    lock, and lookups never see a partially cleaned cache.
+    """
 
     # Some random values to limit memory use
     keep_size, max_size = 10, 75
 
     def __init__(self):
         self.by_url = {}
+        self.lock = Lock()
 
     def get(self, url):
         return self.by_url.get(url)
 
     def put(self, url, response):
-        self.by_url[url] = response
-        if len(self.by_url) > self.max_size:
-            self._clean()
+        self.lock.acquire()
+        try:
+            self.by_url[url] = response
+            if len(self.by_url) > self.max_size:
+                self._clean()
+        finally:
+            self.lock.release()
 
     def remove(self, url):
-        self.by_url.pop(url, None)
+        self.lock.acquire()
+        try:
+            self.by_url.pop(url, None)
+        finally:
+            self.lock.release()
 
     def _clean(self):
+        # Must be called with the lock held.
         ls = sorted(self.by_url.items(), key=cache_sort)
         self.by_url = dict(ls[-self.keep_size:])
 
@@ -476,18 +520,99 @@ class InsecureHTTPSConnection(HTTPSConnection):
             HTTPSConnection.__init__(self, *a, **k)
 
 
+class ResumingHTTPSConnection(HTTPSConnection):
+    """HTTPS connection that resumes TLS sessions negotiated by earlier
+    connections to the same host, so that only the first connection has to go
+    through a full handshake.
+
+    The `tls_sessions` argument is a dictionary shared by all connections of a
+    pool, mapping ``(host, port)`` tuples to the most recent `ssl.SSLSession`.
+    """
+
+    def __init__(self, host, tls_sessions, **kwargs):
+        HTTPSConnection.__init__(self, host, **kwargs)
+        self.tls_sessions = tls_sessions
+
+    def connect(self):
+        session = self.tls_sessions.get((self.host, self.port))
+        try:
+            self._connect(session)
+        except ValueError:
+            if session is None:
+                raise
+            # The session belongs to a different SSLContext, so connect
+            # again without resuming it
+            self.close()
+            self._connect(None)
+        self.remember_session()
+
+    def _connect(self, session):
+        HTTPConnection.connect(self)
+        server_hostname = self._tunnel_host or self.host
+        self.sock = self._context.wrap_socket(
+            self.sock, server_hostname=server_hostname, session=session)
+
+    def remember_session(self):
+        # With TLS 1.3 the session ticket only arrives after the handshake,
+        # so this is also called when the connection goes back to the pool.
+        session = getattr(self.sock, 'session', None)
+        if session is not None:
+            self.tls_sessions[self.host, self.port] = session
+
+
+class ThreadConnections(dict):
+    """Idle connections of a single thread, keyed by ``(scheme, host)``.
+
+    The connections are closed when the owning thread exits.
+    """
+
+    def __del__(self):
+        for conns in self.values():
+            for conn in conns:
+                conn.close()
+
+
 class ConnectionPool(object):
-    """HTTP connection pool."""
+    """HTTP connection pool.
+
+    All HTTPS connections of a pool share a single `ssl.SSLContext` and resume
+    previously negotiated TLS sessions where the Python version supports it.
+
+    With `thread_affinity` enabled, released connections are kept in a
+    per-thread pool, so that threads that repeatedly talk to the same server
+    don't contend for the shared pool lock. The shared pool is still used for
+    pre-warmed connections and when a thread has no idle connection of its
+    own. Idle connections of a thread are closed when the thread exits.
+
+    The `reused` and `discarded` counters record how many connections were
+    taken from the pool instead of being newly opened, and how many were
+    closed because they could not be returned to the pool in a clean state.
+    Connections reused from a per-thread pool are counted without locking, so
+    the `reused` counter is approximate with `thread_affinity`.
+    """
 
-    def __init__(self, timeout, disable_ssl_verification=False):
+    def __init__(self, timeout, disable_ssl_verification=False,
+                 thread_affinity=False):
         self.timeout = timeout
         self.disable_ssl_verification = disable_ssl_verification
+        self.thread_affinity = thread_affinity
+        self._ssl_context = None
+        self.tls_sessions = {} # most recent TLS sessions by (host, port)
         self.conns = {} # HTTP connections keyed by (scheme, host)
+        self.local = local() # per-thread connections, see thread_affinity
         self.lock = Lock()
+        self.reused = self.discarded = 0
 
     def get(self, url):
 
-        scheme, host = util.urlsplit(url, 'http', False)[:2]
+        scheme, host = split_url(url)[0]
+
+        # Try to reuse a connection previously released by this thread.
+        if self.thread_affinity:
+            conns = getattr(self.local, 'conns', {}).get((scheme, host))
+            if conns:
+                self.reused += 1
+                return conns.pop(-1)
 
         # Try to reuse an existing connection.
         self.lock.acquire()
@@ -495,6 +620,7 @@ class ConnectionPool(object):
             conns = self.conns.setdefault((scheme, host), [])
             if conns:
                 conn = conns.pop(-1)
+                self.reused += 1
             else:
                 conn = None
         finally:
@@ -502,28 +628,95 @@ class ConnectionPool(object):
 
         # Create a new connection if nothing was available.
         if conn is None:
-            if scheme == 'http':
-                cls = HTTPConnection
-            elif scheme == 'https':
-                if self.disable_ssl_verification:
-                    cls = InsecureHTTPSConnection
-                else:
-                    cls = HTTPSConnection
-            else:
-                raise ValueError('%s is not a supported scheme' % scheme)
-            conn = cls(host, timeout=self.timeout)
-            conn.connect()
+            conn = self._connect(scheme, host)
 
         return conn
 
+    @property
+    def ssl_context(self):
+        """The `ssl.SSLContext` shared by all HTTPS connections of the pool,
+        or `None` if TLS sessions cannot be resumed (Python < 3.6).
+
+        The context is only created when it is first needed, since loading the
+        trusted CA certificates is relatively expensive.
+        """
+        if self._ssl_context is None and hasattr(ssl, 'SSLSession'):
+            self.lock.acquire()
+            try:
+                if self._ssl_context is None:
+                    if self.disable_ssl_verification:
+                        context = ssl._create_unverified_context()
+                    else:
+                        context = ssl.create_default_context()
+                    self._ssl_context = context
+            finally:
+                self.lock.release()
+        return self._ssl_context
+
+    def prewarm(self, url, count):
+        """Open connections to the host of the given URL until at least
+        `count` idle connections are available in the pool.
+
+        :param url: a URL on the host to connect to
+        :param count: the number of idle connections to keep available
+        :return: the number of connections that were opened
+        """
+        scheme, host = split_url(url)[0]
+        self.lock.acquire()
+        try:
+            missing = count - len(self.conns.get((scheme, host), ()))
+        finally:
+            self.lock.release()
+        conns = [self._connect(scheme, host) for i in range(missing)]
+        self.lock.acquire()
+        try:
+            self.conns.setdefault((scheme, host), []).extend(conns)
+        finally:
+            self.lock.release()
+        return len(conns)
+
+    def _connect(self, scheme, host):
+        if scheme == 'http':
+            conn = HTTPConnection(host, timeout=self.timeout)
+        elif scheme == 'https':
+            context = self.ssl_context
+            if context is not None:
+                conn = ResumingHTTPSConnection(host, self.tls_sessions,
+                                               timeout=self.timeout,
+                                               context=context)
+            elif self.disable_ssl_verification:
+                conn = InsecureHTTPSConnection(host, timeout=self.timeout)
+            else:
+                conn = HTTPSConnection(host, timeout=self.timeout)
+        else:
+            raise ValueError('%s is not a supported scheme' % scheme)
+        conn.connect()
+        return conn
+
     def release(self, url, conn):
-        scheme, host = util.urlsplit(url, 'http', False)[:2]
+        scheme, host = split_url(url)[0]
+        if isinstance(conn, ResumingHTTPSConnection):
+            conn.remember_session()
+        if self.thread_affinity:
+            if not hasattr(self.local, 'conns'):
+                self.local.conns = ThreadConnections()
+            self.local.conns.setdefault((scheme, host), []).append(conn)
+            return
         self.lock.acquire()
         try:
             self.conns.setdefault((scheme, host), []).append(conn)
         finally:
             self.lock.release()
 
+    def discard(self, url, conn):
+        """Close a connection that cannot be returned to the pool."""
+        conn.close()
+        self.lock.acquire()
+        try:
+            self.discarded += 1
+        finally:
+            self.lock.release()
+
     def __del__(self):
         for key, conns in list(self.conns.items()):
             for conn in conns:
@@ -635,12 +828,50 @@ def basic_auth(credentials):
         return ('Basic %s' % token.strip().decode('utf-8')).encode('ascii')
 
 
+URL_CACHE_SIZE = 1000
+_split_urls = {}
+
+def split_url(url):
+    """Split a URL into the ``(scheme, host)`` key used by the connection pool
+    and the path and query string to send in the request line.
+
+    The result is needed several times for every request, so it is memoized.
+
+    >>> split_url('http://localhost:5984/db/doc?rev=1-abc#frag')
+    (('http', 'localhost:5984'), '/db/doc?rev=1-abc')
+    >>> split_url('/db/doc')
+    (('http', ''), '/db/doc')
+    """
+    parts = _split_urls.get(url)
+    if parts is None:
+        split = util.urlsplit(url, 'http')
+        parts = (split[:2], util.urlunsplit(('', '') + split[2:4] + ('',)))
+        if len(_split_urls) >= URL_CACHE_SIZE:
+            _split_urls.clear()
+        _split_urls[url] = parts
+    return parts
+
+
 def quote(string, safe=''):
     if isinstance(string, util.utype):
         string = string.encode('utf-8')
     return util.urlquote(string, safe)
 
 
+_quoted_segments = {}
+
+def _quote_segment(segment):
+    # Database names and reserved segments such as _design or _view show up
+    # in nearly every URL, so remember how they were quoted.
+    quoted = _quoted_segments.get(segment)
+    if quoted is None:
+        quoted = quote(segment)
+        if len(_quoted_segments) >= URL_CACHE_SIZE:
+            _quoted_segments.clear()
+        _quoted_segments[segment] = quoted
+    return quoted
+
+
 def urlencode(data):
     if isinstance(data, dict):
         data = data.items()
@@ -686,7 +917,7 @@ def urljoin(base, *path, **query):
     retval = [base]
 
     # build the path
-    path = '/'.join([''] + [quote(s) for s in path])
+    path = '/'.join([''] + [_quote_segment(s) for s in path])
     if path:
         retval.append(path)
 
@@ -59,22 +59,44 @@ True
 """
 
 import copy
+import re
 
 from calendar import timegm
-from datetime import date, datetime, time
+from datetime import date, datetime, time, timedelta
 from decimal import Decimal
 from time import strptime, struct_time
 
 from couchdb.design import ViewDefinition
-from couchdb import util
+from couchdb import http, util
 
 __all__ = ['Mapping', 'Document', 'Field', 'TextField', 'FloatField',
            'IntegerField', 'LongField', 'BooleanField', 'DecimalField',
            'DateField', 'DateTimeField', 'TimeField', 'DictField', 'ListField',
-           'ViewField']
+           'ViewField', 'UPDATE_HANDLER']
 __docformat__ = 'restructuredtext en'
 
 DEFAULT = object()
+MISSING = object()
+
+#: Source of an update handler which applies the changed fields sent by
+#: `Document.store` to the stored document
+UPDATE_HANDLER = """function(doc, req) {
+  if (!doc) {
+    return [null, {code: 404, json: {error: 'not_found', reason: 'missing'}}];
+  }
+  if (req.query.rev && req.query.rev != doc._rev) {
+    return [null, {code: 409, json: {error: 'conflict',
+                                     reason: 'Document update conflict.'}}];
+  }
+  var delta = JSON.parse(req.body);
+  for (var name in delta.set) {
+    doc[name] = delta.set[name];
+  }
+  for (var i = 0; i < delta.unset.length; i++) {
+    delete doc[delta.unset[i]];
+  }
+  return [doc, {json: {ok: true, id: doc._id}}];
+}"""
 
 
 class Field(object):
@@ -82,8 +104,18 @@ class Field(object):
     
     Instances of this class can be added to subclasses of `Document` to describe
     the mapping of a document.
+
+    Field types with expensive conversions set the `cached` class attribute,
+    so that the converted value is remembered per mapping instance for as
+    long as the underlying JSON value stays the same.
+
+    The `_json_types` class attribute lists the types of JSON values a field
+    accepts when a mapping is validated, `None` meaning any value.
     """
 
+    cached = False
+    _json_types = None
+
     def __init__(self, name=None, default=None):
         self.name = name
         self.default = default
@@ -93,18 +125,32 @@ class Field(object):
             return self
         value = instance._data.get(self.name)
         if value is not None:
-            value = self._to_python(value)
-        elif self.default is not None:
-            default = self.default
-            if callable(default):
-                default = default()
-            value = default
-        return value
+            if self.cached:
+                return self._cached_to_python(instance, value)
+            return self._to_python(value)
+        default = self.default
+        if default is not None and callable(default):
+            return default()
+        return default
 
     def __set__(self, instance, value):
         if value is not None:
             value = self._to_json(value)
         instance._data[self.name] = value
+        if self.cached:
+            instance._cache.pop(self.name, None)
+        instance._mark_changed(self.name)
+
+    def _cached_to_python(self, instance, value):
+        # The cache entry remembers the JSON value it was converted from, so
+        # it is ignored once that value is replaced in the instance data.
+        cache = instance._cache
+        cached = cache.get(self.name)
+        if cached is not None and cached[0] is value:
+            return cached[1]
+        converted = self._to_python(value)
+        cache[self.name] = value, converted
+        return converted
 
     def _to_python(self, value):
         return util.utype(value)
@@ -112,6 +158,137 @@ class Field(object):
     def _to_json(self, value):
         return self._to_python(value)
 
+    def _validate(self, value, path):
+        types = self._json_types
+        if types is not None and type(value) not in types:
+            _invalid(self, path, value)
+
+
+def _invalid(field, path, value):
+    raise ValueError('Invalid value for %s %r: %r' % (type(field).__name__,
+                                                      path, value))
+
+
+def _validate_conversion(field, value, path):
+    # `Field._validate` for fields which need to convert the value to know
+    Field._validate(field, value, path)
+    try:
+        field._to_python(value)
+    except (ArithmeticError, TypeError, ValueError):
+        _invalid(field, path, value)
+
+
+def _track(value, owner, name):
+    # Make changes to a nested mapping or list mark the field of the owning
+    # mapping instance as changed. Plain dicts and lists can't report their
+    # changes, so handing one out counts as a change, unless the owner keeps
+    # copies to compare them to (see `Mapping._snapshot`).
+    if isinstance(value, Mapping):
+        value._owner = owner, name
+    elif isinstance(value, ListField.Proxy):
+        value.owner = owner, name
+    elif isinstance(value, (dict, list)):
+        owner._snapshot(name)
+    return value
+
+
+def _overrides(cls, name, *bases):
+    for klass in cls.__mro__:
+        if klass in bases:
+            return False
+        if name in vars(klass):
+            return True
+    return False
+
+
+def _lookup(cls, name):
+    for klass in cls.__mro__:
+        if name in vars(klass):
+            return vars(klass)[name]
+
+
+def _compile_init_data(cls):
+    """Generate the function that fills in the data of a new mapping instance
+    from the keyword arguments passed to the constructor.
+
+    The generated code is equivalent to setting every field through its
+    descriptor, but avoids the descriptor protocol and the lookup of the
+    field defaults for fields that don't customize `Field.__get__` or
+    `Field.__set__`.
+    """
+    lines = ['def _init_data(self, values):',
+             '    self._data = data = {}',
+             '    pop = values.pop']
+    namespace = {'MISSING': MISSING}
+    for idx, (attrname, field) in enumerate(cls._fields.items()):
+        if _lookup(cls, attrname) is not field \
+                or _overrides(type(field), '__get__', Field) \
+                or _overrides(type(field), '__set__', Field):
+            lines.extend([
+                '    if %r in values:' % attrname,
+                '        setattr(self, %r, pop(%r))' % (attrname, attrname),
+                '    else:',
+                '        setattr(self, %r, getattr(self, %r))' % (attrname,
+                                                                  attrname),
+            ])
+            continue
+        namespace['to_json_%d' % idx] = field._to_json
+        namespace['default_%d' % idx] = field.default
+        lines.append('    value = pop(%r, MISSING)' % attrname)
+        if field.default is None:
+            lines.extend([
+                '    if value is MISSING:',
+                '        data[%r] = None' % field.name,
+                '    else:',
+                '        data[%r] = None if value is None else '
+                'to_json_%d(value)' % (field.name, idx),
+            ])
+        else:
+            if callable(field.default):
+                lines.append('    if value is MISSING: value = default_%d()'
+                             % idx)
+            else:
+                lines.append('    if value is MISSING: value = default_%d'
+                             % idx)
+            lines.append('    data[%r] = None if value is None else '
+                         'to_json_%d(value)' % (field.name, idx))
+    util.pyexec('\n'.join(lines), namespace, namespace)
+    return namespace['_init_data']
+
+
+def _compile_validate_data(cls):
+    """Generate the function that validates the JSON data of a mapping
+    instance, raising a `ValueError` for the first invalid field value.
+
+    Fields that only check the type of their value are checked inline, the
+    others (such as nested mappings and lists) through `Field._validate`.
+    Missing and `None` values are always valid.
+    """
+    lines = ['def _validate_data(data, path):',
+             '    get = data.get']
+    namespace = {'invalid': _invalid}
+    for idx, field in enumerate(cls._fields.values()):
+        if _overrides(type(field), '_validate', Field):
+            namespace['validate_%d' % idx] = field._validate
+            lines.extend([
+                '    value = get(%r)' % field.name,
+                '    if value is not None:',
+                '        validate_%d(value, path + %r)' % (idx, field.name),
+            ])
+        elif field._json_types is not None:
+            namespace['field_%d' % idx] = field
+            namespace['types_%d' % idx] = field._json_types
+            lines.extend([
+                '    value = get(%r)' % field.name,
+                '    if value is not None and type(value) not in types_%d:'
+                % idx,
+                '        invalid(field_%d, path + %r, value)' % (idx,
+                                                                 field.name),
+            ])
+    lines.append('    pass')
+    util.pyexec('\n'.join(lines), namespace, namespace)
+    return namespace['_validate_data']
+
 
 class MappingMeta(type):
 
@@ -126,20 +303,65 @@ class MappingMeta(type):
                     attrval.name = attrname
                 fields[attrname] = attrval
         d['_fields'] = fields
-        return type.__new__(cls, name, bases, d)
+        cls = type.__new__(cls, name, bases, d)
+        cls._init_data = _compile_init_data(cls)
+        cls._validate_data = staticmethod(_compile_validate_data(cls))
+        return cls
 
-MappingMetaClass = MappingMeta('MappingMetaClass', (object,), {})
+MappingMetaClass = MappingMeta('MappingMetaClass', (object,), {'__slots__': ()})
 
 
 class Mapping(MappingMetaClass):
+    """Base class for mapping JSON objects to Python objects.
+
+    Subclasses that declare an empty ``__slots__`` tuple get instances without
+    a ``__dict__``, which makes them smaller and their creation faster. Note
+    that such instances can't be given any additional attributes.
+
+    Changes made through the fields, including changes to nested mappings
+    and lists, are tracked in `dirty_fields`:
+
+    >>> class Post(Document):
+    ...     title = TextField()
+    ...     tags = ListField(TextField())
+    >>> post = Post.wrap({'title': 'Foo', 'tags': []})
+    >>> sorted(post.dirty_fields)
+    []
+    >>> post.title = 'Bar'
+    >>> post.tags.append('foo')
+    >>> sorted(post.dirty_fields)
+    ['tags', 'title']
+
+    Changes made to the data returned by `unwrap` are not tracked.
+    """
+
+    __slots__ = ('_data', '_converted', '_changed', '_snapshots', '_owner',
+                 '__weakref__')
 
     def __init__(self, **values):
-        self._data = {}
-        for attrname, field in self._fields.items():
-            if attrname in values:
-                setattr(self, attrname, values.pop(attrname))
-            else:
-                setattr(self, attrname, getattr(self, attrname))
+        self._init_data(values)
+
+    @property
+    def _cache(self):
+        # Converted field values, see `Field.cached`
+        try:
+            return self._converted
+        except AttributeError:
+            self._converted = {}
+            return self._converted
+
+    def __getstate__(self):
+        state = dict(getattr(self, '__dict__', ()))
+        state['_data'] = self._data
+        for name in ('_changed', '_snapshots'):
+            value = getattr(self, name, None)
+            if value is not None:
+                state[name] = value
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            object.__setattr__(self, name, value)
 
     def __iter__(self):
         return iter(self._data)
@@ -149,22 +371,109 @@ class Mapping(MappingMetaClass):
 
     def __delitem__(self, name):
         del self._data[name]
+        self._mark_changed(name)
 
     def __getitem__(self, name):
-        return self._data[name]
+        return _track(self._data[name], self, name)
 
     def __setitem__(self, name, value):
         self._data[name] = value
+        self._mark_changed(name)
 
     def get(self, name, default=None):
-        return self._data.get(name, default)
+        return _track(self._data.get(name, default), self, name)
 
     def setdefault(self, name, default):
-        return self._data.setdefault(name, default)
+        if name not in self._data:
+            self._mark_changed(name)
+        return _track(self._data.setdefault(name, default), self, name)
+
+    @property
+    def dirty_fields(self):
+        """The names of the JSON properties changed since the data was wrapped
+        or last stored.
+
+        :rtype: ``frozenset``
+        """
+        changed = set(getattr(self, '_changed', None) or ())
+        data = self._data
+        for name, value in (getattr(self, '_snapshots', None) or {}).items():
+            if data.get(name) != value:
+                changed.add(name)
+        return frozenset(changed)
+
+    def _reset_changes(self, snapshots=False):
+        # Take the current data as unchanged. With `snapshots`, copies of the
+        # plain dicts and lists handed out are kept from now on, so that they
+        # are only reported as changed if they differ; the copies are renewed
+        # as they may still be changed through references held by the caller
+        data = self._data
+        current = getattr(self, '_snapshots', None)
+        if current is None and snapshots:
+            current = self._snapshots = {}
+            names = [name for name in getattr(self, '_changed', None) or ()
+                     if isinstance(data.get(name), (dict, list))]
+        else:
+            names = list(current or ())
+        for name in names:
+            current[name] = copy.deepcopy(data.get(name))
+        self._changed = None
+
+    def _snapshot(self, name):
+        # A plain dict or list is handed out for the given property
+        snapshots = getattr(self, '_snapshots', None)
+        if snapshots is None:
+            self._mark_changed(name)
+            return
+        if name not in snapshots:
+            snapshots[name] = copy.deepcopy(self._data.get(name))
+        owner = getattr(self, '_owner', None)
+        if owner is not None:
+            owner[0]._snapshot(owner[1])
+
+    def _mark_changed(self, name):
+        changed = getattr(self, '_changed', None)
+        if changed is None:
+            self._changed = set([name])
+        else:
+            changed.add(name)
+        owner = getattr(self, '_owner', None)
+        if owner is not None:
+            owner[0]._mark_changed(owner[1])
 
     def unwrap(self):
         return self._data
 
+    def validate(self):
+        """Check that the values of all fields, including those of nested
+        mappings and lists, are valid JSON data for the field types.
+
+        >>> class Post(Document):
+        ...     title = TextField()
+        ...     tags = ListField(TextField())
+        >>> Post.wrap({'title': 'Foo', 'tags': ['foo']}).validate()
+        >>> Post.wrap({'title': 'Foo', 'tags': ['foo', 42]}).validate()
+        Traceback (most recent call last):
+          ...
+        ValueError: Invalid value for TextField 'tags[1]': 42
+
+        Missing and `None` values are considered valid.
+
+        :raise ValueError: if a field value is not valid
+        """
+        self._validate_data(self._data, '')
+
+    @staticmethod
+    def validate_many(instances):
+        """Validate every mapping instance in the given sequence, like
+        `validate` does for a single one.
+
+        :param instances: an iterable of mapping instances
+        :raise ValueError: for the first field value found not to be valid
+        """
+        for instance in instances:
+            instance._validate_data(instance._data, '')
+
     @classmethod
     def build(cls, **d):
         fields = {}
@@ -175,12 +484,63 @@ class Mapping(MappingMetaClass):
         d['_fields'] = fields
         return type('AnonymousStruct', (cls,), d)
 
+    @classmethod
+    def _has_custom_init(cls):
+        custom_init = cls.__dict__.get('_custom_init')
+        if custom_init is None:
+            custom_init = _overrides(cls, '__init__', Mapping, Document)
+            cls._custom_init = custom_init
+        return custom_init
+
     @classmethod
     def wrap(cls, data):
-        instance = cls()
+        if cls._has_custom_init():
+            # Only a custom constructor needs to run, as the data of the
+            # instance is replaced anyway
+            instance = cls()
+            instance._changed = instance._snapshots = None
+        else:
+            instance = cls.__new__(cls)
         instance._data = data
         return instance
 
+    @classmethod
+    def wrap_many(cls, data):
+        """Wrap every JSON object in the given sequence, like `wrap` does for
+        a single one.
+
+        >>> class Post(Document):
+        ...     title = TextField()
+        >>> posts = Post.wrap_many([{'title': 'Foo'}, {'title': 'Bar'}])
+        >>> [post.title for post in posts]
+        [u'Foo', u'Bar']
+
+        :param data: an iterable of JSON objects
+        :return: a list of instances of this mapping
+        :rtype: ``list``
+        """
+        if cls._has_custom_init():
+            return [cls.wrap(item) for item in data]
+        new = cls.__new__
+        instances = []
+        append = instances.append
+        for item in data:
+            instance = new(cls)
+            instance._data = item
+            append(instance)
+        return instances
+
+    @staticmethod
+    def unwrap_many(instances):
+        """Return the JSON objects of the given mapping instances, like
+        `unwrap` does for a single one.
+
+        :param instances: an iterable of mapping instances
+        :return: a list of JSON objects
+        :rtype: ``list``
+        """
+        return [instance._data for instance in instances]
+
     def _to_python(self, value):
         return self.wrap(value)
 
@@ -294,16 +654,25 @@ class DocumentMeta(MappingMeta):
                     attrval.name = attrname
         return MappingMeta.__new__(cls, name, bases, d)
 
-DocumentMetaClass = DocumentMeta('DocumentMetaClass', (object,), {})
+DocumentMetaClass = DocumentMeta('DocumentMetaClass', (object,),
+                                 {'__slots__': ()})
 
 
 class Document(DocumentMetaClass, Mapping):
 
+    __slots__ = ('_partial',)
+
     def __init__(self, id=None, **values):
         Mapping.__init__(self, **values)
         if id is not None:
             self.id = id
 
+    def __getstate__(self):
+        state = Mapping.__getstate__(self)
+        if getattr(self, '_partial', False):
+            state['_partial'] = True
+        return state
+
     def __repr__(self):
         return '<%s %r@%r %r>' % (type(self).__name__, self.id, self.rev,
                                   dict([(k, v) for k, v in self._data.items()
@@ -356,24 +725,172 @@ class Document(DocumentMetaClass, Mapping):
         return retval
 
     @classmethod
-    def load(cls, db, id):
+    def load(cls, db, id, fields_only=False):
         """Load a specific document from the given database.
+
+        With `fields_only`, only the properties of the document that are
+        mapped by fields of this class are retrieved, using a Mango query
+        (CouchDB 2.0 or later). This saves bandwidth when reading, but
+        storing such a partial document with `store` retrieves and saves the
+        full document, unless an update handler is given to send only the
+        changed fields to.
         
         :param db: the `Database` object to retrieve the document from
         :param id: the document ID
+        :param fields_only: whether to retrieve only the mapped properties
         :return: the `Document` instance, or `None` if no document with the
                  given ID was found
         """
+        if fields_only:
+            docs = cls.find(db, {'_id': id}, limit=1)
+            return docs[0] if docs else None
         doc = db.get(id)
         if doc is None:
             return None
         return cls.wrap(doc)
 
-    def store(self, db):
-        """Store the document in the given database."""
-        db.save(self._data)
+    @classmethod
+    def find(cls, db, selector, fields_only=True, **options):
+        """Find the documents matching a Mango selector and map them to
+        objects of this mapping.
+
+        By default only the properties mapped by fields of this class are
+        retrieved. Storing such partial documents retrieves and saves the
+        full documents unless an update handler is used; see `load`.
+
+        Note: only available for CouchDB version >= 2.0.0
+
+        :param db: the `Database` object to query
+        :param selector: the Mango selector for the documents
+        :param fields_only: whether to retrieve only the mapped properties
+        :param options: additional members of the Mango query, such as
+                        ``sort``, ``limit`` or ``use_index``
+        :return: the matching documents as a list of instances of this class
+        :rtype: ``list``
+        """
+        query = dict(options, selector=selector)
+        if fields_only:
+            query['fields'] = cls._projection()
+            wrapper = cls._wrap_partial
+        else:
+            wrapper = cls.wrap
+        return list(db.find(query, wrapper=wrapper))
+
+    @classmethod
+    def _projection(cls):
+        projection = cls.__dict__.get('_projection_fields')
+        if projection is None:
+            names = set(field.name for field in cls._fields.values())
+            projection = ['_id', '_rev'] + sorted(names - set(['_id', '_rev']))
+            cls._projection_fields = projection
+        return projection
+
+    @classmethod
+    def _wrap_partial(cls, data):
+        instance = cls.wrap(data)
+        instance._partial = True
+        return instance
+
+    def store(self, db, handler=None, skip_unchanged=False):
+        """Store the document in the given database.
+
+        With `skip_unchanged`, documents that have been stored or loaded
+        before are only sent to the server if `dirty_fields` lists any
+        changes since. Only use it if the document isn't changed through the
+        data returned by `unwrap`, as such changes are not tracked.
+
+        Plain dicts and lists, such as those of a `DictField` without a
+        mapping, count as changed once they are read. After storing with
+        `skip_unchanged` or a handler, the document keeps copies of them to
+        compare to instead, which costs a copy of every such value read.
+
+        By default the whole document is saved. Given the name of an update
+        handler, in the format ``designdoc/updatename``, only the changed
+        fields are sent to it instead, which pays off for large documents.
+        The handler has to apply the changes as `UPDATE_HANDLER` does; the
+        full document is still saved when it is new.
+
+        Without a handler, a document loaded with only its mapped fields (see
+        `load`) is stored by retrieving the full document, replacing the
+        loaded properties, and saving it.
+
+        :param db: the `Database` object to store the document in
+        :param handler: the name of an update handler to send the changed
+                        fields to
+        :param skip_unchanged: whether to skip storing documents without
+                               changes
+        :return: this document
+        """
+        if self.rev is None:
+            db.save(self._data)
+        elif skip_unchanged and not self.dirty_fields:
+            return self
+        elif handler is not None:
+            headers, body = db.update_doc(handler, self.id, body=self._delta(),
+                                          rev=self.rev)
+            body.read()
+            self._data['_rev'] = headers['X-Couch-Update-NewRev']
+        elif getattr(self, '_partial', False):
+            # Apply the loaded properties to the full document, so that the
+            # properties which weren't loaded are kept
+            doc = db[self.id]
+            if doc.rev != self.rev:
+                raise http.ResourceConflict(('conflict',
+                                             'Document update conflict.'))
+            doc.update(self._data)
+            for name in self._delta()['unset']:
+                doc.pop(name, None)
+            db.save(doc)
+            self._data['_rev'] = doc.rev
+        else:
+            db.save(self._data)
+        self._reset_changes(skip_unchanged or handler is not None)
         return self
 
+    def _delta(self):
+        data = self._data
+        delta = {'set': {}, 'unset': []}
+        for name in self.dirty_fields:
+            if name in data:
+                delta['set'][name] = data[name]
+            else:
+                delta['unset'].append(name)
+        return delta
+
+    @classmethod
+    def store_many(cls, db, docs, batch_size=None, **options):
+        """Store the given documents in the given database using bulk
+        requests.
+
+        The IDs and revisions of the documents stored successfully are
+        updated in place, as with `client.Database.update`, which also
+        describes the result tuples and the supported options.
+
+        :param db: the `Database` object to store the documents in
+        :param docs: an iterable of `Document` instances
+        :param batch_size: the maximum number of documents to send per
+                           request, or `None` to send them all at once
+        :return: a list with a ``(success, docid, rev_or_exc)`` tuple for
+                 every document
+        :rtype: ``list``
+        """
+        docs = list(docs)
+        if any(getattr(doc, '_partial', False) for doc in docs):
+            raise ValueError('Partially loaded documents need to be stored '
+                             'one at a time')
+        data = cls.unwrap_many(docs)
+        if not batch_size:
+            results = db.update(data, **options)
+        else:
+            results = []
+            for start in range(0, len(data), batch_size):
+                results.extend(db.update(data[start:start + batch_size],
+                                         **options))
+        for doc, (success, _, _) in zip(docs, results):
+            if success:
+                doc._reset_changes()
+        return results
+
     @classmethod
     def query(cls, db, map_fun, reduce_fun, language='javascript', **options):
         """Execute a CouchDB temporary view and map the result values back to
@@ -413,32 +930,41 @@ class Document(DocumentMetaClass, Mapping):
 
 class TextField(Field):
     """Mapping field for string values."""
+    _json_types = util.strbase
     _to_python = util.utype
 
 
 class FloatField(Field):
     """Mapping field for float values."""
+    _json_types = (float, int, util.ltype)
     _to_python = float
 
 
 class IntegerField(Field):
     """Mapping field for integer values."""
+    _json_types = (int, util.ltype)
     _to_python = int
 
 
 class LongField(Field):
     """Mapping field for long integer values."""
+    _json_types = (int, util.ltype)
     _to_python = util.ltype
 
 
 class BooleanField(Field):
     """Mapping field for boolean values."""
+    _json_types = (bool,)
     _to_python = bool
 
 
 class DecimalField(Field):
     """Mapping field for decimal values."""
 
+    cached = True
+    _json_types = util.strbase + (float, int, util.ltype)
+    _validate = _validate_conversion
+
     def _to_python(self, value):
         return Decimal(value)
 
@@ -446,6 +972,74 @@ class DecimalField(Field):
         return util.utype(value)
 
 
+_DATE_RE = re.compile(r'([0-9]{4})-([0-9]{2})-([0-9]{2})$')
+_TIME_RE = re.compile(r'([0-9]{2}):([0-9]{2}):([0-9]{2})(?:\.[0-9]+)?'
+                      r'(Z|[+-][0-9]{2}:?[0-9]{2})?$')
+_DATETIME_RE = re.compile(r'([0-9]{4})-([0-9]{2})-([0-9]{2})T'
+                          r'([0-9]{2}):([0-9]{2}):([0-9]{2})(?:\.([0-9]+))?'
+                          r'(Z|[+-][0-9]{2}:?[0-9]{2})?$')
+_EPOCH = date(1970, 1, 1)
+_fromisoformat = getattr(datetime, 'fromisoformat', None) # Python >= 3.7
+
+
+def _utcoffset(offset):
+    """Return the ``timedelta`` of a ``[+-]HH[:]MM`` suffix, or `None` for
+    ``Z`` and a missing suffix."""
+    if offset is None or offset == 'Z':
+        return None
+    delta = timedelta(hours=int(offset[1:3]), minutes=int(offset[-2:]))
+    return -delta if offset[0] == '-' else delta
+
+
+def _naive_utc(value):
+    """Convert an aware `datetime` to a naive one in UTC."""
+    offset = value.utcoffset()
+    if offset is None:
+        return value
+    return (value - offset).replace(tzinfo=None)
+
+
+def _parse_date(value):
+    match = _DATE_RE.match(value)
+    if match is None:
+        return date(*strptime(value, '%Y-%m-%d')[:3])
+    year, month, day = match.groups()
+    return date(int(year), int(month), int(day))
+
+
+def _parse_datetime(value):
+    match = _DATETIME_RE.match(value)
+    if match is None:
+        # Let strptime deal with layouts such as single-digit fields
+        value = value.rstrip('Z')
+        if '.' in value:
+            return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f')
+        return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+    if _fromisoformat is not None:
+        try:
+            return _naive_utc(_fromisoformat(value.rstrip('Z')))
+        except ValueError: # fraction or offset layout this Python rejects
+            pass
+    year, month, day, hour, minute, second, fraction, offset = match.groups()
+    value = datetime(int(year), int(month), int(day), int(hour), int(minute),
+                     int(second), int(fraction[:6].ljust(6, '0'))
+                                  if fraction else 0)
+    offset = _utcoffset(offset)
+    return value if offset is None else value - offset
+
+
+def _parse_time(value):
+    match = _TIME_RE.match(value)
+    if match is None:
+        return time(*strptime(value.split('.', 1)[0], '%H:%M:%S')[3:6])
+    hour, minute, second, offset = match.groups()
+    value = time(int(hour), int(minute), int(second))
+    offset = _utcoffset(offset)
+    if offset is None:
+        return value
+    return (datetime.combine(_EPOCH, value) - offset).time()
+
+
 class DateField(Field):
     """Mapping field for storing dates.
     
@@ -458,10 +1052,14 @@ class DateField(Field):
     '2007-04-01'
     """
 
+    cached = True
+    _json_types = util.strbase
+    _validate = _validate_conversion
+
     def _to_python(self, value):
         if isinstance(value, util.strbase):
             try:
-                value = date(*strptime(value, '%Y-%m-%d')[:3])
+                value = _parse_date(value)
             except ValueError:
                 raise ValueError('Invalid ISO date %r' % value)
         return value
@@ -480,6 +1078,11 @@ class DateTimeField(Field):
     datetime.datetime(2007, 4, 1, 15, 30)
     >>> field._to_python('2007-04-01T15:30:00.009876Z')
     datetime.datetime(2007, 4, 1, 15, 30, 0, 9876)
+
+    Values with a UTC offset are converted to naive UTC date/times:
+
+    >>> field._to_python('2007-04-01T17:30:00+02:00')
+    datetime.datetime(2007, 4, 1, 15, 30)
     >>> field._to_json(datetime(2007, 4, 1, 15, 30, 0))
     '2007-04-01T15:30:00Z'
     >>> field._to_json(datetime(2007, 4, 1, 15, 30, 0, 9876))
@@ -488,18 +1091,14 @@ class DateTimeField(Field):
     '2007-04-01T00:00:00Z'
     """
 
+    cached = True
+    _json_types = util.strbase
+    _validate = _validate_conversion
+
     def _to_python(self, value):
         if isinstance(value, util.strbase):
             try:
-                split_value = value.split('.') # strip out microseconds
-                if len(split_value) == 1:   # No microseconds provided
-                    value = split_value[0]
-                    value = value.rstrip('Z')  #remove timezone separator
-                    value = datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
-                else:
-                    value = value.rstrip('Z')
-                    value = datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f')
-
+                value = _parse_datetime(value)
             except ValueError:
                 raise ValueError('Invalid ISO date/time %r' % value)
         return value
@@ -509,6 +1108,8 @@ class DateTimeField(Field):
             value = datetime.utcfromtimestamp(timegm(value))
         elif not isinstance(value, datetime):
             value = datetime.combine(value, time(0))
+        else:
+            value = _naive_utc(value)
         return value.isoformat() + 'Z'
 
 
@@ -518,24 +1119,31 @@ class TimeField(Field):
     >>> field = TimeField()
     >>> field._to_python('15:30:00')
     datetime.time(15, 30)
+    >>> field._to_python('00:30:00+02:00')
+    datetime.time(22, 30)
     >>> field._to_json(time(15, 30))
     '15:30:00'
     >>> field._to_json(datetime(2007, 4, 1, 15, 30))
     '15:30:00'
     """
 
+    cached = True
+    _json_types = util.strbase
+    _validate = _validate_conversion
+
     def _to_python(self, value):
         if isinstance(value, util.strbase):
             try:
-                value = value.split('.', 1)[0] # strip out microseconds
-                value = time(*strptime(value, '%H:%M:%S')[3:6])
+                value = _parse_time(value)
             except ValueError:
                 raise ValueError('Invalid ISO time %r' % value)
         return value
 
     def _to_json(self, value):
         if isinstance(value, datetime):
-            value = value.time()
+            value = _naive_utc(value).time()
+        elif value.tzinfo is not None:
+            value = _naive_utc(datetime.combine(_EPOCH, value)).time()
         return value.replace(microsecond=0).isoformat()
 
 
@@ -573,6 +1181,9 @@ class DictField(Field):
 
     >>> del server['python-tests']
     """
+
+    cached = True
+
     def __init__(self, mapping=None, name=None, default=None):
         default = default or {}
         Field.__init__(self, name=name, default=lambda: default.copy())
@@ -584,6 +1195,10 @@ class DictField(Field):
         else:
             return self.mapping.wrap(value)
 
+    def _cached_to_python(self, instance, value):
+        value = Field._cached_to_python(self, instance, value)
+        return _track(value, instance, self.name)
+
     def _to_json(self, value):
         if self.mapping is None:
             return value
@@ -591,6 +1206,12 @@ class DictField(Field):
             value = self.mapping(**value)
         return value.unwrap()
 
+    def _validate(self, value, path):
+        if not isinstance(value, dict):
+            _invalid(self, path, value)
+        if self.mapping is not None:
+            self.mapping._validate_data(value, path + '.')
+
 
 class ListField(Field):
     """Field type for sequences of other fields.
@@ -628,6 +1249,8 @@ class ListField(Field):
     >>> del server['python-tests']
     """
 
+    cached = True
+
     def __init__(self, field, name=None, default=None):
         default = default or []
         Field.__init__(self, name=name, default=lambda: copy.copy(default))
@@ -641,16 +1264,40 @@ class ListField(Field):
     def _to_python(self, value):
         return self.Proxy(value, self.field)
 
+    def _cached_to_python(self, instance, value):
+        value = Field._cached_to_python(self, instance, value)
+        return _track(value, instance, self.name)
+
     def _to_json(self, value):
         return [self.field._to_json(item) for item in value]
 
+    def _validate(self, value, path):
+        if not isinstance(value, list):
+            _invalid(self, path, value)
+        field = self.field
+        if _overrides(type(field), '_validate', Field):
+            for idx, item in enumerate(value):
+                if item is not None:
+                    field._validate(item, '%s[%d]' % (path, idx))
+        elif field._json_types is not None:
+            types = field._json_types
+            for idx, item in enumerate(value):
+                if item is not None and type(item) not in types:
+                    _invalid(field, '%s[%d]' % (path, idx), item)
+
 
     class Proxy(list):
 
+        owner = None # (mapping instance, field name) to report changes to
+
         def __init__(self, list, field):
             self.list = list
             self.field = field
 
+        def _mark_changed(self):
+            if self.owner is not None:
+                self.owner[0]._mark_changed(self.owner[1])
+
         def __lt__(self, other):
             return self.list < other
 
@@ -683,26 +1330,33 @@ class ListField(Field):
                 self.__delslice__(index.start, index.stop)
             else:
                 del self.list[index]
+                self._mark_changed()
 
         def __getitem__(self, index):
             if isinstance(index, slice):
                 return self.__getslice__(index.start, index.stop)
-            return self.field._to_python(self.list[index])
+            value = self.field._to_python(self.list[index])
+            if self.owner is not None:
+                _track(value, *self.owner)
+            return value
 
         def __setitem__(self, index, value):
             if isinstance(index, slice):
                 self.__setslice__(index.start, index.stop, value)
             else:
                 self.list[index] = self.field._to_json(value)
+                self._mark_changed()
 
         def __delslice__(self, i, j):
             del self.list[i:j]
+            self._mark_changed()
 
         def __getslice__(self, i, j):
             return ListField.Proxy(self.list[i:j], self.field)
 
         def __setslice__(self, i, j, seq):
             self.list[i:j] = (self.field._to_json(v) for v in seq)
+            self._mark_changed()
 
         def __contains__(self, value):
             for item in self.list:
@@ -729,6 +1383,7 @@ class ListField(Field):
             else:
                 value = kwargs
             self.list.append(self.field._to_json(value))
+            self._mark_changed()
 
         def count(self, value):
             return [i for i in self].count(value)
@@ -749,9 +1404,13 @@ class ListField(Field):
             else:
                 value = kwargs
             self.list.insert(idx, self.field._to_json(value))
+            self._mark_changed()
 
         def remove(self, value):
-            return self.list.remove(self.field._to_json(value))
+            self.list.remove(self.field._to_json(value))
+            self._mark_changed()
 
         def pop(self, *args):
-            return self.field._to_python(self.list.pop(*args))
+            value = self.list.pop(*args)
+            self._mark_changed()
+            return self.field._to_python(value)
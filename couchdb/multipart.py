@@ -9,8 +9,9 @@
 """Support for streamed reading and writing of multipart MIME content."""
 
 from base64 import b64encode
-from cgi import parse_header
 from email import header
+from email.message import Message
+from email.utils import collapse_rfc2231_value
 
 try:
     from hashlib import md5
@@ -21,11 +22,23 @@ import uuid
 
 from couchdb import util
 
-__all__ = ['read_multipart', 'write_multipart']
+__all__ = ['read_multipart', 'iter_multipart', 'write_multipart']
 __docformat__ = 'restructuredtext en'
 
 
 CRLF = b'\r\n'
+BLOCK_SIZE = 64 * 1024
+
+
+def _parse_header(value):
+    # Split a header value such as a content type into the value itself and
+    # a dictionary of its parameters, like the cgi module that Python 3.13
+    # removed did
+    message = Message()
+    message['content-type'] = value or ''
+    params = message.get_params()
+    return params[0][0], dict((name, collapse_rfc2231_value(param))
+                              for name, param in params[1:])
 
 
 def read_multipart(fileobj, boundary=None):
@@ -37,9 +50,9 @@ def read_multipart(fileobj, boundary=None):
     names lower-cased), ``is_multipart`` is a boolean indicating whether the
     part is itself multipart, and ``payload`` is either a string (if
     ``is_multipart`` is false), or an iterator over the nested parts.
-    
-    Note that the iterator produced for nested multipart payloads MUST be fully
-    consumed, even if you wish to skip over the content.
+
+    Use `iter_multipart` to read large payloads without holding them in
+    memory.
     
     :param fileobj: a file-like object
     :param boundary: the part boundary string, will generally be determined
@@ -48,73 +61,230 @@ def read_multipart(fileobj, boundary=None):
     :return: an iterator over the parts
     :since: 0.5
     """
-    headers = {}
-    buf = []
-    outer = in_headers = boundary is None
-
-    next_boundary = boundary and ('--' + boundary + '\n').encode('ascii') or None
-    last_boundary = boundary and ('--' + boundary + '--\n').encode('ascii') or None
-
-    def _current_part():
-        payload = b''.join(buf)
-        if payload.endswith(b'\r\n'):
-            payload = payload[:-2]
-        elif payload.endswith(b'\n'):
-            payload = payload[:-1]
-        content_md5 = headers.get(b'content-md5')
-        if content_md5:
-            h = b64encode(md5(payload).digest())
-            if content_md5 != h:
-                raise ValueError('data integrity check failed')
-        return headers, False, payload
-
-    for line in fileobj:
-        if in_headers:
-            line = line.replace(CRLF, b'\n')
-            if line != b'\n':
-                name, value = [item.strip() for item in line.split(b':', 1)]
-                name = name.lower().decode('ascii')
-                value, charset = header.decode_header(value.decode('utf-8'))[0]
-                if charset is None:
-                    headers[name] = value
-                else:
-                    headers[name] = value.decode(charset)
-            else:
-                in_headers = False
-                mimetype, params = parse_header(headers.get('content-type'))
-                if mimetype.startswith('multipart/'):
-                    sub_boundary = params['boundary']
-                    sub_parts = read_multipart(fileobj, boundary=sub_boundary)
-                    if boundary is not None:
-                        yield headers, True, sub_parts
-                        headers.clear()
-                        del buf[:]
-                    else:
-                        for part in sub_parts:
-                            yield part
-                        return
-
-        elif line.replace(CRLF, b'\n') == next_boundary:
-            # We've reached the start of a new part, as indicated by the
-            # boundary
-            if headers:
-                if not outer:
-                    yield _current_part()
-                else:
-                    outer = False
-                headers.clear()
-                del buf[:]
-            in_headers = True
+    return _read_payloads(iter_multipart(fileobj, boundary=boundary))
 
-        elif line.replace(CRLF, b'\n') == last_boundary:
-            # We're done with this multipart envelope
-            break
 
+def _read_payloads(parts):
+    for headers, is_multipart, payload in parts:
+        if is_multipart:
+            yield headers, True, _read_payloads(payload)
         else:
-            buf.append(line)
+            yield headers, False, payload.read()
+
+
+def iter_multipart(fileobj, boundary=None, blocksize=BLOCK_SIZE):
+    r"""Streaming MIME multipart parser for payloads of any size.
+
+    This function works like `read_multipart`, except that the payload of
+    every part that isn't multipart itself is a file-like object with a
+    ``read([size])`` method, which reads the payload from `fileobj` as it
+    is consumed. The file is read in blocks of `blocksize` bytes, so the
+    memory used doesn't depend on the size of the parts.
 
-    if not outer and headers:
-        yield _current_part()
+    >>> from couchdb.util import StringIO
+    >>> text = (b'Content-Type: multipart/mixed; boundary="==1=="\r\n\r\n'
+    ...         b'--==1==\r\nContent-Type: text/plain\r\n\r\n'
+    ...         b'Just testing\r\n--==1==--\r\n')
+    >>> for headers, is_multipart, payload in iter_multipart(StringIO(text)):
+    ...     print(headers['content-type'])
+    ...     print(payload.read(4))
+    ...     print(payload.read())
+    text/plain
+    b'Just'
+    b' testing'
+
+    A payload can only be read until the iterator advances to the next part,
+    which skips whatever remains of it. If the part has a ``Content-MD5``
+    header, a `ValueError` is raised when the end of a payload not matching
+    it is read.
+
+    :param fileobj: a file-like object
+    :param boundary: the part boundary string, will generally be determined
+                     automatically from the headers of the outermost multipart
+                     envelope
+    :param blocksize: the number of bytes to read from `fileobj` at a time
+    :return: an iterator over the parts
+    :since: 1.3
+    """
+    reader = _Reader(fileobj, blocksize)
+    if boundary is None:
+        headers = _read_headers(reader)
+        mimetype, params = _parse_header(headers.get('content-type'))
+        if not mimetype.startswith('multipart/'):
+            return
+        boundary = params['boundary']
+    for part in _iter_parts(reader, boundary.encode('ascii')):
+        yield part
+
+
+def _iter_parts(reader, boundary):
+    delimiter = b'--' + boundary
+    _PartReader(reader, boundary).close() # skip the preamble
+    while True:
+        while len(reader.buf) < len(delimiter) and reader.fill():
+            pass
+        if not reader.buf.startswith(delimiter):
+            return # truncated, there is no further delimiter
+        reader.buf = reader.buf[len(delimiter):]
+        if reader.readline().startswith(b'--'):
+            return # the close delimiter, the parent skips the epilogue
+        headers = _read_headers(reader)
+        mimetype, params = _parse_header(headers.get('content-type', ''))
+        if mimetype.startswith('multipart/'):
+            parts = _iter_parts(reader, params['boundary'].encode('ascii'))
+            yield headers, True, parts
+            for _ in parts:
+                pass
+            _PartReader(reader, boundary).close() # skip the epilogue
+        else:
+            payload = _PartReader(reader, boundary,
+                                  headers.get('content-md5'))
+            yield headers, False, payload
+            payload.close()
+
+
+def _read_headers(reader):
+    headers = {}
+    while True:
+        line = reader.readline()
+        if not line.strip():
+            return headers
+        name, value = [item.strip() for item in line.split(b':', 1)]
+        name = name.lower().decode('ascii')
+        value, charset = header.decode_header(value.decode('utf-8'))[0]
+        if charset is None:
+            headers[name] = value
+        else:
+            headers[name] = value.decode(charset)
+
+
+class _Reader(object):
+    """Buffers the blocks read from a file-like object."""
+
+    def __init__(self, fileobj, blocksize):
+        self.fileobj = fileobj
+        self.blocksize = blocksize
+        self.buf = b''
+        self.eof = False
+
+    def fill(self):
+        if not self.eof:
+            block = self.fileobj.read(self.blocksize)
+            if block:
+                self.buf += block
+                return True
+            self.eof = True
+        return False
+
+    def readline(self):
+        start = 0
+        while True:
+            idx = self.buf.find(b'\n', start)
+            if idx >= 0:
+                line, self.buf = self.buf[:idx + 1], self.buf[idx + 1:]
+                return line
+            start = len(self.buf)
+            if not self.fill():
+                line, self.buf = self.buf, b''
+                return line
+
+
+class _PartReader(object):
+    """File-like object reading the payload of a part, up to the next
+    delimiter line, which is left in the buffer of the reader."""
+
+    def __init__(self, reader, boundary, content_md5=None):
+        self._reader = reader
+        self._delimiter = b'\n--' + boundary
+        self._content_md5 = content_md5
+        self._md5 = md5() if content_md5 else None
+        self._start = True
+        self._done = False
+
+    def _find(self, buf):
+        # Return the end of the payload and the start of the delimiter line
+        # in the buffer, or None if the buffer doesn't contain them (yet)
+        delimiter = self._delimiter
+        if self._start and buf.startswith(delimiter[1:]):
+            if self._at_line_end(buf, len(delimiter) - 1):
+                return 0, 0
+        idx = buf.find(delimiter)
+        while idx >= 0:
+            if self._at_line_end(buf, idx + len(delimiter)):
+                end = idx - 1 if buf[idx - 1:idx] == b'\r' else idx
+                return end, idx + 1
+            idx = buf.find(delimiter, idx + 1)
+        return None
+
+    def _at_line_end(self, buf, pos):
+        # Whether the boundary ending at `pos` isn't just the start of a
+        # longer line, which is only known once two more bytes are read
+        if len(buf) < pos + 2 and not self._reader.eof:
+            return False
+        return buf[pos:pos + 2] == b'--' or buf[pos:pos + 1] in b'\r\n \t'
+
+    def _read_chunk(self, size):
+        if self._done:
+            return b''
+        reader = self._reader
+        while True:
+            buf = reader.buf
+            found = self._find(buf)
+            if found is not None:
+                end, next = found
+                if end > size:
+                    chunk, reader.buf = buf[:size], buf[size:]
+                else:
+                    chunk, reader.buf = buf[:end], buf[next:]
+                    self._done = True
+                break
+            # Keep what may turn out to be the start of the delimiter
+            safe = min(len(buf) - len(self._delimiter) - 3, size)
+            if safe > 0:
+                chunk, reader.buf = buf[:safe], buf[safe:]
+                break
+            if not reader.fill():
+                # No delimiter at all, take the rest as the payload
+                chunk, reader.buf = buf, b''
+                if chunk.endswith(b'\n'):
+                    chunk = chunk[:-2 if chunk.endswith(CRLF) else -1]
+                self._done = True
+                break
+        self._start = False
+        if self._md5 is not None:
+            self._md5.update(chunk)
+            if self._done:
+                digest = b64encode(self._md5.digest()).decode('ascii')
+                if digest != self._content_md5:
+                    raise ValueError('data integrity check failed')
+        return chunk
+
+    def read(self, size=-1):
+        """Read up to `size` bytes of the payload, or all of the rest if
+        `size` is negative or omitted.
+
+        :return: the bytes read, which are empty at the end of the payload
+        """
+        if size is None or size < 0:
+            chunks = []
+            chunk = self._read_chunk(self._reader.blocksize)
+            while chunk:
+                chunks.append(chunk)
+                chunk = self._read_chunk(self._reader.blocksize)
+            return b''.join(chunks)
+        chunks = []
+        while size > 0:
+            chunk = self._read_chunk(size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def close(self):
+        """Skip the rest of the payload."""
+        while self._read_chunk(self._reader.blocksize):
+            pass
 
 
 class MultipartWriter(object):
@@ -138,31 +308,83 @@ class MultipartWriter(object):
         return MultipartWriter(self.fileobj, headers=headers, subtype=subtype,
                                boundary=boundary)
 
-    def add(self, mimetype, content, headers=None):
-        self.fileobj.write(b'--')
-        self.fileobj.write(self.boundary.encode('utf-8'))
-        self.fileobj.write(CRLF)
+    def add(self, mimetype, content, headers=None, length=None):
+        """Add a part to the envelope.
+
+        The content can be a string, a file-like object, or an iterable over
+        byte strings, which are written in blocks as they are read. The
+        ``Content-Length`` and ``Content-MD5`` headers are computed up front
+        for strings and seekable files, which are read twice for that. For
+        other content, the length can be given, and the MD5 digest can only be
+        included by passing it in `headers`.
+
+        :param mimetype: the MIME type of the part
+        :param content: the content of the part
+        :param headers: a dictionary of additional headers for the part
+        :param length: the length of streamed content, if known
+        """
         if headers is None:
             headers = {}
 
-        ctype, params = parse_header(mimetype)
-        if isinstance(content, util.utype):
+        ctype, params = _parse_header(mimetype)
+        if content is None:
+            content = b''
+        elif isinstance(content, util.utype):
             if 'charset' in params:
                 content = content.encode(params['charset'])
             else:
                 content = content.encode('utf-8')
                 mimetype = mimetype + ';charset=utf-8'
+        elif isinstance(content, memoryview):
+            content = content.tobytes()
+        elif isinstance(content, bytearray):
+            content = bytes(content)
+        elif not isinstance(content, util.btype) and \
+                not hasattr(content, 'read'):
+            try:
+                content = iter(content)
+            except TypeError:
+                raise TypeError('unsupported content type %r' %
+                                type(content).__name__)
 
+        self.fileobj.write(b'--')
+        self.fileobj.write(self.boundary.encode('utf-8'))
+        self.fileobj.write(CRLF)
         headers['Content-Type'] = mimetype
-        if content:
-            headers['Content-Length'] = str(len(content))
-            hash = b64encode(md5(content).digest()).decode('ascii')
-            headers['Content-MD5'] = hash
+        if isinstance(content, util.btype):
+            if content:
+                headers['Content-Length'] = str(len(content))
+                hash = b64encode(md5(content).digest()).decode('ascii')
+                headers['Content-MD5'] = hash
+            self._write_headers(headers)
+            if content:
+                # XXX: throw an exception if a boundary appears in the content??
+                self.fileobj.write(content)
+                self.fileobj.write(CRLF)
+            return
+
+        if hasattr(content, 'read'):
+            pos = _tell(content)
+            if pos is not None:
+                hash = md5()
+                length = 0
+                for block in _read_blocks(content):
+                    hash.update(block)
+                    length += len(block)
+                content.seek(pos)
+                headers['Content-MD5'] = b64encode(hash.digest()).decode('ascii')
+            content = _read_blocks(content)
+        if length is not None:
+            headers['Content-Length'] = str(length)
         self._write_headers(headers)
-        if content:
-            # XXX: throw an exception if a boundary appears in the content??
-            self.fileobj.write(content)
-            self.fileobj.write(CRLF)
+        written = 0
+        for chunk in content:
+            written += len(chunk)
+            self.fileobj.write(chunk)
+        self.fileobj.write(CRLF)
+        if length is not None and written != length:
+            raise ValueError('expected %d bytes of content, got %d' %
+                             (length, written))
 
     def close(self):
         self.fileobj.write(b'--')
@@ -189,6 +411,20 @@ class MultipartWriter(object):
         self.close()
 
 
+def _tell(fileobj):
+    # Return the position in a seekable file, or None
+    try:
+        pos = fileobj.tell()
+        fileobj.seek(pos)
+    except (AttributeError, IOError, ValueError):
+        return None
+    return pos
+
+
+def _read_blocks(fileobj):
+    return iter(lambda: fileobj.read(BLOCK_SIZE), b'')
+
+
 def write_multipart(fileobj, subtype='mixed', boundary=None):
     r"""Simple streaming MIME multipart writer.
 
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2007-2009 Christopher Lenz
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+
+"""Replication of databases done by the client, for when the server can't
+replicate itself, e.g. because neither server can reach the other.
+
+The replicator follows the CouchDB replication protocol: it reads the changes
+feed of the source database, asks the target database which of the changed
+revisions it is missing, fetches these from the source, and writes them to
+the target as they are. The sequence up to which all changes were replicated
+is recorded in a local document of the target database, so that the next
+replication can continue from there.
+"""
+
+from hashlib import md5
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from couchdb import http, json
+
+__all__ = ['Replicator']
+__docformat__ = 'restructuredtext en'
+
+
+class Replicator(object):
+    """Replicates the documents of a database to another one.
+
+    Batches of changes are read from the source while up to `concurrency`
+    earlier batches are being compared with the target, fetched and written,
+    so that the round trips for the different stages overlap.
+
+    >>> from couchdb import Server
+    >>> server = Server()
+    >>> source = server.create('python-tests')
+    >>> target = server.create('python-tests-target')
+    >>> source['johndoe'] = dict(type='Person', name='John Doe')
+    >>> stats = Replicator(source, target).replicate()
+    >>> stats['docs_written']
+    1
+    >>> target['johndoe']['name']
+    'John Doe'
+    >>> Replicator(source, target).replicate()['docs_written']
+    0
+
+    >>> del server['python-tests']
+    >>> del server['python-tests-target']
+
+    :param source: the `Database` to replicate from
+    :param target: the `Database` to replicate to
+    :param batch_size: the number of changes to replicate at a time
+    :param concurrency: the number of batches to process at a time
+    :since: 1.3
+    """
+
+    def __init__(self, source, target, batch_size=100, concurrency=4):
+        self.source = source
+        self.target = target
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        key = '%s\n%s' % (source.resource.url, target.resource.url)
+        self.checkpoint_id = '_local/' + md5(key.encode('utf-8')).hexdigest()
+        self._bulk_get = True
+
+    def replicate(self):
+        """Replicate the changes made to the source database since the last
+        replication.
+
+        :return: a dictionary with the number of ``docs_read`` from the
+                 source, ``docs_written`` to the target and
+                 ``doc_write_failures``, the number of ``missing_revisions``
+                 found, the ``last_seq`` replicated, and the ``elapsed``
+                 seconds
+        :rtype: `dict`
+        """
+        start = time.time()
+        checkpoint = self.target.get(self.checkpoint_id) or \
+                     {'_id': self.checkpoint_id}
+        since = checkpoint.get('last_seq', 0)
+        stats = {'docs_read': 0, 'docs_written': 0, 'doc_write_failures': 0,
+                 'missing_revisions': 0, 'last_seq': since}
+        lock = threading.Lock()
+        batches = queue.Queue(self.concurrency)
+        done = {}
+        errors = []
+        state = {'next': 0}
+
+        def work():
+            while True:
+                item = batches.get()
+                if item is None:
+                    return
+                num, changes, last_seq = item
+                try:
+                    counts = None if errors else self._replicate_batch(changes)
+                except Exception as e:
+                    with lock:
+                        errors.append(e)
+                    continue
+                with lock:
+                    if counts is None or errors:
+                        continue
+                    for name, count in counts.items():
+                        stats[name] += count
+                    done[num] = last_seq
+                    # Only checkpoint once all earlier batches are written
+                    last_seq = None
+                    while state['next'] in done:
+                        last_seq = done.pop(state['next'])
+                        state['next'] += 1
+                    if last_seq is not None:
+                        checkpoint['last_seq'] = stats['last_seq'] = last_seq
+                        self.target.save(checkpoint)
+
+        workers = [threading.Thread(target=work)
+                   for _ in range(max(self.concurrency, 1))]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        try:
+            num = 0
+            while not errors:
+                data = self.source.changes(since=since, style='all_docs',
+                                           limit=self.batch_size)
+                changes = data['results']
+                if changes:
+                    since = data['last_seq']
+                    batches.put((num, changes, since))
+                    num += 1
+                if len(changes) < self.batch_size:
+                    break
+        finally:
+            for worker in workers:
+                batches.put(None)
+            for worker in workers:
+                worker.join()
+        if errors:
+            raise errors[0]
+        stats['elapsed'] = time.time() - start
+        return stats
+
+    def _replicate_batch(self, changes):
+        revs = {}
+        for change in changes:
+            revs[change['id']] = [item['rev'] for item in change['changes']]
+        missing = self.target.revs_diff(revs)
+        requests = []
+        for docid, info in missing.items():
+            for rev in info['missing']:
+                request = {'id': docid, 'rev': rev}
+                if info.get('possible_ancestors'):
+                    request['atts_since'] = info['possible_ancestors']
+                requests.append(request)
+
+        counts = {'docs_read': 0, 'docs_written': 0, 'doc_write_failures': 0,
+                  'missing_revisions': len(requests)}
+        if not requests:
+            return counts
+        docs = self._fetch(requests)
+        counts['docs_read'] = len(docs)
+        failures = [result for result in
+                    self.target.update(docs, new_edits=False)
+                    if not result[0]]
+        counts['docs_written'] = len(docs) - len(failures)
+        counts['doc_write_failures'] = len(failures)
+        return counts
+
+    def _fetch(self, requests):
+        if self._bulk_get:
+            try:
+                results = self.source.bulk_get(requests, revs=True,
+                                               attachments=True)
+            except http.ResourceNotFound:
+                # Servers before CouchDB 2.0 don't support _bulk_get
+                self._bulk_get = False
+            except http.ServerError as e:
+                if e.args[0][0] not in (400, 405):
+                    raise
+                self._bulk_get = False
+            else:
+                return [doc for success, _, doc in results if success]
+
+        docs = []
+        for request in requests:
+            options = {'open_revs': json.encode([request['rev']]),
+                       'revs': True, 'latest': True, 'attachments': True}
+            if 'atts_since' in request:
+                options['atts_since'] = json.encode(request['atts_since'])
+            for item in self.source.get(request['id'], default=[], **options):
+                if 'ok' in item:
+                    docs.append(item['ok'])
+        return docs
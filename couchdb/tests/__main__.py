@@ -10,7 +10,7 @@ import unittest
 
 from couchdb.tests import client, couch_tests, design, couchhttp, \
                           multipart, mapping, view, package, tools, \
-                          loader
+                          loader, cache, replication
 
 
 def suite():
@@ -25,6 +25,8 @@ def suite():
     suite.addTest(package.suite())
     suite.addTest(tools.suite())
     suite.addTest(loader.suite())
+    suite.addTest(cache.suite())
+    suite.addTest(replication.suite())
     return suite
 
 
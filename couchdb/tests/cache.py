@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2007-2009 Christopher Lenz
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+
+import threading
+import time
+import unittest
+
+from couchdb import cache, http
+from couchdb.tests import testutil
+
+
+class ChangesDatabase(object):
+    """Serves the changes feed of documents saved to it, without a server."""
+
+    def __init__(self):
+        self.seq = 0
+        self.changes_by_id = {}
+        self.requests = self.gets = 0
+        self.changed = threading.Condition()
+
+    def save(self, doc, deleted=False):
+        with self.changed:
+            self.seq += 1
+            change = {'seq': self.seq, 'id': doc['_id'], 'doc': doc}
+            if deleted:
+                change['deleted'] = True
+            self.changes_by_id[doc['_id']] = change
+            self.changed.notify_all()
+        return doc['_id'], '%d-abc' % self.seq
+
+    def _since(self, since):
+        return sorted((change for change in self.changes_by_id.values()
+                       if change['seq'] > since),
+                      key=lambda change: change['seq'])
+
+    def changes(self, since=0, limit=None, include_docs=False, feed=None,
+                timeout=None):
+        self.requests += 1
+        if feed == 'continuous':
+            return self._continuous(since, timeout)
+        results = self._since(since)[:limit]
+        last_seq = results[-1]['seq'] if results else since
+        return {'results': results, 'last_seq': last_seq}
+
+    def _continuous(self, since, timeout):
+        while True:
+            with self.changed:
+                results = self._since(since)
+                if not results:
+                    self.changed.wait(timeout / 1000.0)
+                    results = self._since(since)
+                    if not results:
+                        yield {'last_seq': since}
+                        return
+            for change in results:
+                yield {'seq': change['seq'], 'id': change['id']}
+                since = change['seq']
+
+    def info(self):
+        return {'update_seq': self.seq}
+
+    def get(self, id, default=None, **options):
+        self.gets += 1
+        change = self.changes_by_id.get(id)
+        if change is None or change.get('deleted'):
+            return default
+        return dict(change['doc'])
+
+
+class LocalViewCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = ChangesDatabase()
+        for docid, type, name in [('john', 'Person', 'John Doe'),
+                                  ('mary', 'Person', 'Mary Jane'),
+                                  ('gotham', 'City', 'Gotham City'),
+                                  ('ann', 'Person', 'Ann Smith')]:
+            self.db.save({'_id': docid, 'type': type, 'name': name})
+        def map_fun(doc):
+            yield [doc['type'], doc['name']], doc['name']
+        self.cache = cache.LocalViewCache(self.db, map_fun)
+        self.cache.update()
+
+    def values(self, results):
+        return [row.value for row in results]
+
+    def test_all_rows(self):
+        results = self.cache()
+        self.assertEqual(self.values(results),
+                         ['Gotham City', 'Ann Smith', 'John Doe', 'Mary Jane'])
+        self.assertEqual(results.total_rows, 4)
+        self.assertEqual(results.offset, 0)
+        self.assertEqual(results.rows[0].id, 'gotham')
+
+    def test_slices(self):
+        people = self.cache()[['Person']:['Person', {}]]
+        self.assertEqual(self.values(people),
+                         ['Ann Smith', 'John Doe', 'Mary Jane'])
+        self.assertEqual(people.offset, 1)
+        self.assertEqual(self.values(self.cache()[['City', 'Gotham City']]),
+                         ['Gotham City'])
+
+    def test_options(self):
+        self.assertEqual(self.values(self.cache(descending=True,
+                                                startkey=['Person', {}],
+                                                endkey=['Person'])),
+                         ['Mary Jane', 'John Doe', 'Ann Smith'])
+        self.assertEqual(self.values(self.cache(endkey=['Person', 'John Doe'],
+                                                inclusive_end=False)),
+                         ['Gotham City', 'Ann Smith'])
+        self.assertEqual(self.values(self.cache(keys=[['Person', 'Mary Jane'],
+                                                      ['City', 'Gotham City']])),
+                         ['Mary Jane', 'Gotham City'])
+        self.assertEqual(self.values(self.cache(skip=1, limit=2)),
+                         ['Ann Smith', 'John Doe'])
+        self.assertRaises(ValueError, lambda: self.cache(group=True).rows)
+
+    def test_update(self):
+        self.db.save({'_id': 'mary', 'type': 'Person', 'name': 'Mary Smith'})
+        self.db.save({'_id': 'gotham'}, deleted=True)
+        self.assertEqual(self.cache.update(), 2)
+        self.assertEqual(self.values(self.cache()),
+                         ['Ann Smith', 'John Doe', 'Mary Smith'])
+        self.assertEqual(self.cache.update(), 0)
+
+    def test_update_batch(self):
+        view = cache.LocalViewCache(self.db, 'def fun(doc):\n'
+                                             '    yield doc["name"], None\n')
+        self.db.requests = 0
+        self.assertEqual(view.update(batch=3), 4)
+        self.assertEqual(self.db.requests, 2)
+        self.assertEqual(len(view), 4)
+
+    def test_map_error(self):
+        def map_fun(doc):
+            yield doc['missing'], None
+        view = cache.LocalViewCache(self.db, map_fun)
+        self.assertEqual(view.update(), 4)
+        self.assertEqual(len(view), 0)
+
+    def test_design_docs(self):
+        self.db.save({'_id': '_design/people', 'views': {}})
+        self.assertEqual(self.cache.update(), 1)
+        self.assertEqual(len(self.cache), 4)
+        def map_fun(doc):
+            yield doc['_id'], None
+        view = cache.LocalViewCache(self.db, map_fun)
+        view.update()
+        self.assertEqual(len(view), 4)
+        view = cache.LocalViewCache(self.db, map_fun, include_design=True)
+        view.update()
+        self.assertEqual([row.key for row in view()],
+                         ['_design/people', 'ann', 'gotham', 'john', 'mary'])
+
+    def test_collation(self):
+        values = [{'a': 1}, ['a'], 'b', 'a', 2.5, 1, True, False, None]
+        self.assertEqual(sorted(values, key=cache._collation_key),
+                         values[::-1])
+
+
+class CachedDatabaseTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = ChangesDatabase()
+        self.db.save({'_id': 'john', 'name': 'John Doe'})
+        self.cached = cache.CachedDatabase(self.db, max_size=2,
+                                           poll_timeout=50)
+
+    def tearDown(self):
+        self.cached.close()
+
+    def wait_for(self, condition):
+        deadline = time.time() + 5
+        while not condition():
+            self.assertTrue(time.time() < deadline)
+            time.sleep(0.01)
+
+    def test_read_through(self):
+        self.assertEqual(self.cached['john']['name'], 'John Doe')
+        self.assertEqual(self.cached.get('john')['name'], 'John Doe')
+        self.assertEqual(self.db.gets, 1)
+        self.assertEqual((self.cached.hits, self.cached.misses), (1, 1))
+        self.assertEqual(self.cached.hit_rate, 0.5)
+        self.assertEqual(self.cached.get('mary', 'default'), 'default')
+        self.assertRaises(http.ResourceNotFound, self.cached.__getitem__,
+                          'mary')
+        self.assertEqual(self.db.gets, 2)
+
+    def test_copies(self):
+        self.cached['john']['name'] = 'Jane Doe'
+        self.assertEqual(self.cached['john']['name'], 'John Doe')
+
+    def test_invalidated_by_changes(self):
+        self.cached['john']
+        self.db.save({'_id': 'john', 'name': 'John Smith'})
+        self.wait_for(lambda: self.cached.invalidations == 1)
+        self.assertEqual(self.cached['john']['name'], 'John Smith')
+        self.assertEqual(self.db.gets, 2)
+
+    def test_invalidated_by_writes(self):
+        self.cached['john']
+        self.cached.save({'_id': 'john', 'name': 'John Smith'})
+        self.assertEqual(self.cached['john']['name'], 'John Smith')
+
+    def test_max_size(self):
+        for docid in ('john', 'mary', 'gotham', 'john'):
+            self.cached.get(docid)
+        self.assertEqual(self.cached.misses, 4)
+        self.assertEqual(list(self.cached._docs), ['gotham', 'john'])
+
+    def test_options_bypass_cache(self):
+        self.cached.get('john', conflicts=True)
+        self.cached.get('john', conflicts=True)
+        self.assertEqual(self.db.gets, 2)
+        self.assertEqual(self.cached.misses, 0)
+
+    def test_changes_failure(self):
+        def changes(**options):
+            raise http.ServerError((500, 'boom'))
+        self.cached.close()
+        self.db.changes = changes
+        self.cached = cache.CachedDatabase(self.db, retry_delay=5)
+        self.wait_for(lambda: not self.cached._listening)
+        self.cached['john']
+        self.cached['john']
+        self.assertEqual(self.db.gets, 2)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(testutil.doctest_suite(cache))
+    suite.addTest(unittest.makeSuite(LocalViewCacheTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(CachedDatabaseTestCase, 'test'))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
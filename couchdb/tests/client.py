@@ -9,13 +9,14 @@
 from datetime import datetime
 import os
 import os.path
+import pickle
 import shutil
 import time
 import tempfile
 import threading
 import unittest
 
-from couchdb import client, http, util
+from couchdb import client, http, json, util
 from couchdb.tests import testutil
 
 
@@ -110,6 +111,12 @@ class ServerTestCase(testutil.TempDatabaseMixin, unittest.TestCase):
         self.temp_db()
         self.assertTrue(len(self.server) >= 2)
 
+    def test_dbs_info(self):
+        aname, a = self.temp_db()
+        infos = self.server.dbs_info([aname, 'python-tests-missing'])
+        self.assertEqual(list(infos), [aname])
+        self.assertEqual(infos[aname]['db_name'], aname)
+
     def test_uuids(self):
         ls = self.server.uuids()
         assert type(ls) == list
@@ -214,6 +221,20 @@ class DatabaseTestCase(testutil.TempDatabaseMixin, unittest.TestCase):
         del self.db['foo/bar']
         self.assertEqual(None, self.db.get('foo/bar'))
 
+    def test_get_lazy(self):
+        self.db['foo'] = {'bar': [1, 2, 3]}
+        doc = self.db.get('foo', lazy=True)
+        self.assertTrue(isinstance(doc, client.LazyDocument))
+        self.assertEqual(doc.id, 'foo')
+        self.assertEqual(doc.rev, self.db['foo'].rev)
+        self.assertFalse(doc.decoded)
+        self.assertEqual(doc['bar'], [1, 2, 3])
+        self.assertTrue(doc.decoded)
+        doc['bar'].append(4)
+        self.db.save(doc)
+        self.assertEqual(self.db['foo']['bar'], [1, 2, 3, 4])
+        self.assertEqual(self.db.get('missing', lazy=True), None)
+
     def test_unicode(self):
         self.db[u'føø'] = {u'bår': u'Iñtërnâtiônàlizætiøn', 'baz': 'ASCII'}
         self.assertEqual(u'Iñtërnâtiônàlizætiøn', self.db[u'føø'][u'bår'])
@@ -322,6 +343,27 @@ class DatabaseTestCase(testutil.TempDatabaseMixin, unittest.TestCase):
         attachment = doc['_attachments']['empty.txt']
         self.assertEqual(0, attachment['length'])
 
+    def test_contains_many(self):
+        self.db.update([{'_id': 'foo'}, {'_id': 'bar'}])
+        del self.db['bar']
+        self.assertEqual(self.db.contains_many(['foo', 'bar', 'baz']),
+                         set(['foo']))
+
+    def test_iter_attachments(self):
+        doc = {'_id': 'foo'}
+        self.db.save(doc)
+        self.db.put_attachment(doc, 'Foo bar', 'foo.txt', 'text/plain')
+        self.db.put_attachment(doc, b'\x00\x01', 'bar.bin',
+                               'application/octet-stream')
+        attachments = {}
+        for name, stub, content in self.db.iter_attachments(doc):
+            attachments[name] = (stub['length'], content.read())
+        self.assertEqual(attachments, {'foo.txt': (7, b'Foo bar'),
+                                       'bar.bin': (2, b'\x00\x01')})
+        names = [name for name, _, _ in
+                 self.db.iter_attachments('foo', rev=doc['_rev'])]
+        self.assertEqual(sorted(names), ['bar.bin', 'foo.txt'])
+
     def test_default_attachment(self):
         doc = {}
         self.db['foo'] = doc
@@ -943,6 +985,343 @@ class ViewIterationTestCase(testutil.TempDatabaseMixin, unittest.TestCase):
     def test_nullkeys(self):
         self.assertEqual(len(list(self.db.iterview('test/nulls', 10))), self.num_docs)
 
+class AllDbsResource(object):
+    """Answers _all_dbs and _dbs_info requests from a list of names.
+
+    With `dbs_info` set to an HTTP status, _dbs_info requests fail with it.
+    Without `start_key`, _all_dbs requests honor skip and limit but ignore
+    the start key.
+    """
+
+    def __init__(self, names, paging=True, dbs_info=True, start_key=True):
+        self.names = sorted(names)
+        self.paging = paging
+        self.start_key = start_key
+        self.dbs_info = dbs_info
+        self.requests = []
+
+    def __call__(self, name):
+        resource = AllDbsResource([name])
+        resource.get_json = lambda: self._info(name)
+        return resource
+
+    def _info(self, name):
+        self.requests.append(name)
+        if name not in self.names:
+            raise http.ResourceNotFound(('not_found', 'missing'))
+        return 200, {}, {'db_name': name}
+
+    def get_json(self, path, **options):
+        self.requests.append((path, options))
+        names = self.names
+        if self.paging:
+            if 'start_key' in options and self.start_key:
+                start = json.decode(options['start_key'])
+                names = [name for name in names if name >= start]
+            names = names[options.get('skip', 0):]
+            names = names[:options.get('limit', len(names))]
+        return 200, {}, names
+
+    def head(self, name):
+        self._info(name)
+
+    def post_json(self, path, body):
+        self.requests.append(path)
+        if self.dbs_info is not True:
+            raise http.ServerError((self.dbs_info, 'error'))
+        return 200, {}, [{'key': name, 'info': {'db_name': name}}
+                         if name in self.names else
+                         {'key': name, 'error': 'not_found'}
+                         for name in body['keys']]
+
+
+class ServerPagingTestCase(unittest.TestCase):
+
+    def test_iterdbs(self):
+        resource = AllDbsResource(['db%02d' % num for num in range(7)])
+        server = client.Server(resource)
+        self.assertEqual(list(server.iterdbs(batch=3)), resource.names)
+        self.assertEqual(len(resource.requests), 3)
+        self.assertEqual(list(server.iterdbs(batch=3, start='db05')),
+                         ['db05', 'db06'])
+        self.assertEqual(list(server), resource.names)
+
+    def test_iterdbs_without_paging(self):
+        resource = AllDbsResource(['a', 'b', 'c'], paging=False)
+        server = client.Server(resource)
+        self.assertEqual(list(server.iterdbs(batch=2)), ['a', 'b', 'c'])
+        self.assertEqual(list(server.iterdbs(batch=3)), ['a', 'b', 'c'])
+
+    def test_iterdbs_ignoring_start_key(self):
+        resource = AllDbsResource(['db%02d' % num for num in range(7)],
+                                  start_key=False)
+        server = client.Server(resource)
+        self.assertEqual(list(server.iterdbs(batch=3)), resource.names)
+        self.assertEqual(resource.requests[-1], ('_all_dbs', {}))
+
+    def test_len(self):
+        for num in (0, 1, 2, 5, 8, 100):
+            resource = AllDbsResource(['db%03d' % i for i in range(num)])
+            self.assertEqual(len(client.Server(resource)), num)
+            self.assertTrue(all(options['limit'] == 1 for _, options
+                                in resource.requests))
+        for num in (1, 3):
+            resource = AllDbsResource(['db%d' % i for i in range(num)],
+                                      paging=False)
+            self.assertEqual(len(client.Server(resource)), num)
+
+    def test_dbs_info(self):
+        resource = AllDbsResource(['db%d' % num for num in range(5)])
+        server = client.Server(resource)
+        infos = server.dbs_info(['db0', 'db3', 'missing', 'db4'], batch=2)
+        self.assertEqual(sorted(infos), ['db0', 'db3', 'db4'])
+        self.assertEqual(infos['db3'], {'db_name': 'db3'})
+        self.assertEqual(resource.requests, ['_dbs_info', '_dbs_info'])
+
+    def test_dbs_info_fallback(self):
+        resource = AllDbsResource(['db%d' % num for num in range(5)],
+                                  dbs_info=405)
+        server = client.Server(resource)
+        infos = server.dbs_info(['db0', 'db3', 'missing'], concurrency=2)
+        self.assertEqual(sorted(infos), ['db0', 'db3'])
+        self.assertEqual(sorted(resource.requests[1:]),
+                         ['db0', 'db3', 'missing'])
+
+    def test_dbs_info_error(self):
+        resource = AllDbsResource(['db0'], dbs_info=503)
+        server = client.Server(resource)
+        self.assertRaises(http.ServerError, server.dbs_info, ['db0'])
+        self.assertEqual(resource.requests, ['_dbs_info'])
+
+    def test_contains_many(self):
+        resource = AllDbsResource(['db%d' % num for num in range(5)])
+        server = client.Server(resource)
+        self.assertEqual(server.contains_many(['db1', 'x', 'db2'], batch=2),
+                         set(['db1', 'db2']))
+        self.assertEqual(resource.requests, ['_dbs_info', '_dbs_info'])
+        resource = AllDbsResource(['db%d' % num for num in range(5)],
+                                  dbs_info=405)
+        server = client.Server(resource)
+        self.assertEqual(server.contains_many(['db1', 'x', 'db2']),
+                         set(['db1', 'db2']))
+        self.assertEqual(sorted(resource.requests[1:]), ['db1', 'db2', 'x'])
+
+    def test_contains_many_error(self):
+        resource = AllDbsResource(['db0'], dbs_info=500)
+        server = client.Server(resource)
+        self.assertRaises(http.ServerError, server.contains_many, ['db0'])
+        self.assertEqual(resource.requests, ['_dbs_info'])
+
+
+class AllDocsResource(object):
+    """Answers _all_docs requests with keys."""
+
+    def __init__(self, ids, deleted=()):
+        self.ids = set(ids)
+        self.deleted = set(deleted)
+        self.requests = []
+
+    def post_json(self, path, body):
+        self.requests.append(body['keys'])
+        rows = []
+        for key in body['keys']:
+            if key in self.ids:
+                rows.append({'id': key, 'key': key, 'value': {'rev': '1-a'}})
+            elif key in self.deleted:
+                rows.append({'id': key, 'key': key,
+                             'value': {'rev': '2-b', 'deleted': True}})
+            else:
+                rows.append({'key': key, 'error': 'not_found'})
+        return 200, {}, {'rows': rows}
+
+
+class ContainsManyTestCase(unittest.TestCase):
+
+    def test_contains_many(self):
+        resource = AllDocsResource(['doc%d' % num for num in range(0, 20, 2)],
+                                   deleted=['doc3'])
+        db = client.Database(resource)
+        ids = ['doc%d' % num for num in range(10)]
+        self.assertEqual(db.contains_many(ids, batch=3),
+                         set(['doc0', 'doc2', 'doc4', 'doc6', 'doc8']))
+        self.assertEqual(sorted(len(keys) for keys in resource.requests),
+                         [1, 3, 3, 3])
+        self.assertEqual(db.contains_many([]), set())
+
+
+class TrickleBody(object):
+    """Response body returning only a few bytes per read."""
+
+    def __init__(self, data, size=7):
+        self.data = data
+        self.size = size
+
+    def read(self, size=None):
+        data, self.data = self.data[:self.size], self.data[self.size:]
+        return data
+
+
+class FindResource(object):
+    """Answers ``_find`` requests in pages, using the offset as bookmark."""
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.requests = []
+
+    def post(self, path, body=None):
+        self.requests.append(body)
+        start = int(body.get('bookmark', body.get('skip', 0)))
+        if 'bookmark' in body:
+            start += body.get('skip', 0)
+        docs = self.docs[start:start + body['limit']]
+        # the order of the members matches CouchDB's responses
+        data = '{"docs": %s, "bookmark": "%d"}' % (json.encode(docs),
+                                                   start + len(docs))
+        return 200, {}, TrickleBody(data.encode('utf-8'))
+
+
+class IterFindTestCase(unittest.TestCase):
+
+    def setUp(self):
+        docs = [{'_id': 'doc%d' % num, 'num': num,
+                 'text': u'a "quoted" {brace} [and] \\ bår'}
+                for num in range(10)]
+        self.resource = FindResource(docs)
+        self.db = client.Database(self.resource)
+
+    def nums(self, docs):
+        return [doc['num'] for doc in docs]
+
+    def test_pages(self):
+        docs = list(self.db.iterfind({'selector': {}}, batch=3))
+        self.assertEqual(self.nums(docs), list(range(10)))
+        self.assertEqual(docs[0]['text'], u'a "quoted" {brace} [and] \\ bår')
+        self.assertTrue(isinstance(docs[0], client.Document))
+        self.assertEqual([request.get('bookmark') for request
+                          in self.resource.requests], [None, '3', '6', '9'])
+
+    def test_limit(self):
+        docs = self.db.iterfind({'selector': {}, 'limit': 5}, batch=2)
+        self.assertEqual(self.nums(docs), list(range(5)))
+        self.assertEqual([request['limit'] for request
+                          in self.resource.requests], [2, 2, 1])
+        self.assertRaises(ValueError, list,
+                          self.db.iterfind({'limit': 0}, batch=2))
+        self.assertRaises(ValueError, list, self.db.iterfind({}, batch=0))
+
+    def test_skip(self):
+        docs = self.db.iterfind({'selector': {}, 'skip': 2}, batch=3)
+        self.assertEqual(self.nums(docs), list(range(2, 10)))
+        self.assertEqual([request.get('skip') for request
+                          in self.resource.requests], [2, None, None])
+
+    def test_exact_pages(self):
+        docs = self.db.iterfind({'selector': {}}, batch=5, wrapper=dict)
+        self.assertEqual(self.nums(docs), list(range(10)))
+        self.assertEqual(len(self.resource.requests), 3)
+
+    def test_prefetch(self):
+        second_page = threading.Event()
+        post = self.resource.post
+        def post_page(path, body=None):
+            if body.get('bookmark') == '4':
+                second_page.set()
+            return post(path, body)
+        self.resource.post = post_page
+        docs = self.db.iterfind({'selector': {}}, batch=4, prefetch=True)
+        first = next(docs)
+        # the second page is requested before the first one is consumed
+        self.assertTrue(second_page.wait(5))
+        self.assertEqual(self.nums([first] + list(docs)), list(range(10)))
+
+    def test_lazy(self):
+        docs = list(self.db.iterfind({'selector': {}}, batch=3, lazy=True))
+        self.assertTrue(all(isinstance(doc, client.LazyDocument)
+                            for doc in docs))
+        self.assertEqual([doc.id for doc in docs],
+                         ['doc%d' % num for num in range(10)])
+        self.assertFalse(any(doc.decoded for doc in docs))
+        self.assertEqual(docs[0]['text'], u'a "quoted" {brace} [and] \\ bår')
+        docs = self.db.find({'selector': {}, 'limit': 4}, lazy=True)
+        self.assertEqual(self.nums(docs), [0, 1, 2, 3])
+
+    def test_other_member_order(self):
+        self.resource.post = lambda path, body=None: (200, {}, TrickleBody(
+            b'{"warning": "no index", "docs": [{"num": 1}], "bookmark": "x"}'))
+        self.assertEqual(self.nums(self.db.iterfind({}, batch=2)), [1])
+
+    def test_truncated(self):
+        self.resource.post = lambda path, body=None: (200, {}, TrickleBody(
+            b'{"docs": [{"num": 1}, {"num": '))
+        self.assertRaises(ValueError, list, self.db.iterfind({}, batch=2))
+
+
+class AttachmentsResource(object):
+    """Answers document requests with the attachments inlined as JSON."""
+
+    def __init__(self, doc):
+        self.doc = doc
+
+    def __call__(self, *path):
+        return self
+
+    def get(self, headers=None, **options):
+        body = json.encode(self.doc).encode('utf-8')
+        return 200, {'content-type': 'application/json'}, util.StringIO(body)
+
+
+class IterAttachmentsTestCase(unittest.TestCase):
+
+    def test_inline_with_stubs(self):
+        db = client.Database(AttachmentsResource({
+            '_id': 'foo', '_rev': '2-abc', '_attachments': {
+                'new.txt': {'content_type': 'text/plain', 'revpos': 2,
+                            'data': 'Rm9vIGJhcg=='},
+                'old.txt': {'content_type': 'text/plain', 'revpos': 1,
+                            'stub': True}}}))
+        attachments = [(name, content.read()) for name, _, content
+                       in db.iter_attachments('foo', atts_since=['1-abc'])]
+        self.assertEqual(attachments, [('new.txt', b'Foo bar')])
+
+
+class LazyDocumentTestCase(unittest.TestCase):
+
+    def test_id_rev_without_decoding(self):
+        doc = client.LazyDocument(b'{"_id": "foo", "_rev": "1-abc"}',
+                                  'foo', '1-abc')
+        self.assertEqual((doc.id, doc.rev), ('foo', '1-abc'))
+        self.assertFalse(doc.decoded)
+
+    def test_decode_on_access(self):
+        raw = u'{"_id": "foo", "_rev": "1-abc", "b\u00e5r": 42}'
+        doc = client.LazyDocument(raw.encode('utf-8'), 'foo', '1-abc')
+        self.assertEqual(doc[u'bår'], 42)
+        self.assertTrue(doc.decoded)
+        self.assertEqual(sorted(doc), [u'_id', u'_rev', u'bår'])
+
+    def test_id_rev_not_given(self):
+        doc = client.LazyDocument(b'{"_id": "foo", "_rev": "1-abc"}')
+        self.assertEqual((doc.id, doc.rev), ('foo', '1-abc'))
+        self.assertTrue(doc.decoded)
+
+    def test_pickle(self):
+        raw = b'{"_id": "foo", "_rev": "1-abc", "bar": [1, 2]}'
+        doc = pickle.loads(pickle.dumps(client.LazyDocument(raw, 'foo')))
+        self.assertEqual(type(doc), client.Document)
+        self.assertEqual(doc, {'_id': 'foo', '_rev': '1-abc', 'bar': [1, 2]})
+        self.assertEqual(doc.rev, '1-abc')
+
+    def test_encode(self):
+        raw = b'{"_id": "foo", "bar": [1, 2]}'
+        doc = client.LazyDocument(raw, 'foo')
+        self.assertEqual(json.decode(json.encode(doc)),
+                         {'_id': 'foo', 'bar': [1, 2]})
+        doc = client.LazyDocument(raw, 'foo')
+        self.assertEqual(dict(doc), {'_id': 'foo', 'bar': [1, 2]})
+        self.assertEqual(client.LazyDocument(raw, 'foo'),
+                         {'_id': 'foo', 'bar': [1, 2]})
+
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(ServerTestCase, 'test'))
@@ -951,6 +1330,11 @@ def suite():
     suite.addTest(unittest.makeSuite(ShowListTestCase, 'test'))
     suite.addTest(unittest.makeSuite(UpdateHandlerTestCase, 'test'))
     suite.addTest(unittest.makeSuite(ViewIterationTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(ServerPagingTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(ContainsManyTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(IterFindTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(IterAttachmentsTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(LazyDocumentTestCase, 'test'))
     suite.addTest(testutil.doctest_suite(client))
     return suite
 
@@ -6,10 +6,19 @@
 # This software is licensed as described in the file COPYING, which
 # you should have received as part of this distribution.
 
+import os
 import socket
+import threading
 import time
 import unittest
 
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
 from couchdb import http, util
 from couchdb.tests import testutil
 
@@ -32,6 +41,193 @@ class SessionTestCase(testutil.TempDatabaseMixin, unittest.TestCase):
         self.assertRaises(socket.timeout, session.request, 'GET', db.resource.url)
 
 
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ETagHandler(BaseHTTPRequestHandler):
+    """Serves a small JSON document with an ETag for every path."""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        etag = '"%s"' % self.path
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = ('{"path": "%s"}' % self.path).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadedSessionTestCase(unittest.TestCase):
+
+    num_threads, num_requests = 16, 100
+
+    def setUp(self):
+        self.server = ThreadedHTTPServer(('127.0.0.1', 0), ETagHandler)
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _hammer(self, session):
+        errors = []
+        def worker(n):
+            try:
+                for i in range(self.num_requests):
+                    # Enough distinct URLs to keep the cache cleaning up
+                    path = 'doc%d' % ((n * self.num_requests + i) % 100)
+                    status, headers, body = session.request('GET',
+                                                            self.url + path)
+                    self.assertEqual(body.read(),
+                                     ('{"path": "/%s"}' % path).encode('utf-8'))
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=worker, args=(n,))
+                   for n in range(self.num_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertTrue(len(session.cache.by_url) <= session.cache.max_size)
+
+    def test_shared_session(self):
+        self._hammer(http.Session())
+
+    def test_shared_session_thread_affinity(self):
+        session = http.Session(thread_affinity=True)
+        self._hammer(session)
+        self.assertFalse(any(session.connection_pool.conns.values()))
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(5)
+        self.url = 'http://127.0.0.1:%d/' % self.listener.getsockname()[1]
+
+    def tearDown(self):
+        self.listener.close()
+
+    def test_prewarm(self):
+        session = http.Session()
+        pool = session.connection_pool
+        self.assertEqual(session.prewarm([self.url], 3), 3)
+        self.assertEqual(session.prewarm([self.url], 3), 0)
+        conn = pool.get(self.url + 'db')
+        self.assertEqual(pool.reused, 1)
+        pool.release(self.url, conn)
+        self.assertEqual(session.prewarm([self.url], 3), 0)
+
+    def test_thread_affinity(self):
+        pool = http.ConnectionPool(None, thread_affinity=True)
+        pool.prewarm(self.url, 1)
+        conn = pool.get(self.url)
+        self.assertEqual(pool.conns[('http', self.url.split('/')[2])], [])
+        pool.release(self.url, conn)
+        self.assertTrue(pool.get(self.url) is conn)
+        pool.release(self.url, conn)
+        other = []
+        thread = threading.Thread(target=lambda: other.append(
+            pool.get(self.url)))
+        thread.start()
+        thread.join()
+        self.assertFalse(other[0] is conn)
+
+    def test_prewarm_strips_credentials(self):
+        session = http.Session()
+        url = self.url.replace('//', '//joe:secret@')
+        self.assertEqual(session.prewarm([url], 1), 1)
+        host = self.url.split('/')[2]
+        self.assertEqual(len(session.connection_pool.conns['http', host]), 1)
+
+    def test_shared_ssl_context(self):
+        pool = http.ConnectionPool(None)
+        if pool.ssl_context is None: # Python < 3.6
+            return
+        import ssl
+        self.assertEqual(pool.ssl_context.verify_mode, ssl.CERT_REQUIRED)
+        pool = http.ConnectionPool(None, disable_ssl_verification=True)
+        self.assertEqual(pool.ssl_context.verify_mode, ssl.CERT_NONE)
+        conn = http.ResumingHTTPSConnection('127.0.0.1', pool.tls_sessions,
+                                            context=pool.ssl_context)
+        self.assertTrue(conn._context is pool.ssl_context)
+
+        pool = http.ConnectionPool(None)
+        contexts = []
+        threads = [threading.Thread(target=lambda: contexts.append(
+            pool.ssl_context)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(map(id, contexts))), 1)
+
+    def test_resume_tls_session(self):
+        import ssl
+        if not hasattr(ssl, 'TLSVersion'): # Python < 3.7
+            return
+        pool = http.ConnectionPool(5, disable_ssl_verification=True)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        # TLS 1.2 makes the session available right after the handshake
+        context.maximum_version = ssl.TLSVersion.TLSv1_2
+        context.load_cert_chain(os.path.join(os.path.dirname(__file__),
+                                             'selfsigned.pem'))
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(5)
+        host = '127.0.0.1:%d' % listener.getsockname()[1]
+
+        def serve():
+            while True:
+                try:
+                    sock, _ = listener.accept()
+                except (OSError, socket.error):
+                    return
+                try:
+                    context.wrap_socket(sock, server_side=True).close()
+                except (OSError, socket.error):
+                    sock.close()
+        thread = threading.Thread(target=serve)
+        thread.daemon = True
+        thread.start()
+        try:
+            first = pool._connect('https', host)
+            self.assertFalse(first.sock.session_reused)
+            second = pool._connect('https', host)
+            self.assertTrue(second.sock.session_reused)
+            self.assertEqual(list(pool.tls_sessions),
+                             [('127.0.0.1', int(host.split(':')[1]))])
+
+            # a session of another context is not resumed, but doesn't fail
+            other = http.ConnectionPool(5, disable_ssl_verification=True)
+            other.tls_sessions.update(pool.tls_sessions)
+            third = other._connect('https', host)
+            self.assertFalse(third.sock.session_reused)
+            for conn in first, second, third:
+                conn.close()
+        finally:
+            listener.close()
+
+
 class ResponseBodyTestCase(unittest.TestCase):
     def test_close(self):
         class TestStream(util.StringIO):
@@ -71,6 +267,48 @@ class ResponseBodyTestCase(unittest.TestCase):
         self.assertEqual(list(response.iterchunks()), [b'foobarbaz\n'])
         self.assertEqual(list(response.iterchunks()), [])
 
+    def _chunked_response(self, data):
+        class TestHttpResp(object):
+            msg = {'transfer-encoding': 'chunked'}
+            def __init__(self, fp):
+                self.fp = fp
+                self.closed = False
+            def close(self):
+                self.closed = True
+            def isclosed(self):
+                return self.closed
+
+        class TestConn(object):
+            closed = False
+            def close(self):
+                self.closed = True
+
+        pool = http.ConnectionPool(None)
+        conn = TestConn()
+        resp = TestHttpResp(util.StringIO(data))
+        return http.ResponseBody(resp, pool, 'http://a/', conn), pool, conn
+
+    def test_chunked_fully_read_releases_conn(self):
+        response, pool, conn = self._chunked_response(
+            b'4\r\nfoo\n\r\n0\r\n\r\n')
+        self.assertEqual(list(response.iterchunks()), [b'foo\n'])
+        del response
+        self.assertEqual(pool.conns[('http', 'a')], [conn])
+        self.assertEqual(pool.discarded, 0)
+        self.assertFalse(conn.closed)
+        self.assertTrue(pool.get('http://a/') is conn)
+        self.assertEqual(pool.reused, 1)
+
+    def test_chunked_partially_read_discards_conn(self):
+        response, pool, conn = self._chunked_response(
+            b'4\r\nfoo\n\r\n4\r\nbar\n\r\n')
+        chunks = response.iterchunks()
+        self.assertEqual(next(chunks), b'foo\n')
+        del chunks, response
+        self.assertFalse(pool.conns)
+        self.assertEqual(pool.discarded, 1)
+        self.assertTrue(conn.closed)
+
 
 class CacheTestCase(testutil.TempDatabaseMixin, unittest.TestCase):
 
@@ -97,6 +335,8 @@ def suite():
     suite = unittest.TestSuite()
     suite.addTest(testutil.doctest_suite(http))
     suite.addTest(unittest.makeSuite(SessionTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(ThreadedSessionTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(ConnectionPoolTestCase, 'test'))
     suite.addTest(unittest.makeSuite(ResponseBodyTestCase, 'test'))
     suite.addTest(unittest.makeSuite(CacheTestCase, 'test'))
     return suite
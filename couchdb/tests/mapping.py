@@ -7,11 +7,12 @@
 # you should have received as part of this distribution.
 
 from decimal import Decimal
+import pickle
 import unittest
 
-from couchdb import design, mapping
+from couchdb import design, mapping, util
 from couchdb.tests import testutil
-from datetime import datetime
+from datetime import date, datetime, time, timedelta, tzinfo
 
 class DocumentTestCase(testutil.TempDatabaseMixin, unittest.TestCase):
 
@@ -93,11 +94,317 @@ class DocumentTestCase(testutil.TempDatabaseMixin, unittest.TestCase):
         d = datetime.now()
         assert dt._to_json(d)
 
+    def test_datetime_offsets(self):
+        dt = mapping.DateTimeField()
+        self.assertEqual(dt._to_python('2007-04-01T17:30:00.5+02:00'),
+                         datetime(2007, 4, 1, 15, 30, 0, 500000))
+        self.assertEqual(dt._to_python('2007-04-01T23:30:00-0100'),
+                         datetime(2007, 4, 2, 0, 30))
+        self.assertEqual(dt._to_json(datetime(2007, 4, 1, 17, 30,
+                                              tzinfo=FixedOffset(120))),
+                         '2007-04-01T15:30:00Z')
+
+    def test_datetime_fractions(self):
+        dt = mapping.DateTimeField()
+        self.assertEqual(dt._to_python('2007-04-01T15:30:00.1Z'),
+                         datetime(2007, 4, 1, 15, 30, 0, 100000))
+        self.assertEqual(dt._to_python('2007-04-01T15:30:00.1234567Z'),
+                         datetime(2007, 4, 1, 15, 30, 0, 123456))
+
+    def test_datetime_legacy_layout(self):
+        dt = mapping.DateTimeField()
+        self.assertEqual(dt._to_python('2007-4-1T5:30:00Z'),
+                         datetime(2007, 4, 1, 5, 30))
+
+    def test_datetime_invalid(self):
+        dt = mapping.DateTimeField()
+        for value in ('2007-04-01', '2007-13-01T15:30:00Z',
+                      '2007-04-01T15:30:00+2', 'foo'):
+            self.assertRaises(ValueError, dt._to_python, value)
+
+    def test_date(self):
+        field = mapping.DateField()
+        self.assertEqual(field._to_python('2007-04-01'), date(2007, 4, 1))
+        self.assertRaises(ValueError, field._to_python, '2007-02-30')
+
+    def test_time_offsets(self):
+        field = mapping.TimeField()
+        self.assertEqual(field._to_python('15:30:00.123Z'), time(15, 30))
+        self.assertEqual(field._to_python('23:30:00-01:00'), time(0, 30))
+        self.assertEqual(field._to_json(time(17, 30, tzinfo=FixedOffset(120))),
+                         '15:30:00')
+        self.assertRaises(ValueError, field._to_python, '25:00:00')
+
+    def test_wrap_many(self):
+        class Post(mapping.Document):
+            title = mapping.TextField()
+        data = [{'_id': 'foo', 'title': 'Foo'}, {'_id': 'bar', 'title': 'Bar'}]
+        posts = Post.wrap_many(data)
+        self.assertEqual([post.id for post in posts], ['foo', 'bar'])
+        self.assertEqual([post.title for post in posts], ['Foo', 'Bar'])
+        self.assertEqual(Post.unwrap_many(posts), data)
+        self.assertTrue(Post.unwrap_many(posts)[0] is data[0])
+
+    def test_wrap_many_custom_init(self):
+        class Post(mapping.Document):
+            title = mapping.TextField()
+            def __init__(self, *args, **kwargs):
+                mapping.Document.__init__(self, *args, **kwargs)
+                self.wrapped = True
+        posts = Post.wrap_many([{'title': 'Foo'}])
+        self.assertTrue(posts[0].wrapped)
+        self.assertEqual(posts[0].title, 'Foo')
+
+    def test_store_many(self):
+        class Post(mapping.Document):
+            title = mapping.TextField()
+        posts = [Post(title='Post %d' % i) for i in range(5)]
+        results = Post.store_many(self.db, posts, batch_size=2)
+        self.assertEqual(len(results), 5)
+        self.assertTrue(all(success for success, _, _ in results))
+        self.assertEqual([post.id for post in posts],
+                         [docid for _, docid, _ in results])
+        self.assertEqual(Post.load(self.db, posts[4].id).title, 'Post 4')
+        posts[0].title = 'Changed'
+        self.assertEqual(Post.store_many(self.db, posts[:1])[0][2],
+                         Post.load(self.db, posts[0].id).rev)
+
+    def test_validate(self):
+        class Post(mapping.Document):
+            title = mapping.TextField()
+            views = mapping.IntegerField()
+            price = mapping.DecimalField()
+            pubdate = mapping.DateTimeField()
+        Post(title='Foo', views=3, price=Decimal('1.5'),
+             pubdate=datetime.now()).validate()
+        Post.wrap({}).validate()
+        for data in ({'title': 3}, {'views': '3'}, {'views': True},
+                     {'price': 'foo'}, {'pubdate': '2007-04-01'}):
+            self.assertRaises(ValueError, Post.wrap(data).validate)
+
+    def test_validate_nested(self):
+        class Author(mapping.Mapping):
+            name = mapping.TextField()
+        class Post(mapping.Document):
+            author = mapping.DictField(Author)
+            comments = mapping.ListField(mapping.DictField(Author))
+            tags = mapping.ListField(mapping.TextField())
+        Post(author={'name': 'Joe'}, comments=[{'name': 'Jane'}],
+             tags=['foo']).validate()
+        post = Post.wrap({'comments': [{'name': 'Jane'}, {'name': 42}]})
+        try:
+            post.validate()
+        except ValueError as e:
+            self.assertEqual(str(e),
+                             "Invalid value for TextField 'comments[1].name': 42")
+        else:
+            self.fail('Expected ValueError')
+        self.assertRaises(ValueError, Post.wrap({'author': 'Joe'}).validate)
+        self.assertRaises(ValueError, Post.wrap({'tags': ['foo', 1]}).validate)
+
+    def test_validate_many(self):
+        class Post(mapping.Document):
+            title = mapping.TextField()
+        Post.validate_many([Post(title='Foo'), Post.wrap({'title': 'Bar'})])
+        self.assertRaises(ValueError, Post.validate_many,
+                          [Post(title='Foo'), Post.wrap({'title': 3})])
+
+    def test_dirty_fields(self):
+        class Author(mapping.Mapping):
+            name = mapping.TextField()
+        class Post(mapping.Document):
+            title = mapping.TextField()
+            author = mapping.DictField(Author)
+            comments = mapping.ListField(mapping.DictField(Author))
+            tags = mapping.ListField(mapping.TextField())
+        post = Post.wrap({'_id': 'foo', '_rev': '1-abc', 'title': 'Foo',
+                          'author': {'name': 'Joe'},
+                          'comments': [{'name': 'Jane'}], 'tags': ['foo']})
+        post.title, post.author.name, list(post.comments), list(post.tags)
+        self.assertEqual(post.dirty_fields, frozenset())
+        post.author.name = 'John'
+        post.comments[0].name = 'Mary'
+        post.tags.append('bar')
+        self.assertEqual(post.dirty_fields,
+                         frozenset(['author', 'comments', 'tags']))
+        self.assertEqual(post.unwrap()['comments'], [{'name': 'Mary'}])
+        del post['title']
+        self.assertTrue('title' in post.dirty_fields)
+
+    def test_dirty_fields_plain_dict(self):
+        class Post(mapping.Document):
+            extra = mapping.DictField()
+        post = Post.wrap({'_id': 'foo', '_rev': '1-abc', 'extra': {'a': 1}})
+        extra = post.extra
+        # no copies are kept until the document is stored with tracking
+        self.assertEqual(post.dirty_fields, frozenset(['extra']))
+        self.assertEqual(getattr(post, '_snapshots', None), None)
+        post._reset_changes(snapshots=True)
+        self.assertEqual(post.dirty_fields, frozenset())
+        extra['b'] = 2
+        self.assertEqual(post.dirty_fields, frozenset(['extra']))
+        post._reset_changes()
+        self.assertEqual(post.dirty_fields, frozenset())
+        extra['c'] = 3
+        self.assertEqual(post.dirty_fields, frozenset(['extra']))
+
+    def test_store_unchanged(self):
+        class Post(mapping.Document):
+            title = mapping.TextField()
+        post = Post(title='Foo').store(self.db)
+        rev = post.rev
+        self.assertEqual(post.dirty_fields, frozenset())
+        self.assertEqual(post.store(self.db, skip_unchanged=True).rev, rev)
+        post = Post.load(self.db, post.id)
+        self.assertEqual(post.store(self.db, skip_unchanged=True).rev, rev)
+        post.title = 'Bar'
+        self.assertNotEqual(post.store(self.db, skip_unchanged=True).rev, rev)
+
+    def test_store_with_update_handler(self):
+        self.db['_design/test'] = {'updates': {'delta': mapping.UPDATE_HANDLER}}
+        class Post(mapping.Document):
+            title = mapping.TextField()
+            body = mapping.TextField()
+        post = Post(title='Foo', body='Long text').store(self.db,
+                                                         handler='test/delta')
+        post.title = 'Bar'
+        del post['body']
+        post.store(self.db, handler='test/delta')
+        self.assertEqual(post.dirty_fields, frozenset())
+        doc = self.db[post.id]
+        self.assertEqual(doc.rev, post.rev)
+        self.assertEqual(doc['title'], 'Bar')
+        self.assertFalse('body' in doc)
+
+    def test_load_fields_only(self):
+        class Post(mapping.Document):
+            title = mapping.TextField()
+        self.db['foo'] = {'title': 'Foo', 'body': 'Long text'}
+        post = Post.load(self.db, 'foo', fields_only=True)
+        self.assertEqual(post.title, 'Foo')
+        self.assertFalse('body' in post)
+        self.assertEqual(Post.load(self.db, 'bar', fields_only=True), None)
+        post.title = 'Bar'
+        post.store(self.db)
+        doc = self.db['foo']
+        self.assertEqual(doc.rev, post.rev)
+        self.assertEqual(doc['title'], 'Bar')
+        self.assertEqual(doc['body'], 'Long text')
+
+    def test_find(self):
+        class Post(mapping.Document):
+            title = mapping.TextField()
+            type = mapping.TextField()
+        self.db.update([{'type': 'Post', 'title': 'Foo', 'body': '...'},
+                        {'type': 'Post', 'title': 'Bar', 'body': '...'},
+                        {'type': 'Page', 'title': 'Baz', 'body': '...'}])
+        posts = Post.find(self.db, {'type': 'Post'})
+        self.assertEqual(sorted(post.title for post in posts), ['Bar', 'Foo'])
+        self.assertFalse(any('body' in post for post in posts))
+        posts = Post.find(self.db, {'type': 'Page'}, fields_only=False)
+        self.assertEqual(posts[0]['body'], '...')
+
     def test_get_has_default(self):
         doc = mapping.Document()
         doc.get('foo')
         doc.get('foo', None)
 
+    def test_init_defaults(self):
+        class Post(mapping.Document):
+            title = mapping.TextField()
+            views = mapping.IntegerField(default=0)
+            slug = mapping.TextField(name='_slug', default=lambda: 'foo')
+        self.assertEqual(Post()._data,
+                         {'title': None, 'views': 0, '_slug': 'foo'})
+        self.assertEqual(Post(title=42, views=None, slug='bar')._data,
+                         {'title': '42', 'views': None, '_slug': 'bar'})
+
+    def test_init_custom_field(self):
+        class UpperField(mapping.TextField):
+            def __set__(self, instance, value):
+                instance._data[self.name] = value.upper()
+        class Post(mapping.Document):
+            title = UpperField(default='untitled')
+        self.assertEqual(Post()._data, {'title': 'UNTITLED'})
+        self.assertEqual(Post(title='foo')._data, {'title': 'FOO'})
+
+    def test_wrap_custom_init(self):
+        class Post(mapping.Document):
+            title = mapping.TextField()
+            def __init__(self, **values):
+                mapping.Document.__init__(self, **values)
+                self.loaded = False
+        post = Post.wrap({'title': 'Foo'})
+        self.assertEqual(post.title, 'Foo')
+        self.assertFalse(post.loaded)
+
+    def test_slots(self):
+        post = SlottedPost(title='Foo')
+        self.assertFalse(hasattr(post, '__dict__'))
+        self.assertRaises(AttributeError, setattr, post, 'foo', 'bar')
+        self.assertEqual(pickle.loads(pickle.dumps(post))._data,
+                         {'title': 'Foo'})
+
+    def test_cached_conversion(self):
+        class Post(mapping.Document):
+            pubdate = mapping.DateTimeField()
+            tags = mapping.ListField(mapping.TextField())
+            author = mapping.DictField(mapping.Mapping.build(
+                name=mapping.TextField()))
+        post = Post.wrap({'pubdate': '2007-04-01T15:30:00Z',
+                          'tags': ['foo'], 'author': {'name': 'Joe'}})
+        self.assertTrue(post.pubdate is post.pubdate)
+        self.assertTrue(post.tags is post.tags)
+        self.assertTrue(post.author is post.author)
+        post.tags.append('bar')
+        self.assertEqual(post.tags, ['foo', 'bar'])
+
+    def test_cached_conversion_invalidation(self):
+        class Post(mapping.Document):
+            pubdate = mapping.DateTimeField()
+            tags = mapping.ListField(mapping.TextField())
+        post = Post(pubdate=datetime(2007, 4, 1, 15, 30), tags=['foo'])
+        self.assertEqual(post.pubdate, datetime(2007, 4, 1, 15, 30))
+        post.pubdate = datetime(2008, 4, 1, 15, 30)
+        self.assertEqual(post.pubdate, datetime(2008, 4, 1, 15, 30))
+        post['pubdate'] = '2009-04-01T15:30:00Z'
+        self.assertEqual(post.pubdate, datetime(2009, 4, 1, 15, 30))
+        post._data['pubdate'] = None
+        self.assertEqual(post.pubdate, None)
+        self.assertEqual(post.tags, ['foo'])
+        post.tags = ['bar']
+        self.assertEqual(post.tags, ['bar'])
+        post._data = {'tags': ['baz']}
+        self.assertEqual(post.tags, ['baz'])
+
+    def test_pickle(self):
+        post = PicklePost(title='Foo')
+        post.extra = 'bar'
+        post = pickle.loads(pickle.dumps(post))
+        self.assertEqual(post.title, 'Foo')
+        self.assertEqual(post.extra, 'bar')
+
+
+class FixedOffset(tzinfo):
+
+    def __init__(self, minutes):
+        self.offset = timedelta(minutes=minutes)
+
+    def utcoffset(self, dt):
+        return self.offset
+
+    def dst(self, dt):
+        return timedelta(0)
+
+
+class PicklePost(mapping.Document):
+    title = mapping.TextField()
+
+
+class SlottedPost(mapping.Document):
+    __slots__ = ()
+    title = mapping.TextField()
+
 
 class ListFieldTestCase(testutil.TempDatabaseMixin, unittest.TestCase):
 
@@ -266,12 +573,85 @@ class WrappingTestCase(testutil.TempDatabaseMixin, unittest.TestCase):
         self.assertEqual(type(results.rows[0]), self.Item)
 
 
+class UpdateDatabase(object):
+    """Records the documents stored with bulk updates."""
+
+    def __init__(self):
+        self.updated = []
+
+    def save(self, doc, **options):
+        self.updated.append(dict(doc))
+        doc['_rev'] = '%d-abc' % len(self.updated)
+        return doc['_id'], doc['_rev']
+
+    def update_doc(self, name, docid=None, **options):
+        self.updated.append(options['body'])
+        return {'X-Couch-Update-NewRev': '2-def'}, util.StringIO(b'')
+
+    def update(self, docs, **options):
+        self.updated.extend(docs)
+        return [(True, doc.setdefault('_id', 'doc%d' % num), '1-abc')
+                for num, doc in enumerate(docs)]
+
+
+class StoreTestCase(unittest.TestCase):
+
+    def test_store_many_generator(self):
+        class Post(mapping.Document):
+            title = mapping.TextField()
+        db = UpdateDatabase()
+        posts = [Post(title='Post %d' % i) for i in range(3)]
+        results = Post.store_many(db, (post for post in posts), batch_size=2)
+        self.assertEqual(len(results), 3)
+        self.assertEqual([doc['title'] for doc in db.updated],
+                         ['Post 0', 'Post 1', 'Post 2'])
+        self.assertEqual(posts[2].dirty_fields, frozenset())
+
+    def test_store_unwrapped_changes(self):
+        class Post(mapping.Document):
+            title = mapping.TextField()
+        db = UpdateDatabase()
+        post = Post.wrap({'_id': 'foo', '_rev': '1-abc', 'title': 'Foo'})
+        post.unwrap()['title'] = 'Bar'
+        post.store(db)
+        self.assertEqual(db.updated, [{'_id': 'foo', '_rev': '1-abc',
+                                       'title': 'Bar'}])
+        post.store(db, skip_unchanged=True)
+        self.assertEqual(len(db.updated), 1)
+
+    def test_store_plain_dict_unchanged(self):
+        class Post(mapping.Document):
+            extra = mapping.DictField()
+        db = UpdateDatabase()
+        post = Post.wrap({'_id': 'foo', '_rev': '1-abc', 'extra': {'a': 1}})
+        post.extra['a']
+        post.store(db, skip_unchanged=True)
+        post.extra['a']
+        post.store(db, skip_unchanged=True)
+        self.assertEqual(len(db.updated), 1)
+        post.extra['a'] = 2
+        post.store(db, skip_unchanged=True)
+        self.assertEqual(db.updated[-1]['extra'], {'a': 2})
+
+    def test_store_partial_with_handler(self):
+        class Post(mapping.Document):
+            title = mapping.TextField()
+        db = UpdateDatabase()
+        post = Post._wrap_partial({'_id': 'foo', '_rev': '1-abc',
+                                   'title': 'Foo'})
+        post.title = 'Bar'
+        post.store(db, handler='test/delta')
+        self.assertEqual(db.updated, [{'set': {'title': 'Bar'}, 'unset': []}])
+        self.assertEqual(post.rev, '2-def')
+
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(testutil.doctest_suite(mapping))
     suite.addTest(unittest.makeSuite(DocumentTestCase, 'test'))
     suite.addTest(unittest.makeSuite(ListFieldTestCase, 'test'))
     suite.addTest(unittest.makeSuite(WrappingTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(StoreTestCase, 'test'))
     return suite
 
 
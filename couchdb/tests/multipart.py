@@ -165,6 +165,93 @@ Content-Type: application/json
             break
 
 
+class IterMultipartTestCase(unittest.TestCase):
+
+    def envelope(self, *parts):
+        body = [b'Content-Type: multipart/mixed; boundary="==1=="\r\n\r\n']
+        for headers, payload in parts:
+            body.append(b'--==1==\r\n' + headers + b'\r\n\r\n' + payload +
+                        b'\r\n')
+        body.append(b'--==1==--\r\n')
+        return StringIO(b''.join(body))
+
+    def test_small_blocks(self):
+        binary = bytes(bytearray(range(256))) * 4 + b'\r\n--==1=\r'
+        fileobj = self.envelope((b'Content-Type: image/png', binary),
+                                (b'Content-Type: text/plain', b''),
+                                (b'Content-Type: text/plain', b'--==1==x'))
+        for blocksize in (1, 7, 4096):
+            fileobj.seek(0)
+            parts = multipart.iter_multipart(fileobj, blocksize=blocksize)
+            self.assertEqual([payload.read() for _, _, payload in parts],
+                             [binary, b'', b'--==1==x'])
+
+    def test_partial_reads(self):
+        fileobj = self.envelope((b'Content-Type: text/plain', b'x' * 100),
+                                (b'Content-Type: text/plain', b'foo'))
+        parts = multipart.iter_multipart(fileobj, blocksize=16)
+        headers, is_multipart, payload = next(parts)
+        self.assertEqual(payload.read(10), b'x' * 10)
+        self.assertEqual(payload.read(95), b'x' * 90)
+        self.assertEqual(payload.read(), b'')
+        headers, is_multipart, payload = next(parts)
+        self.assertEqual(payload.read(2), b'fo')
+        self.assertEqual(list(parts), [])
+
+    def test_truncated(self):
+        data = self.envelope((b'Content-Type: text/plain', b'foo'),
+                             (b'Content-Type: text/plain', b'bar')).getvalue()
+        cut = data.index(b'bar') + 2
+        for blocksize in (1, 16, 4096):
+            parts = multipart.iter_multipart(StringIO(data[:cut]),
+                                             blocksize=blocksize)
+            self.assertEqual([payload.read() for _, _, payload in parts],
+                             [b'foo', b'ba'])
+        parts = multipart.read_multipart(StringIO(data[:cut]))
+        self.assertEqual([payload for _, _, payload in parts], [b'foo', b'ba'])
+
+    def test_skipped_parts(self):
+        fileobj = self.envelope((b'Content-Type: text/plain', b'x' * 100),
+                                (b'Content-Type: text/plain', b'foo'))
+        parts = multipart.iter_multipart(fileobj, blocksize=16)
+        self.assertEqual([payload.read() for _, _, payload in parts][1:],
+                         [b'foo'])
+        fileobj.seek(0)
+        parts = list(multipart.iter_multipart(fileobj, blocksize=16))
+        self.assertEqual(parts[1][2].read(), b'')
+
+    def test_nested(self):
+        nested = (b'--==2==\r\nContent-Type: text/plain\r\n\r\nbar\r\n'
+                  b'--==2==--\r\nepilogue')
+        fileobj = self.envelope(
+            (b'Content-Type: multipart/related; boundary="==2=="', nested),
+            (b'Content-Type: text/plain', b'foo'))
+        parts = multipart.iter_multipart(fileobj, blocksize=5)
+        headers, is_multipart, payload = next(parts)
+        self.assertEqual(is_multipart, True)
+        self.assertEqual([part.read() for _, _, part in payload], [b'bar'])
+        headers, is_multipart, payload = next(parts)
+        self.assertEqual(payload.read(), b'foo')
+
+    def test_content_md5(self):
+        fileobj = self.envelope((b'Content-MD5: rL0Y20zC+Fzt72VPzMSk2A==',
+                                 b'foo'),
+                                (b'Content-MD5: rL0Y20zC+Fzt72VPzMSk2A==',
+                                 b'bar'))
+        parts = multipart.iter_multipart(fileobj)
+        self.assertEqual(next(parts)[2].read(), b'foo')
+        self.assertRaises(ValueError, next(parts)[2].read)
+
+    def test_parse_header(self):
+        self.assertEqual(multipart._parse_header(
+                             'multipart/related; Boundary="a b"'),
+                         ('multipart/related', {'boundary': 'a b'}))
+        self.assertEqual(multipart._parse_header(
+                             "attachment; filename*=utf-8''%C3%A4.txt"),
+                         ('attachment', {'filename': u'\xe4.txt'}))
+        self.assertEqual(multipart._parse_header(''), ('', {}))
+
+
 class WriteMultipartTestCase(unittest.TestCase):
 
     def test_unicode_content(self):
@@ -183,6 +270,67 @@ Iñtërnâtiônàlizætiøn
 --==123456789==--
 '''.encode('utf-8'), buf.getvalue().replace(b'\r\n', b'\n'))
 
+    def test_seekable_content(self):
+        buf = StringIO()
+        envelope = multipart.write_multipart(buf, boundary='==123456789==')
+        content = StringIO(b'xxJust testing')
+        content.seek(2)
+        envelope.add('text/plain', content)
+        envelope.close()
+        self.assertEqual(b'''Content-Type: multipart/mixed; boundary="==123456789=="
+
+--==123456789==
+Content-Length: 12
+Content-MD5: nHmX4a6el41B06x2uCpglQ==
+Content-Type: text/plain
+
+Just testing
+--==123456789==--
+''', buf.getvalue().replace(b'\r\n', b'\n'))
+
+    def test_streamed_content(self):
+        class Stream(object):
+            def __init__(self, data):
+                self.fileobj = StringIO(data)
+            def read(self, size=-1):
+                return self.fileobj.read(size)
+        buf = StringIO()
+        envelope = multipart.write_multipart(buf, boundary='==123456789==')
+        data = b'x' * (multipart.BLOCK_SIZE + 10)
+        envelope.add('text/plain', Stream(data), length=len(data))
+        envelope.add('text/plain', iter([data[:10], data[10:]]))
+        envelope.add('text/plain', iter([]))
+        envelope.close()
+        buf.seek(0)
+        parts = list(multipart.read_multipart(buf))
+        self.assertEqual(parts[0][0]['content-length'], str(len(data)))
+        self.assertFalse('content-md5' in parts[0][0])
+        self.assertFalse('content-length' in parts[1][0])
+        self.assertEqual([payload for _, _, payload in parts],
+                         [data, data, b''])
+
+    def test_streamed_content_length(self):
+        buf = StringIO()
+        envelope = multipart.write_multipart(buf, boundary='==123456789==')
+        self.assertRaises(ValueError, envelope.add, 'text/plain',
+                          iter([b'foo']), length=4)
+
+    def test_buffer_content(self):
+        buf = StringIO()
+        envelope = multipart.write_multipart(buf, boundary='==123456789==')
+        envelope.add('application/octet-stream', bytearray(b'\x00\x01'))
+        envelope.add('application/octet-stream', memoryview(b'foo'))
+        envelope.add('text/plain', None)
+        size = len(buf.getvalue())
+        self.assertRaises(TypeError, envelope.add, 'text/plain', 42)
+        self.assertEqual(len(buf.getvalue()), size)
+        envelope.close()
+        buf.seek(0)
+        parts = list(multipart.read_multipart(buf))
+        self.assertEqual([payload for _, _, payload in parts],
+                         [b'\x00\x01', b'foo', b''])
+        self.assertEqual(parts[0][0]['content-length'], '2')
+
     def test_unicode_content_ascii(self):
         buf = StringIO()
         envelope = multipart.write_multipart(buf, boundary='==123456789==')
@@ -232,6 +380,7 @@ def suite():
     suite = unittest.TestSuite()
     suite.addTest(testutil.doctest_suite(multipart))
     suite.addTest(unittest.makeSuite(ReadMultipartTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(IterMultipartTestCase, 'test'))
     suite.addTest(unittest.makeSuite(WriteMultipartTestCase, 'test'))
     return suite
 
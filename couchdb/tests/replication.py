@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2007-2009 Christopher Lenz
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+
+import threading
+import unittest
+
+from couchdb import http, json, replication
+from couchdb.client import Document
+from couchdb.tests import testutil
+
+
+class MemoryDatabase(object):
+    """Keeps document revisions in memory, with the replication API."""
+
+    def __init__(self, url):
+        self.resource = http.Resource(url, None)
+        self.revs = {}
+        self.local = {}
+        self.seqs = {}
+        self.seq = 0
+        self.lock = threading.Lock()
+        self.requests = []
+
+    def put(self, docid, rev, **fields):
+        self.update([dict(fields, _id=docid, _rev=rev)], new_edits=False)
+
+    def changes(self, since=0, style=None, limit=None):
+        with self.lock:
+            ids = sorted((seq, docid) for docid, seq in self.seqs.items()
+                         if seq > since)[:limit]
+            results = [{'seq': seq, 'id': docid,
+                        'changes': [{'rev': rev} for rev in
+                                    sorted(self.revs[docid])]}
+                       for seq, docid in ids]
+        return {'results': results,
+                'last_seq': results[-1]['seq'] if results else since}
+
+    def revs_diff(self, revs):
+        self.requests.append('_revs_diff')
+        missing = {}
+        for docid, doc_revs in revs.items():
+            known = self.revs.get(docid, {})
+            doc_missing = [rev for rev in doc_revs if rev not in known]
+            if doc_missing:
+                missing[docid] = {'missing': doc_missing}
+        return missing
+
+    def bulk_get(self, docs, **options):
+        self.requests.append('_bulk_get')
+        return [(True, doc['id'], Document(self.revs[doc['id']][doc['rev']]))
+                for doc in docs]
+
+    def get(self, id, default=None, **options):
+        if id.startswith('_local/'):
+            doc = self.local.get(id)
+            return Document(doc) if doc is not None else default
+        self.requests.append('open_revs')
+        return [{'ok': self.revs[id][rev]}
+                for rev in json.decode(options['open_revs'])]
+
+    def save(self, doc):
+        self.local[doc['_id']] = dict(doc)
+
+    def update(self, docs, new_edits=True):
+        self.requests.append('_bulk_docs')
+        assert new_edits is False
+        with self.lock:
+            for doc in docs:
+                self.seq += 1
+                self.revs.setdefault(doc['_id'], {})[doc['_rev']] = dict(doc)
+                self.seqs[doc['_id']] = self.seq
+        return []
+
+
+class ReplicatorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.source = MemoryDatabase('http://source/db')
+        self.target = MemoryDatabase('http://target/db')
+        for num in range(10):
+            self.source.put('doc%d' % num, '1-a', num=num)
+
+    def replicate(self, **options):
+        return replication.Replicator(self.source, self.target,
+                                      **options).replicate()
+
+    def test_replicate(self):
+        stats = self.replicate(batch_size=3)
+        self.assertEqual((stats['docs_read'], stats['docs_written'],
+                          stats['missing_revisions'], stats['last_seq']),
+                         (10, 10, 10, 10))
+        self.assertEqual(self.target.revs, self.source.revs)
+        self.assertEqual(list(self.target.local.values())[0]['last_seq'], 10)
+
+    def test_incremental(self):
+        self.replicate()
+        self.source.put('doc3', '2-b', num=33)
+        self.source.put('doc3', '2-c', num=34) # a conflict
+        self.target.requests = []
+        stats = self.replicate()
+        self.assertEqual(stats['docs_written'], 2)
+        self.assertEqual(sorted(self.target.revs['doc3']),
+                         ['1-a', '2-b', '2-c'])
+        self.assertEqual(self.target.requests, ['_revs_diff', '_bulk_docs'])
+        self.assertEqual(self.replicate()['missing_revisions'], 0)
+
+    def test_serial(self):
+        stats = self.replicate(batch_size=4, concurrency=1)
+        self.assertEqual(stats['docs_written'], 10)
+        self.assertEqual(self.source.requests.count('_bulk_get'), 3)
+
+    def test_open_revs_fallback(self):
+        def bulk_get(docs, **options):
+            raise http.ResourceNotFound(('not_found', 'missing'))
+        self.source.bulk_get = bulk_get
+        stats = self.replicate(batch_size=5, concurrency=1)
+        self.assertEqual(stats['docs_written'], 10)
+        self.assertEqual(self.source.requests.count('open_revs'), 10)
+
+    def test_open_revs_fallback_status(self):
+        def bulk_get(docs, **options):
+            raise http.ServerError((405, ('method_not_allowed', 'Only GET')))
+        self.source.bulk_get = bulk_get
+        self.assertEqual(self.replicate()['docs_written'], 10)
+
+    def test_bulk_get_error(self):
+        def bulk_get(docs, **options):
+            raise http.ServerError((503, ('unavailable', 'busy')))
+        self.source.bulk_get = bulk_get
+        self.assertRaises(http.ServerError, self.replicate, concurrency=1)
+        self.assertEqual(self.source.requests.count('open_revs'), 0)
+
+    def test_error(self):
+        def update(docs, new_edits=True):
+            raise http.ServerError((500, 'boom'))
+        self.target.update = update
+        self.assertRaises(http.ServerError, self.replicate, batch_size=2)
+        self.assertEqual(self.target.local, {})
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(testutil.doctest_suite(replication))
+    suite.addTest(unittest.makeSuite(ReplicatorTestCase, 'test'))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -8,11 +8,20 @@
 #
 
 
+import gzip
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 
 from couchdb.util import StringIO
 from couchdb import Unauthorized
-from couchdb.tools import load, dump
+from couchdb import json
+from couchdb.client import Document, Row
+from couchdb.multipart import read_multipart, write_multipart
+from couchdb.tools import dumpfile, indexes, load, dump, replicate
 from couchdb.tests import testutil
 
 
@@ -36,9 +45,415 @@ class ToolDumpTestCase(testutil.TempDatabaseMixin, unittest.TestCase):
             pass
 
 
+class AttachmentsDatabase(object):
+
+    def __init__(self, attachments):
+        self.attachments = attachments
+
+    def iter_attachments(self, doc, rev=None):
+        for name, stub, data in self.attachments:
+            yield name, stub, StringIO(data)
+
+
+class DumpDocsTestCase(unittest.TestCase):
+
+    def test_attachments(self):
+        compressed = StringIO()
+        with gzip.GzipFile(fileobj=compressed, mode='wb') as fileobj:
+            fileobj.write(b'Foo bar')
+        db = AttachmentsDatabase([
+            ('foo.txt', {'content_type': 'text/plain', 'length': 7,
+                         'encoding': 'gzip'}, compressed.getvalue()),
+            ('bar.bin', {'content_type': 'application/octet-stream',
+                         'length': 2,
+                         'digest': 'md5-RBB3zJ5XVU3Udr37i4uBAg=='}, b'\x00\x01')
+        ])
+        doc = Document(_id='foo', _rev='1-abc',
+                       _attachments=dict((name, stub) for name, stub, _
+                                         in db.attachments))
+        output = StringIO()
+        envelope = write_multipart(output)
+        dump.dump_docs(envelope, db, [doc])
+        envelope.close()
+        output.seek(0)
+        headers, is_multipart, parts = next(read_multipart(output))
+        parts = [(headers, payload) for headers, _, payload in parts]
+        self.assertEqual([payload for _, payload in parts][1:],
+                         [b'Foo bar', b'\x00\x01'])
+        self.assertEqual(parts[2][0]['content-md5'],
+                         'RBB3zJ5XVU3Udr37i4uBAg==')
+
+
+class DumpFileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'dump')
+        db = AttachmentsDatabase([('foo.txt', {'content_type': 'text/plain',
+                                               'length': 3}, b'foo')])
+        docs = [Document(_id='doc%02d' % num, _rev='1-abc', num=num)
+                for num in range(20)]
+        docs[5]['_attachments'] = {'foo.txt': {}}
+        with open(self.path, 'wb') as fileobj:
+            envelope = dumpfile.DumpWriter(fileobj, block_size=200)
+            dump.dump_docs(envelope, db, docs)
+            envelope.close()
+            self.blocks = len(set(offset for _, offset in envelope.index))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def ids(self, parts):
+        return [headers['content-id'] for headers, _, _ in parts]
+
+    def test_read_all(self):
+        self.assertTrue(self.blocks > 1)
+        ids = []
+        with open(self.path, 'rb') as fileobj:
+            self.assertTrue(dumpfile.is_dump_file(fileobj))
+            for headers, is_multipart, payload in dumpfile.read_dump(fileobj):
+                ids.append(headers['content-id'])
+                if is_multipart:
+                    self.assertEqual([part for _, _, part in payload][1:],
+                                     [b'foo'])
+        self.assertEqual(ids, ['doc%02d' % num for num in range(20)])
+
+    def test_read_selected(self):
+        with open(self.path, 'rb') as fileobj:
+            parts = dumpfile.read_dump(fileobj, ids=['doc17', 'doc03', 'x'])
+            self.assertEqual(self.ids(parts), ['doc03', 'doc17'])
+            parts = dumpfile.read_dump(fileobj, start='doc08', end='doc11')
+            self.assertEqual(self.ids(parts),
+                             ['doc08', 'doc09', 'doc10', 'doc11'])
+            fileobj.seek(0)
+            data = StringIO(fileobj.read())
+        self.assertEqual(self.ids(dumpfile.read_dump(data, start='doc19')),
+                         ['doc19'])
+
+    def test_sniff_stream(self):
+        class Stream(object):
+            def __init__(self, data):
+                self.fileobj = StringIO(data)
+            def read(self, size=-1):
+                return self.fileobj.read(size)
+        with open(self.path, 'rb') as fileobj:
+            data = fileobj.read()
+        is_dump, fileobj = dumpfile.sniff_dump_file(Stream(data))
+        self.assertTrue(is_dump)
+        self.assertEqual(len(self.ids(dumpfile.read_dump(fileobj))), 20)
+        output = StringIO()
+        envelope = write_multipart(output)
+        envelope.add('application/json', '{}', {'Content-ID': 'foo'})
+        envelope.close()
+        is_dump, fileobj = dumpfile.sniff_dump_file(
+            Stream(output.getvalue()))
+        self.assertFalse(is_dump)
+        self.assertEqual(self.ids(read_multipart(fileobj)), ['foo'])
+
+    def test_sniff_short_reads(self):
+        class Trickle(object):
+            # A pipe returning and buffering only a few bytes at a time
+            def __init__(self, data):
+                self.fileobj = StringIO(data)
+            def read(self, size=-1):
+                return self.fileobj.read(3 if size < 0 else min(size, 3))
+        class PeekTrickle(Trickle):
+            def peek(self, size=0):
+                pos = self.fileobj.tell()
+                data = self.fileobj.read(3)
+                self.fileobj.seek(pos)
+                return data
+        with open(self.path, 'rb') as fileobj:
+            data = fileobj.read()
+        for cls in (Trickle, PeekTrickle):
+            is_dump, fileobj = dumpfile.sniff_dump_file(cls(data))
+            self.assertTrue(is_dump)
+            self.assertEqual(len(self.ids(dumpfile.read_dump(fileobj))), 20)
+        self.assertRaises(ValueError, dumpfile.is_dump_file, PeekTrickle(data))
+        self.assertFalse(dumpfile.is_dump_file(PeekTrickle(b'Content')))
+
+    def test_not_dump_file(self):
+        self.assertFalse(dumpfile.is_dump_file(StringIO(b'Content-Type: ')))
+        self.assertRaises(ValueError, dumpfile.DumpWriter, StringIO(),
+                          compression='lzma')
+
+
+class DeltaDatabase(object):
+    """Keeps documents in memory, with a changes feed and bulk updates."""
+
+    def __init__(self):
+        self.docs = {}
+        self.seqs = {}
+        self.seq = 0
+
+    def update(self, docs):
+        results = []
+        for doc in docs:
+            current = self.docs.get(doc['_id'])
+            if current is not None and not current.get('_deleted') and \
+                    doc.get('_rev') != current['_rev']:
+                results.append((False, doc['_id'], ValueError('conflict')))
+                continue
+            self.seq += 1
+            doc = dict(doc, _rev='%d-abc' % self.seq)
+            self.docs[doc['_id']] = doc
+            self.seqs[doc['_id']] = self.seq
+            results.append((True, doc['_id'], doc['_rev']))
+        return results
+
+    def changes(self, since=0, include_docs=False, style=None, limit=None):
+        ids = sorted((seq, docid) for docid, seq in self.seqs.items()
+                     if seq > since)[:limit]
+        results = [{'seq': seq, 'id': docid, 'doc': dict(self.docs[docid])}
+                   for seq, docid in ids]
+        return {'results': results,
+                'last_seq': results[-1]['seq'] if results else since}
+
+    def view(self, name, keys=None):
+        for key in keys:
+            doc = self.docs.get(key)
+            if doc is None:
+                yield Row(key=key, error='not_found')
+            else:
+                yield Row(id=key, key=key, value={
+                    'rev': doc['_rev'], 'deleted': doc.get('_deleted', False)
+                })
+
+
+class DeltaDumpTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.source = DeltaDatabase()
+        self.source.update([{'_id': 'foo', 'num': 1},
+                            {'_id': 'bar', 'num': 2}])
+        self.target = DeltaDatabase()
+        self.target.update([dict(doc) for doc in self.source.docs.values()])
+
+    def dump(self, since):
+        output = StringIO()
+        envelope = write_multipart(output)
+        last_seq = dump.dump_changes(envelope, self.source, since,
+                                     bulk_size=1)
+        envelope.close()
+        output.seek(0)
+        return last_seq, [json.decode(payload) for _, _, payload
+                          in read_multipart(output)]
+
+    def test_dump_changes(self):
+        self.source.update([dict(self.source.docs['foo'], num=3),
+                            {'_id': 'baz', 'num': 4}])
+        last_seq, docs = self.dump(2)
+        self.assertEqual(last_seq, 4)
+        self.assertEqual([(doc['_id'], doc['num']) for doc in docs],
+                         [('foo', 3), ('baz', 4)])
+        self.assertEqual(self.dump(last_seq), (4, []))
+
+    def test_apply_deltas(self):
+        self.source.update([dict(self.source.docs['foo'], num=3),
+                            dict(self.source.docs['bar'], _deleted=True),
+                            {'_id': 'baz', 'num': 4}])
+        _, docs = self.dump(2)
+        load.apply_deltas(self.target, docs)
+        self.assertEqual(self.target.docs['foo']['num'], 3)
+        self.assertEqual(self.target.docs['bar']['_deleted'], True)
+        self.assertEqual(self.target.docs['baz']['num'], 4)
+
+    def test_apply_duplicate_deltas(self):
+        foo = self.source.docs['foo']
+        load.apply_deltas(self.target, [dict(foo, num=3), dict(foo, num=5)])
+        self.assertEqual(self.target.docs['foo']['num'], 5)
+
+
+class ReplicateServer(object):
+    """Records replications, keeping track of how many run at a time."""
+
+    def __init__(self, names):
+        self.names = set(names)
+        self.lock = threading.Lock()
+        self.running = self.max_running = 0
+        self.replicated = []
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def create(self, name):
+        self.names.add(name)
+
+    def replicate(self, source, target, **options):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(0.05)
+        with self.lock:
+            self.running -= 1
+            self.replicated.append((source, target))
+        return {'ok': True, 'history': [{'docs_written': 10}]}
+
+    def tasks(self):
+        return [{'type': 'replication', 'docs_written': 5}]
+
+
+class ReplicateTestCase(unittest.TestCase):
+
+    def test_concurrency(self):
+        server = ReplicateServer(['db0'])
+        databases = [('db%d' % num, 'db%d' % num) for num in range(6)]
+        docs = replicate.replicate_databases(server, 'http://source/',
+                                             databases, concurrency=3,
+                                             interval=0.01)
+        self.assertEqual(docs, 60)
+        self.assertEqual(server.max_running, 3)
+        self.assertEqual(sorted(server.replicated),
+                         [('http://source/db%d' % num, 'db%d' % num)
+                          for num in range(6)])
+        self.assertEqual(len(server.names), 6)
+
+    def test_serial(self):
+        server = ReplicateServer([])
+        docs = replicate.replicate_databases(server, 'http://source/',
+                                             [('a', 'b'), ('c', 'd')])
+        self.assertEqual(docs, 20)
+        self.assertEqual(server.max_running, 1)
+        self.assertEqual(server.replicated, [('http://source/a', 'b'),
+                                             ('http://source/c', 'd')])
+
+
+class Output(object):
+
+    def __init__(self, lines):
+        self.write = lines.append
+
+
+class IndexList(list):
+
+    def __setitem__(self, ddoc_name, index):
+        self.append(index)
+
+
+class IndexDatabase(object):
+    """Answers mango queries from the indexes created on it."""
+
+    def __init__(self):
+        self.indexes = IndexList()
+        self.found = []
+
+    def index(self):
+        return self.indexes
+
+    def _index(self, query):
+        fields = indexes.index_fields(query)
+        for index in self.indexes:
+            if index == fields:
+                return {'ddoc': '_design/auto', 'name': 'by-fields',
+                        'type': 'json'}
+        return {'ddoc': None, 'name': '_all_docs', 'type': 'special'}
+
+    def explain(self, query):
+        return {'index': self._index(query), 'selector': query['selector']}
+
+    def find(self, query):
+        self.found.append(query)
+        return []
+
+    def iterfind(self, query, batch):
+        self.found.append(query)
+        if self._index(query)['type'] == 'special':
+            time.sleep(0.01)
+        return iter([{}] * 3)
+
+
+class IndexPlanTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = IndexDatabase()
+        self.queries = [
+            {'selector': {'type': 'Person', 'age': {'$gte': 21}},
+             'sort': [{'name': 'desc'}]},
+            {'selector': {'_id': {'$gt': 'a'}}},
+            {'selector': {'$or': [{'a': 1}, {'b': 2}]}},
+            {'selector': {'$and': [{'type': 'Person'}, {'age': {'$gte': 30}}]},
+             'sort': ['name']},
+            {'selector': {'address': {'city': 'Gotham'}}},
+        ]
+
+    def test_index_fields(self):
+        self.assertEqual(indexes.index_fields(self.queries[0]),
+                         [{'type': 'desc'}, {'name': 'desc'}, {'age': 'desc'}])
+        self.assertEqual(indexes.index_fields(self.queries[1]), None)
+        self.assertEqual(indexes.index_fields(self.queries[4]),
+                         [{'address.city': 'asc'}])
+
+    def test_index_sort(self):
+        self.assertEqual(indexes.index_sort(self.queries[0]),
+                         [{'type': 'desc'}, {'name': 'desc'}])
+        self.assertEqual(indexes.index_sort(self.queries[3]),
+                         [{'type': 'asc'}, {'name': 'asc'}])
+        self.assertEqual(indexes.index_sort(self.queries[4]), None)
+        query = {'selector': {'type': 'Person'},
+                 'sort': [{'type': 'asc'}, {'name': 'asc'}]}
+        self.assertEqual(indexes.index_sort(query), None)
+
+    def test_full_scan(self):
+        special = {'type': 'special', 'name': '_all_docs'}
+        self.assertTrue(indexes.is_full_scan({
+            'index': special, 'selector': {'_id': {'$gt': None}},
+            'mrargs': {'start_key': None, 'end_key': '<MAX>'}}))
+        self.assertFalse(indexes.is_full_scan({
+            'index': special, 'selector': {'_id': {'$gt': 'a'}},
+            'mrargs': {'start_key': 'a', 'end_key': '<MAX>'}}))
+        self.assertFalse(indexes.is_full_scan({
+            'index': {'type': 'json'}, 'selector': {'type': 'Person'}}))
+
+    def test_plan(self):
+        results = indexes.plan_queries(self.db, self.queries)
+        self.assertEqual([result['full_scan'] for result in results],
+                         [True, False, True, True, True])
+        self.assertEqual(results[2]['fields'], None)
+        self.assertEqual(self.db.indexes, [])
+        self.assertEqual(self.db.found, [])
+
+    def test_create(self):
+        results = indexes.plan_queries(self.db, self.queries, create=True,
+                                       repeat=2)
+        self.assertEqual(self.db.indexes, [
+            [{'type': 'desc'}, {'name': 'desc'}, {'age': 'desc'}],
+            [{'type': 'asc'}, {'name': 'asc'}, {'age': 'asc'}],
+            [{'address.city': 'asc'}],
+        ])
+        self.assertEqual([result['created'] for result in results],
+                         [True, False, False, True, True])
+        for result in results[0], results[3]:
+            self.assertEqual(result['index']['type'], 'json')
+            self.assertTrue(result['before'] > result['after'])
+            self.assertEqual(result['results'], 3)
+        self.assertEqual(results[2]['before'], None)
+
+        output = []
+        indexes.print_report(results, Output(output))
+        lines = ''.join(output).splitlines()
+        self.assertEqual(len(lines), 5)
+        self.assertTrue(lines[0].startswith('query 1: _design/auto/by-fields,'
+                                            ' full scan, index on '))
+        self.assertTrue(', which needs sort [{"type": "desc"}, '
+                        '{"name": "desc"}] (created)' in lines[0])
+        self.assertTrue(lines[0].endswith('s for all 3 results'))
+        # the query is timed after creating the index with the needed sort
+        self.assertTrue(dict(self.queries[0], sort=[{'type': 'desc'},
+                                                    {'name': 'desc'}])
+                        in self.db.found)
+        self.assertEqual(lines[2], 'query 3: _all_docs, full scan, '
+                                   'no index can help')
+
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(ToolLoadTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(DumpDocsTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(DumpFileTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(DeltaDumpTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(ReplicateTestCase, 'test'))
+    suite.addTest(testutil.doctest_suite(indexes))
+    suite.addTest(unittest.makeSuite(IndexPlanTestCase, 'test'))
     return suite
 
 
@@ -12,16 +12,25 @@ file.
 """
 
 from __future__ import print_function
-from base64 import b64decode
 from optparse import OptionParser
 import sys
+import zlib
 
 from couchdb import __version__ as VERSION
 from couchdb import json
-from couchdb.client import Database
-from couchdb.multipart import write_multipart
+from couchdb.client import Database, Document
+from couchdb.multipart import BLOCK_SIZE, write_multipart
+from couchdb.tools.dumpfile import COMPRESSIONS, DumpWriter
 
 BULK_SIZE = 1000
+CHECKPOINT_ID = '_checkpoint'
+
+
+def _gunzip(fileobj):
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for block in iter(lambda: fileobj.read(BLOCK_SIZE), b''):
+        yield decompressor.decompress(block)
+    yield decompressor.flush()
 
 def dump_docs(envelope, db, docs):
     for doc in docs:
@@ -36,18 +45,19 @@ def dump_docs(envelope, db, docs):
                 'ETag': '"%s"' % doc.rev
             })
             parts.add('application/json', jsondoc)
-            for name, info in attachments.items():
+            for name, info, content in db.iter_attachments(doc, rev=doc.rev):
 
                 content_type = info.get('content_type')
                 if content_type is None: # CouchDB < 0.8
                     content_type = info.get('content-type')
 
-                if 'data' not in info:
-                    data = db.get_attachment(doc, name).read()
-                else:
-                    data = b64decode(info['data'])
-
-                parts.add(content_type, data, {'Content-ID': name})
+                headers = {'Content-ID': name}
+                if info.get('encoding') == 'gzip':
+                    content = _gunzip(content)
+                elif info.get('digest', '').startswith('md5-'):
+                    headers['Content-MD5'] = info['digest'][4:]
+                parts.add(content_type, content, headers,
+                          length=info.get('length'))
 
             parts.close()
 
@@ -57,8 +67,19 @@ def dump_docs(envelope, db, docs):
                 'ETag': '"%s"' % doc.rev
             })
 
+def dump_changes(envelope, db, since, bulk_size=BULK_SIZE):
+    while True:
+        changes = db.changes(since=since, include_docs=True,
+                             style='all_docs', limit=bulk_size)
+        results = changes['results']
+        dump_docs(envelope, db, (Document(change['doc'])
+                                 for change in results if 'doc' in change))
+        since = changes['last_seq']
+        if len(results) < bulk_size:
+            return since
+
 def dump_db(dburl, username=None, password=None, boundary=None,
-            output=None, bulk_size=BULK_SIZE):
+            output=None, bulk_size=BULK_SIZE, compression=None, since=None):
 
     if output is None:
         output = sys.stdout if sys.version_info[0] < 3 else sys.stdout.buffer
@@ -67,15 +88,29 @@ def dump_db(dburl, username=None, password=None, boundary=None,
     if username is not None and password is not None:
         db.resource.credentials = username, password
 
-    envelope = write_multipart(output, boundary=boundary)
-    start, num = 0, db.info()['doc_count']
-    while start < num:
-        opts = {'limit': bulk_size, 'skip': start, 'include_docs': True}
-        docs = (row.doc for row in db.view('_all_docs', **opts))
-        dump_docs(envelope, db, docs)
-        start += bulk_size
+    if compression is not None:
+        envelope = DumpWriter(output, compression, boundary=boundary)
+    else:
+        envelope = write_multipart(output, boundary=boundary)
+    if since is not None:
+        last_seq = dump_changes(envelope, db, since, bulk_size=bulk_size)
+        envelope.add('application/json', json.encode({
+            'since': since,
+            'last_seq': last_seq
+        }), {'Content-ID': CHECKPOINT_ID})
+    else:
+        info = db.info()
+        last_seq = info['update_seq']
+        start, num = 0, info['doc_count']
+        while start < num:
+            opts = {'limit': bulk_size, 'skip': start, 'include_docs': True}
+            docs = (row.doc for row in db.view('_all_docs', **opts))
+            dump_docs(envelope, db, docs)
+            start += bulk_size
 
     envelope.close()
+    print('Dumped up to sequence %s' % last_seq, file=sys.stderr)
+    return last_seq
 
 
 def main():
@@ -90,6 +125,14 @@ def main():
     parser.add_option('-b', '--bulk-size', action='store', dest='bulk_size',
                       type='int', default=BULK_SIZE,
                       help='number of docs retrieved from database')
+    parser.add_option('-c', '--compress', action='store', dest='compression',
+                      type='choice', choices=COMPRESSIONS,
+                      help='write a compressed and indexed dump file, using '
+                           '"gzip" or "zstd" compression')
+    parser.add_option('-s', '--since', action='store', dest='since',
+                      metavar='SEQ',
+                      help='only dump the documents changed or deleted after '
+                           'the given update sequence')
     parser.set_defaults()
     options, args = parser.parse_args()
 
@@ -100,7 +143,8 @@ def main():
         json.use(options.json_module)
 
     dump_db(args[0], username=options.username, password=options.password,
-            bulk_size=options.bulk_size)
+            bulk_size=options.bulk_size, compression=options.compression,
+            since=options.since)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2007-2009 Christopher Lenz
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+
+"""Compressed and indexed container format for database dumps.
+
+A dump file starts with a line identifying the format and the compression
+used, followed by blocks that each hold a multipart MIME envelope with a
+number of documents, compressed independently of each other. After the
+blocks comes an index mapping each document ID to the offset of its block,
+and finally the offset of the index. The file can thus be read sequentially
+from a pipe, or documents can be picked out of it without decompressing the
+rest.
+"""
+
+import bisect
+import mmap
+import struct
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from couchdb import json
+from couchdb.multipart import BLOCK_SIZE, MultipartWriter, read_multipart
+
+__all__ = ['DumpWriter', 'is_dump_file', 'read_dump', 'sniff_dump_file']
+__docformat__ = 'restructuredtext en'
+
+
+MAGIC = b'\x89COUCHDUMP'
+COMPRESSIONS = ('gzip', 'zstd')
+DUMP_BLOCK_SIZE = 4 * 1024 * 1024
+
+_FOOTER = struct.Struct('>Q')
+_BLOCK, _INDEX = b'B', b'I'
+
+
+def _compressor(compression):
+    if compression == 'gzip':
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif compression == 'zstd':
+        return _zstandard().ZstdCompressor().compressobj()
+    raise ValueError('unsupported compression %r' % compression)
+
+
+def _decompressor(compression):
+    if compression == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif compression == 'zstd':
+        return _zstandard().ZstdDecompressor().decompressobj()
+    raise ValueError('unsupported compression %r' % compression)
+
+
+def _zstandard():
+    if zstandard is None:
+        raise ValueError('zstd compression requires the zstandard package')
+    return zstandard
+
+
+class DumpWriter(object):
+    """Writes a compressed and indexed dump file.
+
+    This class provides the ``open()``, ``add()`` and ``close()`` methods of
+    `MultipartWriter`, so that it can be used in place of the envelope
+    returned by `write_multipart`. Every top-level part is expected to be a
+    document, with its ID in the ``Content-ID`` header.
+
+    :param fileobj: a writable file-like object, which doesn't need to be
+                    seekable
+    :param compression: the compression to use, ``'gzip'`` or ``'zstd'``
+    :param block_size: the number of uncompressed bytes after which a new
+                       block is started
+    :param boundary: the boundary to use for the envelope of every block
+    :since: 1.3
+    """
+
+    def __init__(self, fileobj, compression='gzip', block_size=DUMP_BLOCK_SIZE,
+                 boundary=None):
+        _compressor(compression) # check early that it is supported
+        self.fileobj = fileobj
+        self.compression = compression
+        self.block_size = block_size
+        self.boundary = boundary
+        self.offset = 0
+        self.index = []
+        self._block = self._envelope = None
+        self._write(MAGIC + b' ' + compression.encode('ascii') + b'\n')
+
+    def _write(self, data):
+        if data:
+            self.fileobj.write(data)
+            self.offset += len(data)
+
+    def _start_part(self, headers):
+        if self._block is not None and self._block.size >= self.block_size:
+            self._end_block()
+        if self._block is None:
+            self._block_offset = self.offset
+            self._write(_BLOCK)
+            self._block = _BlockWriter(self, _compressor(self.compression))
+            self._envelope = MultipartWriter(self._block,
+                                             boundary=self.boundary)
+        if headers and 'Content-ID' in headers:
+            self.index.append((headers['Content-ID'], self._block_offset))
+        return self._envelope
+
+    def _end_block(self):
+        self._envelope.close()
+        self._write(self._block.compressor.flush())
+        self._block = self._envelope = None
+
+    def open(self, headers=None, subtype='mixed', boundary=None):
+        return self._start_part(headers).open(headers, subtype=subtype,
+                                              boundary=boundary)
+
+    def add(self, mimetype, content, headers=None, length=None):
+        self._start_part(headers).add(mimetype, content, headers,
+                                      length=length)
+
+    def close(self):
+        if self._block is not None:
+            self._end_block()
+        index_offset = self.offset
+        self._write(_INDEX)
+        compressor = _compressor(self.compression)
+        index = json.encode(sorted(self.index)).encode('utf-8')
+        self._write(compressor.compress(index))
+        self._write(compressor.flush())
+        self._write(_FOOTER.pack(index_offset) + MAGIC)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class _BlockWriter(object):
+
+    def __init__(self, writer, compressor):
+        self.writer = writer
+        self.compressor = compressor
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        self.writer._write(self.compressor.compress(data))
+
+
+class _Input(object):
+    """Reads from a file-like object, allowing data to be pushed back."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.pending = b''
+
+    def read(self, size):
+        if self.pending:
+            data, self.pending = self.pending[:size], self.pending[size:]
+            return data
+        return self.fileobj.read(size)
+
+    def readline(self):
+        line = b''
+        while not line.endswith(b'\n'):
+            char = self.read(1)
+            if not char:
+                break
+            line += char
+        return line
+
+    def unread(self, data):
+        self.pending = data + self.pending
+
+
+class _BlockReader(object):
+    """File-like object decompressing a single block."""
+
+    def __init__(self, input, compression):
+        self.input = input
+        self.decompressor = _decompressor(compression)
+        self.buf = b''
+        self.eof = False
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b''.join(iter(lambda: self.read(BLOCK_SIZE), b''))
+        while not self.buf and not self.eof:
+            data = self.input.read(BLOCK_SIZE)
+            if not data:
+                raise ValueError('unexpected end of dump file')
+            self.buf = self.decompressor.decompress(data)
+            if self.decompressor.unused_data or \
+                    getattr(self.decompressor, 'eof', False):
+                self.eof = True
+                self.input.unread(self.decompressor.unused_data)
+        chunk, self.buf = self.buf[:size], self.buf[size:]
+        return chunk
+
+    def close(self):
+        while self.read(BLOCK_SIZE):
+            pass
+
+
+def _seekable(fileobj):
+    try:
+        fileobj.seek(fileobj.tell())
+    except (AttributeError, IOError, ValueError):
+        return False
+    return True
+
+
+def _read_fully(fileobj, size):
+    # A single read from a pipe or socket may return fewer bytes than asked
+    # for before the end of the stream
+    data = b''
+    while len(data) < size:
+        chunk = fileobj.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def _peek(fileobj, size):
+    # Return the next `size` bytes without consuming them, or fewer at the
+    # end of the file. A ``peek()`` only returns what is buffered, which
+    # may be less, so only seekable files can then be read further.
+    if hasattr(fileobj, 'peek'):
+        data = fileobj.peek(size)[:size]
+        if len(data) == size or not data or not _seekable(fileobj):
+            return data
+    pos = fileobj.tell()
+    data = _read_fully(fileobj, size)
+    fileobj.seek(pos)
+    return data
+
+
+def is_dump_file(fileobj):
+    """Return whether the file-like object is positioned at the start of a
+    compressed dump file, without consuming any of it.
+
+    The file needs to be either seekable or have a ``peek()`` method, like
+    buffered binary files, including standard input. If ``peek()`` returns
+    only the start of the magic header of a stream that isn't seekable,
+    the format can't be told without consuming data, which raises a
+    `ValueError`; use `sniff_dump_file` for such streams.
+
+    :param fileobj: a file-like object
+    :rtype: `bool`
+    :since: 1.3
+    """
+    head = _peek(fileobj, len(MAGIC))
+    if len(head) < len(MAGIC) and head and MAGIC.startswith(head) and \
+            not _seekable(fileobj):
+        raise ValueError('not enough data buffered to check for a dump file')
+    return head == MAGIC
+
+
+def sniff_dump_file(fileobj):
+    """Return whether the file-like object is positioned at the start of a
+    compressed dump file, along with the file-like object to read the file
+    from instead.
+
+    Unlike `is_dump_file`, this also works for files that are neither
+    seekable nor have a ``peek()`` method, such as sockets, and for streams
+    whose ``peek()`` returns less than the magic header. The bytes read
+    from those to check the format are put back in front of the rest of
+    the file in the file-like object returned.
+
+    :param fileobj: a binary file-like object
+    :return: a ``(is_dump, fileobj)`` tuple
+    :rtype: `tuple`
+    :since: 1.3
+    """
+    if hasattr(fileobj, 'peek'):
+        head = fileobj.peek(len(MAGIC))[:len(MAGIC)]
+        if len(head) == len(MAGIC) or not MAGIC.startswith(head) or not head:
+            return head == MAGIC, fileobj
+    if _seekable(fileobj):
+        return is_dump_file(fileobj), fileobj
+    input = _Input(fileobj)
+    head = _read_fully(fileobj, len(MAGIC))
+    input.unread(head)
+    return head == MAGIC, input
+
+
+def _read_compression(fileobj):
+    header = fileobj.readline()
+    if not header.startswith(MAGIC):
+        raise ValueError('not a compressed dump file')
+    return header[len(MAGIC):].strip().decode('ascii')
+
+
+def read_dump(fileobj, ids=None, start=None, end=None):
+    """Read the documents in a compressed dump file.
+
+    This function yields the same ``(headers, is_multipart, payload)`` tuples
+    as `read_multipart` for every document in the dump. Without further
+    arguments, the file is read sequentially. If `ids` or an ID range are
+    given, only the blocks containing the requested documents are read,
+    which requires a seekable file, and uses ``mmap`` for regular files.
+
+    :param fileobj: a binary file-like object
+    :param ids: a collection of the IDs of the documents to read
+    :param start: the lowest ID of the documents to read
+    :param end: the highest ID of the documents to read
+    :return: an iterator over the documents
+    :since: 1.3
+    """
+    if ids is None and start is None and end is None:
+        return _read_all(fileobj)
+    return _read_selected(fileobj, ids, start, end)
+
+
+def _read_all(fileobj):
+    compression = _read_compression(fileobj)
+    input = _Input(fileobj)
+    while input.read(1) == _BLOCK:
+        block = _BlockReader(input, compression)
+        for part in read_multipart(block):
+            yield part
+        block.close()
+
+
+def _read_selected(fileobj, ids, start, end):
+    try:
+        data = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, IOError, ValueError):
+        data = fileobj
+    try:
+        for part in _read_indexed(data, ids, start, end):
+            yield part
+    finally:
+        if data is not fileobj:
+            data.close()
+
+
+def _read_indexed(data, ids, start, end):
+    data.seek(0)
+    compression = _read_compression(data)
+    data.seek(-(_FOOTER.size + len(MAGIC)), 2)
+    footer = data.read(_FOOTER.size + len(MAGIC))
+    if footer[_FOOTER.size:] != MAGIC:
+        raise ValueError('dump file has no index')
+    data.seek(_FOOTER.unpack(footer[:_FOOTER.size])[0] + len(_INDEX))
+    index = json.decode(_BlockReader(_Input(data), compression).read()
+                        .decode('utf-8'))
+
+    keys = [docid for docid, _ in index]
+    lo = 0 if start is None else bisect.bisect_left(keys, start)
+    hi = len(keys) if end is None else bisect.bisect_right(keys, end)
+    wanted = set(keys[lo:hi])
+    if ids is not None:
+        wanted &= set(ids)
+
+    offsets = sorted(set(offset for docid, offset in index[lo:hi]
+                         if docid in wanted))
+    for offset in offsets:
+        data.seek(offset + len(_BLOCK))
+        for headers, is_multipart, payload in read_multipart(
+                _BlockReader(_Input(data), compression)):
+            if headers.get('content-id') in wanted:
+                yield headers, is_multipart, payload
@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2007-2009 Christopher Lenz
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+
+"""Utility for finding mango queries that scan all documents of a database,
+and for creating indexes that let CouchDB answer them from an index instead.
+
+The queries are read from a file holding a JSON list of mango queries, such
+as the ones an application sends. Every query is explained by the server;
+those answered by the special ``_all_docs`` index get an index proposed over
+the fields they select and sort by, and are timed before and after the index
+is created when the ``--create`` option is given. The timings are for
+retrieving all results of a query, paging through them with bookmarks, rather
+than for the first page that ``_find`` returns by default. CouchDB only uses
+an index to sort if the query sorts by a prefix of the index fields, so for
+queries that sort, the report also shows the sort to use with the index.
+"""
+
+from __future__ import print_function
+from optparse import OptionParser
+import sys
+import time
+
+from couchdb import __version__ as VERSION
+from couchdb import json
+from couchdb.client import Database
+
+REPEAT = 3
+BATCH = 1000
+
+_EQUALITY = '$eq'
+_RANGE = frozenset(['$gt', '$gte', '$lt', '$lte', '$in', '$exists'])
+
+
+def _selector_fields(selector, prefix='', fields=None):
+    """Collect ``(field, kind)`` pairs for the fields of a selector that an
+    index can be used for, where kind is ``'eq'`` or ``'range'``.
+    """
+    if fields is None:
+        fields = []
+    for key, value in selector.items():
+        if key == '$and':
+            for item in value:
+                _selector_fields(item, prefix, fields)
+        elif key.startswith('$'):
+            continue # $or, $nor, $not etc. can't be answered by a json index
+        elif isinstance(value, dict) and value and \
+                not any(op.startswith('$') for op in value):
+            _selector_fields(value, prefix + key + '.', fields)
+        elif not isinstance(value, dict):
+            fields.append((prefix + key, 'eq'))
+        elif _EQUALITY in value:
+            fields.append((prefix + key, 'eq'))
+        elif _RANGE.intersection(value) and value.get('$exists') is not False:
+            fields.append((prefix + key, 'range'))
+    return fields
+
+
+def _plan_index(query):
+    # Return the fields of the index for the query, and the number of them
+    # that the query needs to sort by to use the index
+    selected = _selector_fields(query.get('selector', {}))
+    direction = 'asc'
+    sort = []
+    for item in query.get('sort', []):
+        if isinstance(item, dict):
+            (field, direction), = item.items()
+        else:
+            field = item
+        sort.append(field)
+
+    fields = []
+    for field in [field for field, kind in selected if kind == 'eq'] + sort:
+        if field not in fields:
+            fields.append(field)
+    sorted_by = len(fields) if sort else 0
+    for field, kind in selected:
+        if kind == 'range' and field not in fields:
+            fields.append(field)
+    if not fields or fields == ['_id']:
+        return None, 0
+    return [{field: direction} for field in fields], sorted_by
+
+
+def index_fields(query):
+    """Return the fields of an index for the given mango query, as a list in
+    the format expected by `Indexes.__setitem__`, or `None` if the query
+    doesn't select or sort by any field an index can be used for.
+
+    The fields that the selector compares for equality come first, followed
+    by the fields to sort by, and then the fields the selector compares with
+    a range, so that the rows of the index matching the query are adjacent.
+    CouchDB only uses an index for sorting if the fields to sort by are a
+    prefix of the index fields, so a query that sorts needs to sort by the
+    equality fields first, as returned by `index_sort`.
+
+    >>> index_fields({'selector': {'type': 'Person', 'age': {'$gt': 21}},
+    ...               'sort': [{'name': 'asc'}]})
+    [{'type': 'asc'}, {'name': 'asc'}, {'age': 'asc'}]
+    >>> index_fields({'selector': {'$or': [{'a': 1}, {'b': 2}]}}) is None
+    True
+
+    :param query: the mango query
+    :rtype: `list`
+    """
+    return _plan_index(query)[0]
+
+
+def index_sort(query):
+    """Return the sort the given mango query needs to use the index returned
+    by `index_fields`, or `None` if the query doesn't sort or its sort can
+    be used as it is.
+
+    As the fields compared for equality only have a single value in the
+    results, sorting by them first doesn't change the order of the results.
+
+    >>> index_sort({'selector': {'type': 'Person', 'age': {'$gt': 21}},
+    ...             'sort': [{'name': 'asc'}]})
+    [{'type': 'asc'}, {'name': 'asc'}]
+    >>> index_sort({'selector': {'name': {'$gt': 'A'}},
+    ...             'sort': ['name']}) is None
+    True
+
+    :param query: the mango query
+    :rtype: `list`
+    """
+    fields, sorted_by = _plan_index(query)
+    if not fields or not sorted_by:
+        return None
+    sort = fields[:sorted_by]
+    current = [item if isinstance(item, dict) else {item: 'asc'}
+               for item in query['sort']]
+    return None if sort == current else sort
+
+
+def is_full_scan(explanation):
+    """Return whether the server answers an explained mango query by reading
+    all documents of the database.
+
+    :param explanation: the result of `Database.explain` for the query
+    :rtype: `bool`
+    """
+    index = explanation.get('index', {})
+    if index.get('type') != 'special':
+        return False
+    # _all_docs is also used for selecting by document ID, which only reads
+    # the requested range of it
+    mrargs = explanation.get('mrargs')
+    if mrargs is not None:
+        return mrargs.get('start_key') is None and \
+            mrargs.get('end_key') in (None, '<MAX>')
+    return '_id' not in [field for field, _ in
+                         _selector_fields(explanation.get('selector', {}))]
+
+
+def time_query(db, query, repeat=REPEAT, batch=BATCH):
+    """Run a mango query `repeat` times and return the shortest time it took
+    to retrieve all results, in seconds, along with the number of results.
+
+    As ``_find`` only returns 25 documents unless the query has a ``limit``,
+    the results are retrieved in pages of `batch` documents using
+    `Database.iterfind`.
+
+    :rtype: `tuple`
+    """
+    best = count = None
+    for _ in range(repeat):
+        start = time.time()
+        count = sum(1 for _ in db.iterfind(query, batch))
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, count
+
+
+def plan_queries(db, queries, create=False, ddoc=None, repeat=REPEAT):
+    """Explain the given mango queries and propose an index for every query
+    that falls back to a scan of all documents.
+
+    With `create`, the proposed indexes are created, built by running the
+    queries once, and the queries that had no index are timed before and
+    after.
+
+    :param db: the `Database` to query
+    :param queries: a list of mango queries
+    :param create: whether to create the proposed indexes
+    :param ddoc: the design document to create indexes in, or `None` to let
+                 the server pick one per index
+    :param repeat: the number of times to run every query when timing it
+    :return: a list with a `dict` per query, holding the ``query``, the
+             ``index`` the server used, whether it was a ``full_scan``, the
+             ``fields`` of the proposed index, the ``sort`` the query has
+             to use for the index (see `index_sort`), whether the index was
+             ``created``, the ``before`` and ``after`` times in seconds for
+             retrieving all results, and the number of ``results``; the
+             time after is taken with the proposed sort
+    :rtype: `list`
+    """
+    results = []
+    for query in queries:
+        explanation = db.explain(query)
+        result = {'query': query, 'index': explanation.get('index', {}),
+                  'full_scan': is_full_scan(explanation), 'fields': None,
+                  'sort': None, 'created': False, 'before': None,
+                  'after': None, 'results': None}
+        if result['full_scan']:
+            result['fields'] = index_fields(query)
+            result['sort'] = index_sort(query)
+        results.append(result)
+    if not create:
+        return results
+
+    pending = [result for result in results if result['fields']]
+    for result in pending:
+        result['before'], result['results'] = time_query(db, result['query'],
+                                                         repeat)
+
+    created = []
+    indexes = db.index()
+    for result in pending:
+        if result['fields'] not in created:
+            indexes[ddoc, None] = result['fields']
+            created.append(result['fields'])
+            result['created'] = True
+
+    for result in pending:
+        query = result['query']
+        if result['sort'] is not None:
+            query = dict(query, sort=result['sort'])
+        list(db.find(dict(query, limit=1))) # build the index before timing
+        result['after'], _ = time_query(db, query, repeat)
+        result['index'] = db.explain(query).get('index', {})
+    return results
+
+
+def _describe_index(index):
+    if index.get('type') == 'special':
+        return index.get('name', '_all_docs')
+    return '%s/%s' % (index.get('ddoc'), index.get('name'))
+
+
+def print_report(results, output=None):
+    """Print a line per query of the results of `plan_queries`."""
+    if output is None:
+        output = sys.stdout
+    for num, result in enumerate(results):
+        line = 'query %d: %s' % (num + 1, _describe_index(result['index']))
+        if result['full_scan']:
+            if result['fields'] is None:
+                line += ', full scan, no index can help'
+            else:
+                line += ', full scan, index on %s' % json.encode(
+                    result['fields'])
+                if result['sort'] is not None:
+                    line += ', which needs sort %s' % json.encode(
+                        result['sort'])
+        if result['created']:
+            line += ' (created)'
+        if result['before'] is not None and result['after'] is not None:
+            line += ', %.3fs -> %.3fs for all %d results' % (
+                result['before'], result['after'], result['results'])
+        print(line, file=output)
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] dburl queries.json',
+                          version=VERSION)
+    parser.add_option('--json-module', action='store', dest='json_module',
+                      help='the JSON module to use ("simplejson", "cjson", '
+                            'or "json" are supported)')
+    parser.add_option('-u', '--username', action='store', dest='username',
+                      help='the username to use for authentication')
+    parser.add_option('-p', '--password', action='store', dest='password',
+                      help='the password to use for authentication')
+    parser.add_option('-c', '--create', action='store_true', dest='create',
+                      help='create the proposed indexes, and time the '
+                           'queries before and after')
+    parser.add_option('-d', '--ddoc', action='store', dest='ddoc',
+                      help='the design document to create the indexes in')
+    parser.add_option('-r', '--repeat', action='store', dest='repeat',
+                      type='int', default=REPEAT,
+                      help='number of times to run every query when timing')
+    parser.set_defaults()
+    options, args = parser.parse_args()
+
+    if len(args) != 2:
+        return parser.error('incorrect number of arguments')
+
+    if options.json_module:
+        json.use(options.json_module)
+
+    if args[1] == '-':
+        queries = json.decode(sys.stdin.read())
+    else:
+        with open(args[1]) as fileobj:
+            queries = json.decode(fileobj.read())
+    if isinstance(queries, dict):
+        queries = [queries]
+
+    db = Database(args[0])
+    if options.username is not None and options.password is not None:
+        db.resource.credentials = options.username, options.password
+
+    print_report(plan_queries(db, queries, create=options.create,
+                              ddoc=options.ddoc, repeat=options.repeat))
+
+
+if __name__ == '__main__':
+    main()
@@ -20,15 +20,63 @@ from couchdb import __version__ as VERSION
 from couchdb import json
 from couchdb.client import Database
 from couchdb.multipart import read_multipart
+from couchdb.tools.dump import BULK_SIZE, CHECKPOINT_ID
+from couchdb.tools.dumpfile import read_dump, sniff_dump_file
+
+
+def apply_deltas(db, docs, ignore_errors=False):
+    # A document changed while it was dumped can appear more than once, and
+    # only its last version can be applied on top of the current revision
+    latest = dict((doc['_id'], doc) for doc in docs)
+    docs = [doc for doc in docs if latest[doc['_id']] is doc]
+
+    revs = {}
+    for row in db.view('_all_docs', keys=[doc['_id'] for doc in docs]):
+        if row.value and not row.value.get('deleted'):
+            revs[row.key] = row.value['rev']
+
+    updates = []
+    for doc in docs:
+        rev = revs.get(doc['_id'])
+        if doc.get('_deleted'):
+            if rev is not None:
+                updates.append({'_id': doc['_id'], '_rev': rev,
+                                '_deleted': True})
+            continue
+        doc.pop('_rev', None)
+        if rev is not None:
+            doc['_rev'] = rev
+        updates.append(doc)
+
+    for success, docid, result in db.update(updates):
+        if not success:
+            if not ignore_errors:
+                raise result
+            print('Error: %s' % result, file=sys.stderr)
 
 
-def load_db(fileobj, dburl, username=None, password=None, ignore_errors=False):
+def load_db(fileobj, dburl, username=None, password=None, ignore_errors=False,
+            ids=None, start=None, end=None, deltas=False):
     db = Database(dburl)
     if username is not None and password is not None:
         db.resource.credentials = (username, password)
 
-    for headers, is_multipart, payload in read_multipart(fileobj):
+    is_dump, fileobj = sniff_dump_file(fileobj)
+    if is_dump:
+        parts = read_dump(fileobj, ids=ids, start=start, end=end)
+    elif ids is None and start is None and end is None:
+        parts = read_multipart(fileobj)
+    else:
+        raise ValueError('only compressed dump files allow selecting '
+                         'documents')
+
+    last_seq = None
+    batch = []
+    for headers, is_multipart, payload in parts:
         docid = headers['content-id']
+        if docid == CHECKPOINT_ID:
+            last_seq = json.decode(payload)['last_seq']
+            continue
 
         if is_multipart: # doc has attachments
             for headers, _, payload in payload:
@@ -45,6 +93,14 @@ def load_db(fileobj, dburl, username=None, password=None, ignore_errors=False):
         else: # no attachments, just the JSON
             doc = json.decode(payload)
 
+        if deltas:
+            print('Applying change to document %r' % docid, file=sys.stderr)
+            batch.append(doc)
+            if len(batch) >= BULK_SIZE:
+                apply_deltas(db, batch, ignore_errors=ignore_errors)
+                batch = []
+            continue
+
         del doc['_rev']
         print('Loading document %r' % docid, file=sys.stderr)
         try:
@@ -54,6 +110,12 @@ def load_db(fileobj, dburl, username=None, password=None, ignore_errors=False):
                 raise
             print('Error: %s' % e, file=sys.stderr)
 
+    if batch:
+        apply_deltas(db, batch, ignore_errors=ignore_errors)
+    if last_seq is not None:
+        print('Loaded up to sequence %s' % last_seq, file=sys.stderr)
+    return last_seq
+
 
 def main():
     parser = OptionParser(usage='%prog [options] dburl', version=VERSION)
@@ -70,6 +132,18 @@ def main():
                       help='the username to use for authentication')
     parser.add_option('-p', '--password', action='store', dest='password',
                       help='the password to use for authentication')
+    parser.add_option('--ids', action='store', dest='ids', metavar='IDS',
+                      help='comma-separated IDs of the documents to load from '
+                           'a compressed dump file')
+    parser.add_option('--start-id', action='store', dest='start', metavar='ID',
+                      help='the lowest ID of the documents to load from a '
+                           'compressed dump file')
+    parser.add_option('--end-id', action='store', dest='end', metavar='ID',
+                      help='the highest ID of the documents to load from a '
+                           'compressed dump file')
+    parser.add_option('--deltas', action='store_true', dest='deltas',
+                      help='apply an incremental dump, updating and deleting '
+                           'existing documents')
     parser.set_defaults(input='-')
     options, args = parser.parse_args()
 
@@ -79,13 +153,19 @@ def main():
     if options.input != '-':
         fileobj = open(options.input, 'rb')
     else:
-        fileobj = sys.stdin
+        fileobj = sys.stdin if sys.version_info[0] < 3 else sys.stdin.buffer
 
     if options.json_module:
         json.use(options.json_module)
 
+    ids = options.ids.split(',') if options.ids else None
+    if options.input == '-' and (ids or options.start or options.end):
+        return parser.error('selecting documents requires an input file')
+
     load_db(fileobj, args[0], username=options.username,
-            password=options.password, ignore_errors=options.ignore_errors)
+            password=options.password, ignore_errors=options.ignore_errors,
+            ids=ids, start=options.start, end=options.end,
+            deltas=options.deltas)
 
 
 if __name__ == '__main__':
@@ -18,8 +18,10 @@ Use 'python replicate.py --help' to get more detailed usage instructions.
 """
 
 from couchdb import http, client, util
+from couchdb.replication import Replicator
 import optparse
 import sys
+import threading
 import time
 import fnmatch
 
@@ -52,6 +54,81 @@ def findpath(parser, s):
     base = res.url + (parts[:cut] and '/'.join(parts[:cut]) or '')
     return base, '/'.join(parts[cut:])
 
+_output_lock = threading.Lock()
+
+def report(message):
+    '''prints a line of output, also from concurrent threads'''
+
+    with _output_lock:
+        sys.stdout.write(message + '\n')
+        sys.stdout.flush()
+
+def replicate_db(target, sbase, sdb, tdb, continuous=False,
+                 client_side=False):
+    '''replicates a single database, returns the number of docs written'''
+
+    start = time.time()
+    created = tdb not in target
+    if created:
+        target.create(tdb)
+
+    url = '%s%s' % (sbase, util.urlquote(sdb, ''))
+    if client_side:
+        source = client.Database(url)
+        docs = Replicator(source, target[tdb]).replicate()['docs_written']
+    else:
+        if continuous:
+            result = target.replicate(url, tdb, continuous=continuous)
+        else:
+            result = target.replicate(url, tdb)
+        history = result.get('history') or [{}]
+        docs = history[0].get('docs_written', 0)
+
+    report('%s -> %s%s %.1fs' % (sdb, tdb, created and ' (created)' or '',
+                                 time.time() - start))
+    return docs
+
+def monitor(target, stop, interval):
+    '''prints the progress of active replications until stop is set'''
+
+    while not stop.wait(interval):
+        try:
+            tasks = [t for t in target.tasks() if t.get('type') == 'replication']
+        except Exception:
+            continue
+        written = sum(t.get('docs_written', 0) for t in tasks)
+        report('%d replications active, %d docs written' % (len(tasks),
+                                                            written))
+
+def replicate_databases(target, sbase, databases, continuous=False,
+                        concurrency=1, interval=10, client_side=False):
+    '''replicates (source, target) name pairs, with up to concurrency
+    replications running at a time, returns the number of docs written'''
+
+    stop = threading.Event()
+    if concurrency > 1 and not client_side:
+        thread = threading.Thread(target=monitor,
+                                  args=(target, stop, interval))
+        thread.daemon = True
+        thread.start()
+    try:
+        docs = util.parallel_map(
+            lambda names: replicate_db(target, sbase, names[0], names[1],
+                                       continuous=continuous,
+                                       client_side=client_side),
+            databases, concurrency)
+    finally:
+        stop.set()
+    return sum(docs)
+
+def compact_db(db, interval=1):
+    '''compacts a database and waits for the compaction to finish'''
+
+    db.compact()
+    while db.info().get('compact_running'):
+        time.sleep(interval)
+    report('compacted %s' % db.name)
+
 def main():
 
     usage = '%prog [options] <source> <target>'
@@ -64,10 +141,22 @@ def main():
         action='store_true',
         dest='compact',
         help='compact target database after replication')
+    parser.add_option('--concurrency',
+        action='store',
+        dest='concurrency',
+        type='int',
+        default=1,
+        help='number of databases to replicate or compact at a time')
+    parser.add_option('--client',
+        action='store_true',
+        dest='client_side',
+        help='replicate through this client instead of the target server')
 
     options, args = parser.parse_args()
     if len(args) != 2:
         raise parser.error('need source and target arguments')
+    if options.client_side and options.continuous:
+        raise parser.error('client replication cannot be continuous')
 
     # set up server objects
 
@@ -99,29 +188,18 @@ def main():
 
     # do the actual replication
 
-    for sdb, tdb in databases:
-
-        start = time.time()
-        print(sdb, '->', tdb)
-        sys.stdout.flush()
-
-        if tdb not in target:
-            target.create(tdb)
-            sys.stdout.write("created")
-            sys.stdout.flush()
-
-        sdb = '%s%s' % (sbase, util.urlquote(sdb, ''))
-        if options.continuous:
-            target.replicate(sdb, tdb, continuous=options.continuous)
-        else:
-            target.replicate(sdb, tdb)
-        print('%.1fs' % (time.time() - start))
-        sys.stdout.flush()
+    start = time.time()
+    docs = replicate_databases(target, sbase, databases,
+                               continuous=options.continuous,
+                               concurrency=options.concurrency,
+                               client_side=options.client_side)
+    elapsed = time.time() - start
+    print('replicated %d databases, %d docs in %.1fs (%.1f docs/s)' % (
+        len(databases), docs, elapsed, docs / max(elapsed, 0.001)))
 
     if options.compact:
-        for (sdb, tdb) in databases:
-            print('compact', tdb)
-            target[tdb].compact()
+        util.parallel_map(lambda names: compact_db(target[names[1]]),
+                          databases, options.concurrency)
 
 if __name__ == '__main__':
     main()
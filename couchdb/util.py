@@ -1,4 +1,5 @@
 import sys
+import threading
 
 if sys.version_info[0] < 3:
     from couchdb.util2 import *
@@ -8,3 +9,64 @@ else:
 def pyexec(code, gns, lns):
     # http://bugs.python.org/issue21591
     exec(code, gns, lns)
+
+def parallel_map(func, items, concurrency):
+    """Return the list of ``func(item)`` for all items, calling `func` in up
+    to `concurrency` threads. If a call raises an exception, no further calls
+    are started, and the exception is raised once the running ones finish.
+    """
+    items = list(items)
+    if concurrency <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    results = [None] * len(items)
+    errors = []
+    pending = iter(range(len(items)))
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            with lock:
+                index = None if errors else next(pending, None)
+            if index is None:
+                return
+            try:
+                results[index] = func(items[index])
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+
+    threads = [threading.Thread(target=work)
+               for _ in range(min(concurrency, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
+
+
+def in_background(func, *args):
+    """Start calling ``func(*args)`` in a thread, and return a function that
+    waits for the call to finish and returns its result, or raises the
+    exception it raised.
+    """
+    outcome = []
+
+    def run():
+        try:
+            outcome.append((True, func(*args)))
+        except Exception as e:
+            outcome.append((False, e))
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+
+    def wait():
+        thread.join()
+        success, value = outcome[0]
+        if not success:
+            raise value
+        return value
+    return wait
@@ -2,18 +2,24 @@
 Simple peformance tests.
 """
 
+from __future__ import print_function
 import sys
 import time
 
 import couchdb
+from couchdb import mapping, util
+from couchdb.replication import Replicator
 
 
 def main():
 
-    print 'sys.version : %r' % (sys.version,)
-    print 'sys.platform : %r' % (sys.platform,)
+    print('sys.version : %r' % (sys.version,))
+    print('sys.platform : %r' % (sys.platform,))
 
-    tests = [create_doc, create_bulk_docs]
+    tests = [create_doc, create_bulk_docs, get_small_doc, get_large_doc,
+             get_large_doc_lazy, create_mapping_docs, wrap_mapping_docs,
+             read_mapping_dates, store_mapping_docs, validate_mapping_docs,
+             replicate_docs]
     if len(sys.argv) > 1:
         tests = [test for test in tests if test.__name__ in sys.argv[1:]]
 
@@ -36,7 +42,7 @@ def _run(server, func):
             sys.stdout.write("%0.2fs\n" % (stop - start,))
             sys.stdout.flush()
         except Exception as e:
-            sys.stdout.write("FAILED - %r\n" % (unicode(e),))
+            sys.stdout.write("FAILED - %r\n" % (util.utype(e),))
             sys.stdout.flush()
     finally:
         server.delete(db_name)
@@ -45,7 +51,7 @@ def _run(server, func):
 def create_doc(db):
     """Create lots of docs, one at a time"""
     for i in range(1000):
-        db.save({'_id': unicode(i)})
+        db.save({'_id': util.utype(i)})
 
 
 def create_bulk_docs(db):
@@ -53,7 +59,89 @@ def create_bulk_docs(db):
     batch_size = 100
     num_batches = 1000
     for i in range(num_batches):
-        db.update([{'_id': unicode((i * batch_size) + j)} for j in range(batch_size)])
+        db.update([{'_id': util.utype((i * batch_size) + j)} for j in range(batch_size)])
+
+
+def get_small_doc(db):
+    """Get small docs lots of times"""
+    db.update([{'_id': util.utype(i), 'n': i} for i in range(100)])
+    for i in range(5000):
+        db.get(util.utype(i % 100))
+
+
+def _large_doc():
+    return {'_id': 'large', 'items': [{'n': i, 'name': 'item %d' % i}
+                                      for i in range(10000)]}
+
+
+def get_large_doc(db):
+    """Get a large doc and read its revision"""
+    db.save(_large_doc())
+    for i in range(200):
+        db.get('large').rev
+
+
+def get_large_doc_lazy(db):
+    """Get a large doc lazily and read its revision"""
+    db.save(_large_doc())
+    for i in range(200):
+        db.get('large', lazy=True).rev
+
+
+class Post(mapping.Document):
+    title = mapping.TextField()
+    author = mapping.TextField()
+    views = mapping.IntegerField(default=0)
+    pubdate = mapping.DateTimeField()
+    tags = mapping.ListField(mapping.TextField())
+
+
+def create_mapping_docs(db):
+    """Create lots of mapping documents (no requests)"""
+    for i in range(50000):
+        Post(title='Foo bar', author='Joe', tags=['foo', 'bar'])
+
+
+def wrap_mapping_docs(db):
+    """Wrap lots of docs in a mapping and read a field (no requests)"""
+    data = {'_id': 'foo', 'title': 'Foo bar', 'author': 'Joe', 'views': 3,
+            'pubdate': '2018-02-09T12:00:00Z', 'tags': ['foo', 'bar']}
+    for i in range(50000):
+        Post.wrap(data).title
+
+
+def read_mapping_dates(db):
+    """Wrap lots of docs in a mapping and read a date/time field (no requests)"""
+    data = {'_id': 'foo', 'title': 'Foo bar', 'author': 'Joe', 'views': 3,
+            'pubdate': '2018-02-09T12:00:00.123+01:00', 'tags': ['foo', 'bar']}
+    for i in range(50000):
+        Post.wrap(data).pubdate
+
+
+def store_mapping_docs(db):
+    """Store lots of mapping documents, lots at a time"""
+    posts = [Post(title='Foo bar', author='Joe', tags=['foo', 'bar'])
+             for i in range(100000)]
+    Post.store_many(db, posts, batch_size=100)
+
+
+def validate_mapping_docs(db):
+    """Validate lots of mapping documents (no requests)"""
+    data = {'_id': 'foo', 'title': 'Foo bar', 'author': 'Joe', 'views': 3,
+            'pubdate': '2018-02-09T12:00:00Z', 'tags': ['foo', 'bar']}
+    Post.validate_many(Post.wrap_many([data] * 50000))
+
+
+def replicate_docs(db):
+    """Replicate lots of docs to another db on the client"""
+    for i in range(100):
+        db.update([{'_id': util.utype((i * 100) + j)} for j in range(100)])
+    server = couchdb.Server()
+    target = server.create('couchdb-python/perftest-target')
+    try:
+        Replicator(db, target, batch_size=500).replicate()
+    finally:
+        server.delete('couchdb-python/perftest-target')
 
 
 if __name__ == '__main__':